@@ -0,0 +1,221 @@
+# analytics.py
+# Grade analytics kept as rollup rows instead of being computed from assignments.
+#
+# `class_rollups`, `class_grade_counts` and `student_rollups` hold running totals
+# (submissions, grade distribution, average grade points, comments waiting for an
+# answer, tokens) that are bumped in the same transaction as the write they
+# count: a graded assignment in process_file, a comment or an instructor
+# response. Reading the stats of a class is then a couple of primary-key lookups,
+# however many submissions it has. `rebuild` recomputes the rollups from the
+# assignments (regrades, backfills, or to repair drift).
+#
+#   python analytics.py rebuild ["Class name"]
+
+import re
+from collections import defaultdict
+from typing import Iterable, Optional
+
+from sqlalchemy import case, delete, func, insert, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import Assignment, ClassGradeCount, ClassRollup, Comment, StudentRollup
+
+GRADE_POINTS = {"A": 4.0, "B": 3.0, "C": 2.0, "D": 1.0, "F": 0.0}
+_LETTER_GRADE = re.compile(r"^\s*([ABCDF])\s*([+-]?)\s*$", re.IGNORECASE)
+
+
+def grade_points(grade: Optional[str]) -> Optional[float]:
+    """4.0 scale value of a letter grade ("B+" -> 3.3); None for anything else ("Error")."""
+    match = _LETTER_GRADE.match(grade or "")
+    if not match:
+        return None
+    letter, sign = match.group(1).upper(), match.group(2)
+    points = GRADE_POINTS[letter]
+    if letter != "F":
+        points += {"+": 0.3, "-": -0.3}.get(sign, 0.0)
+    return min(points, 4.0)
+
+
+def _upsert(db, model, keys: dict, increments: dict, values: Optional[dict] = None, returning=None):
+    """INSERT the row, or add `increments` to (and overwrite `values` of) the existing one."""
+    values = values or {}
+    dialect_insert = postgresql.insert if db.get_bind().dialect.name == "postgresql" else sqlite.insert
+    table = model.__table__
+    statement = dialect_insert(table).values(**keys, **increments, **values)
+    updates = {name: table.c[name] + statement.excluded[name] for name in increments}
+    updates.update({name: statement.excluded[name] for name in values})
+    statement = statement.on_conflict_do_update(index_elements=list(keys), set_=updates)
+    if returning is not None:
+        return db.execute(statement.returning(table.c[returning])).scalar()
+    db.execute(statement)
+
+
+def record_assignment(db, assignment_id: int, class_id: Optional[int], student_id: int, grade: str,
+                      prompt_tokens: int = 0, completion_tokens: int = 0):
+    """Count a newly graded assignment. Runs in the caller's transaction."""
+    if class_id is None:
+        return
+    points = grade_points(grade)
+    graded = {"graded": 1 if points is not None else 0, "grade_points": points or 0.0}
+    # RETURNING the new count tells us (race-free) whether this is the student's first submission here
+    submissions = _upsert(
+        db, StudentRollup, {"class_id": class_id, "student_id": student_id},
+        {"submissions": 1, "comments": 0, "unanswered_comments": 0, **graded},
+        {"latest_assignment_id": assignment_id, "latest_grade": grade},
+        returning="submissions",
+    )
+    _upsert(db, ClassRollup, {"class_id": class_id}, {
+        "submissions": 1, "students": 1 if submissions == 1 else 0, "comments": 0, "unanswered_comments": 0,
+        "prompt_tokens": prompt_tokens or 0, "completion_tokens": completion_tokens or 0, **graded,
+    })
+    _upsert(db, ClassGradeCount, {"class_id": class_id, "grade": grade}, {"count": 1})
+
+
+def record_comment(db, class_id: Optional[int], student_id: int, comments: int = 0, unanswered: int = 0):
+    """Apply a change in the number of comments / unanswered comments. Runs in the caller's transaction."""
+    if class_id is None or not (comments or unanswered):
+        return
+    zero = {"submissions": 0, "graded": 0, "grade_points": 0.0}
+    delta = {"comments": comments, "unanswered_comments": unanswered}
+    _upsert(db, StudentRollup, {"class_id": class_id, "student_id": student_id}, {**zero, **delta})
+    _upsert(db, ClassRollup, {"class_id": class_id},
+            {**zero, "students": 0, "prompt_tokens": 0, "completion_tokens": 0, **delta})
+
+
+def rebuild(db, class_id: Optional[int] = None) -> int:
+    """Recompute the rollups of one class (or all classes) from assignments and comments.
+
+    Works with a Session or a Connection; the caller commits. Returns the number of
+    student rollup rows written.
+    """
+    def scoped(query, column):
+        return query.where(column == class_id) if class_id is not None else query.where(column.is_not(None))
+
+    groups = db.execute(scoped(
+        select(Assignment.class_id, Assignment.student_id, Assignment.grade, func.count(), func.max(Assignment.id),
+               func.sum(func.coalesce(Assignment.prompt_tokens, 0)),
+               func.sum(func.coalesce(Assignment.completion_tokens, 0)))
+        .group_by(Assignment.class_id, Assignment.student_id, Assignment.grade),
+        Assignment.class_id,
+    )).all()
+    unanswered = case((func.coalesce(Comment.instructor_response, "") == "", 1), else_=0)
+    comment_groups = db.execute(scoped(
+        select(Assignment.class_id, Assignment.student_id, func.count(Comment.id), func.sum(unanswered))
+        .join(Assignment, Assignment.id == Comment.assignment_id)
+        .group_by(Assignment.class_id, Assignment.student_id),
+        Assignment.class_id,
+    )).all()
+
+    def empty_student():
+        return {"submissions": 0, "graded": 0, "grade_points": 0.0, "comments": 0, "unanswered_comments": 0,
+                "latest_assignment_id": None, "latest_grade": None}
+
+    def empty_class():
+        return {"submissions": 0, "students": 0, "graded": 0, "grade_points": 0.0, "comments": 0,
+                "unanswered_comments": 0, "prompt_tokens": 0, "completion_tokens": 0}
+
+    students = defaultdict(empty_student)
+    classes = defaultdict(empty_class)
+    grade_counts = defaultdict(int)
+    for group_class, student_id, grade, count, latest_id, prompt_tokens, completion_tokens in groups:
+        points = grade_points(grade)
+        student, class_ = students[(group_class, student_id)], classes[group_class]
+        for row in (student, class_):
+            row["submissions"] += count
+            if points is not None:
+                row["graded"] += count
+                row["grade_points"] += points * count
+        class_["prompt_tokens"] += prompt_tokens or 0
+        class_["completion_tokens"] += completion_tokens or 0
+        if student["latest_assignment_id"] is None or latest_id > student["latest_assignment_id"]:
+            student["latest_assignment_id"], student["latest_grade"] = latest_id, grade
+        grade_counts[(group_class, grade)] += count
+    for group_class, student_id, count, unanswered_count in comment_groups:
+        for row in (students[(group_class, student_id)], classes[group_class]):
+            row["comments"] += count
+            row["unanswered_comments"] += unanswered_count or 0
+    for (group_class, _), student in students.items():
+        if student["submissions"]:
+            classes[group_class]["students"] += 1
+
+    for model in (StudentRollup, ClassGradeCount, ClassRollup):
+        statement = delete(model)
+        if class_id is not None:
+            statement = statement.where(model.class_id == class_id)
+        db.execute(statement)
+    if students:
+        db.execute(insert(StudentRollup), [
+            {"class_id": c, "student_id": s, **row} for (c, s), row in students.items()
+        ])
+        db.execute(insert(ClassRollup), [{"class_id": c, **row} for c, row in classes.items()])
+    if grade_counts:
+        db.execute(insert(ClassGradeCount), [
+            {"class_id": c, "grade": grade, "count": count} for (c, grade), count in grade_counts.items()
+        ])
+    return len(students)
+
+
+def class_summaries(db, class_ids: Iterable[int]) -> dict:
+    """{class_id: summary} for the given classes, in one query however many classes or submissions."""
+    class_ids = list(class_ids)
+    if not class_ids:
+        return {}
+    summaries = {class_id: {
+        "class_id": class_id, "submissions": 0, "students": 0, "graded": 0, "average_grade_points": None,
+        "comments": 0, "unanswered_comments": 0, "tokens": {"prompt": 0, "completion": 0}, "grades": {},
+    } for class_id in class_ids}
+    # One row per (class, grade); the class columns repeat on each
+    rows = db.execute(
+        select(ClassRollup, ClassGradeCount.grade, ClassGradeCount.count)
+        .outerjoin(ClassGradeCount, (ClassGradeCount.class_id == ClassRollup.class_id) & (ClassGradeCount.count > 0))
+        .where(ClassRollup.class_id.in_(class_ids))
+        .order_by(ClassRollup.class_id, ClassGradeCount.grade)
+    )
+    for rollup, grade, count in rows:
+        summary = summaries[rollup.class_id]
+        summary.update({
+            "submissions": rollup.submissions,
+            "students": rollup.students,
+            "graded": rollup.graded,
+            "average_grade_points": round(rollup.grade_points / rollup.graded, 2) if rollup.graded else None,
+            "comments": rollup.comments,
+            "unanswered_comments": rollup.unanswered_comments,
+            "tokens": {"prompt": rollup.prompt_tokens, "completion": rollup.completion_tokens},
+        })
+        if grade is not None:
+            summary["grades"][grade] = count
+    return summaries
+
+
+def student_summary(row: StudentRollup) -> dict:
+    return {
+        "student_id": row.student_id,
+        "submissions": row.submissions,
+        "graded": row.graded,
+        "average_grade_points": round(row.grade_points / row.graded, 2) if row.graded else None,
+        "latest_grade": row.latest_grade,
+        "comments": row.comments,
+        "unanswered_comments": row.unanswered_comments,
+    }
+
+
+if __name__ == "__main__":
+    import sys
+
+    from models import Class, SessionLocal
+
+    if len(sys.argv) not in (2, 3) or sys.argv[1] != "rebuild":
+        sys.exit('usage: python analytics.py rebuild ["Class name"]')
+    db = SessionLocal()
+    try:
+        class_id = None
+        if len(sys.argv) == 3:
+            class_obj = db.query(Class).filter(Class.name == sys.argv[2]).first()
+            if class_obj is None:
+                sys.exit(f"Class {sys.argv[2]} not found.")
+            class_id = class_obj.id
+        rows = rebuild(db, class_id)
+        db.commit()
+        print(f"Rebuilt analytics for {rows} student(s).")
+    finally:
+        db.close()
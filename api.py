@@ -0,0 +1,308 @@
+# api.py
+# Paginated JSON API for results, class rosters, class submissions, near-duplicate
+# submissions, grade analytics and search.
+#
+# Every list endpoint uses keyset pagination on the primary key: pass the
+# `next_after` value of one page as `after` to get the next one. Cost per page
+# stays flat no matter how many rows the table holds (no OFFSET scans).
+# Search results are ranked, so their `next_after` is an opaque cursor instead.
+# Responses carry an ETag and answer If-None-Match with 304 Not Modified.
+
+import hashlib
+import json
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Query, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import Response
+from sqlalchemy.orm import Session, joinedload, selectinload, defer
+
+import analytics
+import metrics
+import search
+from auth import Identity, current_user
+from models import Assignment, Class, SimilarityMatch, Student, StudentRollup, SemesterEnum, student_class_association, get_db
+
+router = APIRouter(prefix="/api")
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def etag_response(request: Request, payload) -> Response:
+    body = json.dumps(jsonable_encoder(payload), separators=(",", ":"), sort_keys=True).encode("utf-8")
+    etag = f'W/"{hashlib.sha1(body).hexdigest()}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+def keyset_page(query, id_column, after: Optional[int], limit: int):
+    """Return (rows, next_after) for the page of rows with id > after."""
+    if after is not None:
+        query = query.filter(id_column > after)
+    rows = query.order_by(id_column).limit(limit + 1).all()
+    next_after = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_after = getattr(rows[-1], id_column.key)
+    return rows, next_after
+
+
+def parse_semester(semester: Optional[str]):
+    if semester is None:
+        return None
+    try:
+        return SemesterEnum[semester.strip().upper()]
+    except KeyError:
+        return False
+
+
+def assignment_to_dict(a: Assignment) -> dict:
+    return {
+        "id": a.id,
+        "filename": a.filename,
+        "class_id": a.class_id,
+        "class_name": a.class_obj.name if a.class_obj else "N/A",
+        "student_id": a.student_id,
+        "grade": a.grade,
+        "feedback": a.feedback,
+        "tokens": {
+            "prompt": a.prompt_tokens,
+            "completion": a.completion_tokens,
+        },
+        "comment": {
+            "student_comment": a.comment.student_comment,
+            "instructor_response": a.comment.instructor_response,
+        } if a.comment else None,
+    }
+
+
+def filtered_assignments(db: Session, class_id, semester, year, grade):
+    query = (
+        db.query(Assignment)
+        .options(joinedload(Assignment.class_obj), selectinload(Assignment.comment), defer(Assignment.extracted_text))
+    )
+    if class_id is not None:
+        query = query.filter(Assignment.class_id == class_id)
+    if grade is not None:
+        query = query.filter(Assignment.grade == grade)
+    if semester is not None or year is not None:
+        query = query.join(Assignment.class_obj)
+        if semester is not None:
+            query = query.filter(Class.semester == semester)
+        if year is not None:
+            query = query.filter(Class.year == year)
+    return query
+
+
+@router.get("/results")
+async def api_results(
+    request: Request,
+    class_id: Optional[int] = None,
+    semester: Optional[str] = None,
+    year: Optional[int] = None,
+    grade: Optional[str] = None,
+    after: Optional[int] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    user: Identity = Depends(current_user),
+    db: Session = Depends(get_db),
+):
+    if not user or user.role != "student":
+        return {"error": "You must be logged in as a student to view results."}
+    semester_value = parse_semester(semester)
+    if semester_value is False:
+        return {"error": f"Unknown semester {semester}."}
+
+    query = filtered_assignments(db, class_id, semester_value, year, grade).filter(Assignment.student_id == user.user_id)
+    rows, next_after = keyset_page(query, Assignment.id, after, limit)
+    return etag_response(request, {"items": [assignment_to_dict(a) for a in rows], "next_after": next_after})
+
+
+@router.get("/classes")
+async def api_classes(
+    request: Request,
+    semester: Optional[str] = None,
+    year: Optional[int] = None,
+    after: Optional[int] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    user: Identity = Depends(current_user),
+    db: Session = Depends(get_db),
+):
+    if not user or user.role not in ("instructor", "admin"):
+        return {"error": "You must be logged in as an instructor or admin to view classes."}
+    semester_value = parse_semester(semester)
+    if semester_value is False:
+        return {"error": f"Unknown semester {semester}."}
+
+    query = db.query(Class).options(joinedload(Class.instructor))
+    if user.role == "instructor":
+        query = query.filter(Class.id.in_(user.class_ids))
+    if semester_value is not None:
+        query = query.filter(Class.semester == semester_value)
+    if year is not None:
+        query = query.filter(Class.year == year)
+
+    rows, next_after = keyset_page(query, Class.id, after, limit)
+    items = [
+        {
+            "id": c.id,
+            "name": c.name,
+            "year": c.year,
+            "semester": c.semester.name,
+            "instructor": {"id": c.instructor.id, "name": c.instructor.name, "email": c.instructor.email} if c.instructor else None,
+        }
+        for c in rows
+    ]
+    return etag_response(request, {"items": items, "next_after": next_after})
+
+
+@router.get("/classes/{class_id}/students")
+async def api_class_roster(
+    request: Request,
+    class_id: int,
+    after: Optional[int] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    user: Identity = Depends(current_user),
+    db: Session = Depends(get_db),
+):
+    if not user or not user.can_view_class(class_id):
+        return {"error": "Class not found or you are not authorized."}
+
+    query = (
+        db.query(Student)
+        .join(student_class_association, student_class_association.c.student_id == Student.id)
+        .filter(student_class_association.c.class_id == class_id)
+    )
+    rows, next_after = keyset_page(query, Student.id, after, limit)
+    items = [{"id": s.id, "name": s.name, "email": s.email} for s in rows]
+    return etag_response(request, {"items": items, "next_after": next_after})
+
+
+@router.get("/classes/{class_id}/assignments")
+async def api_class_assignments(
+    request: Request,
+    class_id: int,
+    student_id: Optional[int] = None,
+    grade: Optional[str] = None,
+    after: Optional[int] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    user: Identity = Depends(current_user),
+    db: Session = Depends(get_db),
+):
+    if not user or not user.can_view_class(class_id):
+        return {"error": "Class not found or you are not authorized."}
+
+    query = filtered_assignments(db, class_id, None, None, grade)
+    if student_id is not None:
+        query = query.filter(Assignment.student_id == student_id)
+    rows, next_after = keyset_page(query, Assignment.id, after, limit)
+    return etag_response(request, {"items": [assignment_to_dict(a) for a in rows], "next_after": next_after})
+
+
+@router.get("/classes/{class_id}/similar")
+async def api_class_similar(
+    request: Request,
+    class_id: int,
+    min_similarity: float = Query(0.0, ge=0.0, le=1.0),
+    after: Optional[int] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    user: Identity = Depends(current_user),
+    db: Session = Depends(get_db),
+):
+    """Pairs of submissions in the class flagged as near-duplicates (see similarity.py)."""
+    if not user or not user.can_view_class(class_id):
+        return {"error": "Class not found or you are not authorized."}
+
+    query = db.query(SimilarityMatch).filter(SimilarityMatch.class_id == class_id)
+    if min_similarity:
+        query = query.filter(SimilarityMatch.similarity >= min_similarity)
+    rows, next_after = keyset_page(query, SimilarityMatch.id, after, limit)
+    ids = {m.assignment_id for m in rows} | {m.matched_assignment_id for m in rows}
+    assignments = {
+        a.id: a for a in db.query(Assignment.id, Assignment.filename, Assignment.student_id).filter(Assignment.id.in_(ids))
+    } if ids else {}
+
+    def summary(assignment_id):
+        a = assignments.get(assignment_id)
+        return {"id": assignment_id, "filename": a.filename, "student_id": a.student_id} if a else {"id": assignment_id}
+
+    items = [
+        {
+            "id": m.id,
+            "similarity": m.similarity,
+            "assignment": summary(m.assignment_id),
+            "matched_assignment": summary(m.matched_assignment_id),
+            "created_at": m.created_at,
+        }
+        for m in rows
+    ]
+    return etag_response(request, {"items": items, "next_after": next_after})
+
+
+@router.get("/classes/{class_id}/analytics")
+async def api_class_analytics(
+    request: Request,
+    class_id: int,
+    user: Identity = Depends(current_user),
+    db: Session = Depends(get_db),
+):
+    """Grade distribution, submission and comment counts of a class, from the rollups (see analytics.py)."""
+    if not user or not user.can_view_class(class_id):
+        return {"error": "Class not found or you are not authorized."}
+    with metrics.span("analytics_query"):
+        summary = analytics.class_summaries(db, [class_id])[class_id]
+    return etag_response(request, summary)
+
+
+@router.get("/classes/{class_id}/analytics/students")
+async def api_class_student_analytics(
+    request: Request,
+    class_id: int,
+    after: Optional[int] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    user: Identity = Depends(current_user),
+    db: Session = Depends(get_db),
+):
+    """Per-student rollups of a class, paginated on student id."""
+    if not user or not user.can_view_class(class_id):
+        return {"error": "Class not found or you are not authorized."}
+    query = db.query(StudentRollup).filter(StudentRollup.class_id == class_id)
+    rows, next_after = keyset_page(query, StudentRollup.student_id, after, limit)
+    return etag_response(request, {"items": [analytics.student_summary(r) for r in rows], "next_after": next_after})
+
+
+@router.get("/search")
+async def api_search(
+    request: Request,
+    q: str = Query(..., min_length=1, max_length=500),
+    class_id: Optional[int] = None,
+    after: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE),
+    user: Identity = Depends(current_user),
+    db: Session = Depends(get_db),
+):
+    """Ranked full-text search over the submissions, feedback and comments the caller may see."""
+    if not user:
+        return {"error": "You must be logged in to search."}
+    cursor = search.decode_cursor(after)
+    if cursor is False:
+        return {"error": "Invalid next_after cursor."}
+
+    # Students search their own submissions, instructors their classes, admins everything
+    class_ids, student_id = None, None
+    if user.role == "student":
+        student_id = user.user_id
+    elif user.role == "instructor":
+        class_ids = user.class_ids
+    if class_id is not None:
+        if user.role == "instructor" and class_id not in user.class_ids:
+            return {"error": "Class not found or you are not authorized."}
+        class_ids = [class_id]
+
+    with metrics.span("search_query"):
+        items, next_after = search.search(db, q, class_ids=class_ids, student_id=student_id, after=cursor, limit=limit)
+    return etag_response(request, {"items": items, "next_after": next_after})
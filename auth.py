@@ -0,0 +1,227 @@
+# auth.py
+# Login sessions and the identity of the user behind each request.
+#
+# Logging in creates a row in the `sessions` table and sets one cookie holding the
+# session id plus an HMAC signature (SESSION_SECRET). A request's cookie is checked
+# against the signature before anything else, so forged or tampered cookies never
+# reach the database. The resolved Identity (role, id, and the ids of the classes
+# the user is enrolled in or teaches) is kept in an in-memory cache for
+# IDENTITY_CACHE_TTL_SECONDS, so most requests resolve their user without a query.
+
+import base64
+import dataclasses
+import datetime
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from fastapi import Cookie, Depends
+from sqlalchemy import literal, select, union_all
+from sqlalchemy.orm import Session
+
+import metrics
+from models import Admin, Class, Instructor, Student, UserSession, get_db, student_class_association
+
+# Must be set, and the same for every worker: a cookie signed by one worker has to
+# verify on the others and after a restart. The server refuses to start without it.
+SESSION_SECRET = os.getenv("SESSION_SECRET", "")
+# Local development only: sign with a random per-process secret instead of refusing to start
+SESSION_SECRET_ALLOW_RANDOM = os.getenv("SESSION_SECRET_ALLOW_RANDOM", "0") == "1"
+SESSION_COOKIE = "session"
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", str(7 * 24 * 3600)))
+SESSION_COOKIE_SECURE = os.getenv("SESSION_COOKIE_SECURE", "0") == "1"
+IDENTITY_CACHE_TTL_SECONDS = float(os.getenv("IDENTITY_CACHE_TTL_SECONDS", "60"))
+IDENTITY_CACHE_SIZE = int(os.getenv("IDENTITY_CACHE_SIZE", "10000"))
+
+LANDING_PAGES = {"student": "/", "instructor": "/instructor_dashboard", "admin": "/admin_dashboard"}
+
+
+@dataclasses.dataclass(frozen=True)
+class Identity:
+    user_id: int
+    role: str
+    email: str
+    # Classes the student is enrolled in, or the instructor teaches (empty for admins)
+    class_ids: frozenset = frozenset()
+
+    def can_view_class(self, class_id: int) -> bool:
+        return self.role == "admin" or (self.role == "instructor" and class_id in self.class_ids)
+
+
+def require_session_secret():
+    """Fail startup without SESSION_SECRET (unless SESSION_SECRET_ALLOW_RANDOM=1 for development)."""
+    global SESSION_SECRET
+    if SESSION_SECRET:
+        return
+    if not SESSION_SECRET_ALLOW_RANDOM:
+        raise RuntimeError("SESSION_SECRET is not set. Set it to the same random value for every worker "
+                           "(e.g. `python -c 'import secrets; print(secrets.token_hex(32))'`).")
+    from main import log_error
+    log_error("SESSION_SECRET is not set; using a random secret. Sessions will not survive a restart "
+              "and are only valid on this worker. Do not run like this in production.")
+    SESSION_SECRET = secrets.token_hex(32)
+
+
+def _sign(session_id: str) -> str:
+    if not SESSION_SECRET:
+        raise RuntimeError("SESSION_SECRET is not set.")
+    digest = hmac.new(SESSION_SECRET.encode(), session_id.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).decode().rstrip("=")
+
+
+def _session_key(session_id: str) -> str:
+    return hashlib.sha256(session_id.encode()).hexdigest()
+
+
+def unsign(token: Optional[str]) -> Optional[str]:
+    """Return the session id in a cookie value, or None if it is missing or not signed by us."""
+    if not token or "." not in token:
+        return None
+    session_id, signature = token.rsplit(".", 1)
+    if not hmac.compare_digest(signature, _sign(session_id)):
+        return None
+    return session_id
+
+
+class IdentityCache:
+    """LRU of session id -> Identity, each entry valid for `ttl` seconds."""
+
+    def __init__(self, ttl: float = IDENTITY_CACHE_TTL_SECONDS, max_size: int = IDENTITY_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()  # session id -> (identity, expires at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, session_id: str) -> Optional[Identity]:
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None or entry[1] < time.monotonic():
+                self._entries.pop(session_id, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(session_id)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, session_id: str, identity: Identity, max_age: float = None):
+        ttl = self.ttl if max_age is None else min(self.ttl, max_age)
+        with self._lock:
+            self._entries[session_id] = (identity, time.monotonic() + ttl)
+            self._entries.move_to_end(session_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, session_id: str):
+        with self._lock:
+            self._entries.pop(session_id, None)
+
+    def clear(self):
+        """Drop every cached identity, e.g. after enrollments or class assignments changed."""
+        with self._lock:
+            self._entries.clear()
+
+
+identity_cache = IdentityCache()
+
+metrics.CallbackMetric(
+    "identity_cache_lookups_total", "Session identity cache lookups by result.",
+    lambda: {("hit",): identity_cache.hits, ("miss",): identity_cache.misses},
+    labels=["result"], type="counter",
+)
+
+
+def find_user_by_email(db: Session, email: str):
+    """Look the email up in all three user tables in one query. Returns (role, user id) or None.
+
+    If the same email is in more than one table, student wins over instructor over admin.
+    """
+    query = union_all(
+        select(literal(0).label("rank"), literal("student").label("role"), Student.id).where(Student.email == email),
+        select(literal(1), literal("instructor"), Instructor.id).where(Instructor.email == email),
+        select(literal(2), literal("admin"), Admin.id).where(Admin.email == email),
+    ).order_by("rank").limit(1)
+    row = db.execute(query).first()
+    return (row.role, row.id) if row else None
+
+
+def load_identity(db: Session, role: str, user_id: int) -> Optional[Identity]:
+    """Build an Identity with one query; None if the user no longer exists."""
+    if role == "student":
+        rows = db.execute(
+            select(Student.email, student_class_association.c.class_id)
+            .outerjoin(student_class_association, student_class_association.c.student_id == Student.id)
+            .where(Student.id == user_id)
+        ).all()
+    elif role == "instructor":
+        rows = db.execute(
+            select(Instructor.email, Class.id)
+            .outerjoin(Class, Class.instructor_id == Instructor.id)
+            .where(Instructor.id == user_id)
+        ).all()
+    elif role == "admin":
+        rows = db.execute(select(Admin.email, literal(None)).where(Admin.id == user_id)).all()
+    else:
+        return None
+    if not rows:
+        return None
+    return Identity(user_id=user_id, role=role, email=rows[0][0],
+                    class_ids=frozenset(class_id for _, class_id in rows if class_id is not None))
+
+
+def create_session(db: Session, role: str, user_id: int) -> str:
+    """Start a session for the user and return the signed cookie value."""
+    now = datetime.datetime.utcnow()
+    # Expired sessions are cleared out here rather than by a separate job
+    db.query(UserSession).filter(UserSession.expires_at < now).delete(synchronize_session=False)
+    session_id = secrets.token_urlsafe(32)
+    db.add(UserSession(id=_session_key(session_id), user_id=user_id, role=role, created_at=now,
+                       expires_at=now + datetime.timedelta(seconds=SESSION_TTL_SECONDS)))
+    db.commit()
+    return f"{session_id}.{_sign(session_id)}"
+
+
+def resolve_session(db: Session, token: Optional[str]) -> Optional[Identity]:
+    session_id = unsign(token)
+    if session_id is None:
+        return None
+    identity = identity_cache.get(session_id)
+    if identity is not None:
+        return identity
+
+    now = datetime.datetime.utcnow()
+    row = db.query(UserSession.role, UserSession.user_id, UserSession.expires_at).filter(
+        UserSession.id == _session_key(session_id), UserSession.expires_at > now
+    ).first()
+    if row is None:
+        return None
+    identity = load_identity(db, row.role, row.user_id)
+    if identity is not None:
+        # Never cache an identity past the end of its session
+        identity_cache.put(session_id, identity, max_age=(row.expires_at - now).total_seconds())
+    return identity
+
+
+def end_session(db: Session, token: Optional[str]):
+    session_id = unsign(token)
+    if session_id is None:
+        return
+    identity_cache.invalidate(session_id)
+    db.query(UserSession).filter(UserSession.id == _session_key(session_id)).delete(synchronize_session=False)
+    db.commit()
+
+
+def set_session_cookie(response, token: str):
+    response.set_cookie(key=SESSION_COOKIE, value=token, max_age=SESSION_TTL_SECONDS, httponly=True,
+                        samesite="lax", secure=SESSION_COOKIE_SECURE)
+
+
+async def current_user(session: str = Cookie(default=None), db: Session = Depends(get_db)) -> Optional[Identity]:
+    """FastAPI dependency: the logged-in user's Identity, or None."""
+    return resolve_session(db, session)
@@ -0,0 +1,300 @@
+# batch_grading.py
+# Batched grading: several short submissions share one LLM request and one copy
+# of the grading instructions, and the reply is split back into one grade per
+# document. Documents the model skipped or answered badly are graded again on
+# their own, so a bad batch reply never loses a grade. Documents over the
+# single-request budget are never batched; they go through chunking.py.
+#
+# Two ways in:
+#   - the grading workers, when GRADING_BATCH_SIZE > 1: evaluate_grade hands its
+#     text to `batcher`, which collects submissions graded at the same moment;
+#   - regrading a whole class from the command line:
+#
+#       python batch_grading.py regrade "CS 101"
+
+import asyncio
+import os
+import re
+
+import llm
+from chunking import needs_chunking, grade_long_document
+from grading_cache import grade_cache
+from main import GRADING_PROMPT, parse_grade, request_grade, log_error
+
+# 1 disables batching in the workers; the CLI always batches
+GRADING_BATCH_SIZE = int(os.getenv("GRADING_BATCH_SIZE", "1"))
+REGRADE_BATCH_SIZE = int(os.getenv("REGRADE_BATCH_SIZE", "10"))
+# Submissions longer than this are always graded alone, and a batch never holds more in total
+GRADING_BATCH_MAX_CHARS = int(os.getenv("GRADING_BATCH_MAX_CHARS", "24000"))
+# How long a worker's submission waits for others to share its request
+GRADING_BATCH_WINDOW_SECONDS = float(os.getenv("GRADING_BATCH_WINDOW_SECONDS", "0.2"))
+
+BATCH_GRADING_PROMPT = '''
+        You are a teacher who is grading the class assignments. Below are {count} separate assignments,
+        each inside <document id="N"> tags. Grade each one on its own and give feedback to its student.
+
+        Output Format, once for every document, in order:
+        ### Document N
+        ```Grade: A (or B, C, D, F etc.)```
+        Feedback: <detailed explanation>
+
+        {documents}
+        '''
+
+_DOCUMENT_HEADER = re.compile(r"^[ \t#*]*Document\s+(\d+)[ \t:*]*$", re.IGNORECASE | re.MULTILINE)
+
+
+def build_batch_prompt(texts) -> str:
+    documents = "\n".join(f'<document id="{i}">\n{text}\n</document>' for i, text in enumerate(texts, 1))
+    return BATCH_GRADING_PROMPT.format(count=len(texts), documents=documents)
+
+
+def parse_batch_response(content: str, count: int) -> dict:
+    """Split a batch reply into {index: (grade, feedback)} for the documents it answered.
+
+    Sections that are missing, repeated, out of range or unparseable are left out.
+    """
+    results = {}
+    headers = list(_DOCUMENT_HEADER.finditer(content))
+    for header, following in zip(headers, headers[1:] + [None]):
+        index = int(header.group(1)) - 1
+        if not 0 <= index < count or index in results:
+            continue
+        section = content[header.end():following.start() if following else len(content)]
+        try:
+            results[index] = parse_grade(section)
+        except ValueError:
+            continue
+    return results
+
+
+def pack_batches(texts, max_documents: int, max_chars: int = GRADING_BATCH_MAX_CHARS):
+    """Group indexes of texts into batches of at most max_documents and max_chars."""
+    batches, current, current_chars = [], [], 0
+    for index, text in enumerate(texts):
+        if len(text) > max_chars:
+            batches.append([index])
+            continue
+        if current and (len(current) >= max_documents or current_chars + len(text) > max_chars):
+            batches.append(current)
+            current, current_chars = [], 0
+        current.append(index)
+        current_chars += len(text)
+    if current:
+        batches.append(current)
+    return batches
+
+
+async def grade_single(text: str) -> (str, str):
+    """Grade one text on its own, map-reduce over chunks if it is too long for one prompt."""
+    if needs_chunking(text):
+        return await grade_long_document(text)
+    return await request_grade(text)
+
+
+async def grade_batch(texts) -> list:
+    """Grade texts in one request. Returns [(grade, feedback)] in the same order."""
+    if len(texts) == 1:
+        return [await grade_single(texts[0])]
+    content = await llm.complete(build_batch_prompt(texts))
+    parsed = parse_batch_response(content, len(texts))
+    missing = [i for i in range(len(texts)) if i not in parsed]
+    if missing:
+        log_error(f"Batch reply left out {len(missing)} of {len(texts)} document(s); grading them singly.")
+        for index, result in zip(missing, await asyncio.gather(*(grade_single(texts[i]) for i in missing))):
+            parsed[index] = result
+    return [parsed[i] for i in range(len(texts))]
+
+
+async def evaluate_grades(texts, batch_size: int = REGRADE_BATCH_SIZE, use_cache: bool = True,
+                          with_usage: bool = False) -> list:
+    """Grade many documents with as few requests as possible.
+
+    Returns [(grade, feedback)] in input order; a document whose batch failed gets
+    ("Error", "Could not generate feedback.") like evaluate_grade. Results are
+    written to the grade cache; with use_cache=False it is not read. With
+    with_usage, each result also carries the llm.TokenUsage it was charged: an
+    equal share of its request (nothing for a cached grade).
+    """
+    model = llm.get_backend().model
+    results = [None] * len(texts)
+    usages = [llm.TokenUsage() for _ in texts]
+    pending = {}  # text -> indexes, so duplicate submissions are graded once
+    if use_cache:
+        found = await asyncio.gather(*(grade_cache.get(text, GRADING_PROMPT, model) for text in texts))
+    else:
+        found = [None] * len(texts)
+    for index, (text, cached) in enumerate(zip(texts, found)):
+        if cached:
+            results[index] = cached
+        else:
+            pending.setdefault(text, []).append(index)
+
+    unique = list(pending)
+
+    async def run(batch):
+        batch_texts = [unique[i] for i in batch]
+        try:
+            with llm.track_usage() as usage:
+                graded = await grade_batch(batch_texts)
+        except Exception as e:
+            log_error(f"Error grading batch of {len(batch)}: {str(e)}")
+            graded = [("Error", "Could not generate feedback.")] * len(batch)
+        else:
+            for text, (grade, feedback) in zip(batch_texts, graded):
+                await grade_cache.put(text, GRADING_PROMPT, model, grade, feedback)
+        members = sum(len(pending[text]) for text in batch_texts)
+        for text, result in zip(batch_texts, graded):
+            for index in pending[text]:
+                results[index] = result
+                usages[index].add(usage.prompt_tokens // members, usage.completion_tokens // members,
+                                  requests=0)
+
+    # Over-budget documents are graded alone (chunked); only the rest share requests
+    chunked = [needs_chunking(text) for text in unique]
+    long = [i for i in range(len(unique)) if chunked[i]]
+    short = [i for i in range(len(unique)) if not chunked[i]]
+    batches = [[i] for i in long] + [
+        [short[j] for j in batch] for batch in pack_batches([unique[i] for i in short], batch_size)
+    ]
+    await asyncio.gather(*(run(batch) for batch in batches))
+    if with_usage:
+        return [(grade, feedback, usage) for (grade, feedback), usage in zip(results, usages)]
+    return results
+
+
+class GradeBatcher:
+    """Collects submissions graded concurrently (by the grading workers) into shared requests.
+
+    A submission waits at most `window` seconds for company; a full batch is sent
+    at once. Batches can't be larger than the number of workers grading at once.
+    """
+
+    def __init__(self, max_documents: int = GRADING_BATCH_SIZE, max_chars: int = GRADING_BATCH_MAX_CHARS,
+                 window: float = GRADING_BATCH_WINDOW_SECONDS):
+        self.max_documents = max_documents
+        self.max_chars = max_chars
+        self.window = window
+        self._pending = []  # (text, future, caller's TokenUsage)
+        self._pending_chars = 0
+        self._timer = None
+        self._tasks = set()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_documents > 1
+
+    async def grade(self, text: str) -> (str, str):
+        if len(text) > self.max_chars:
+            return await grade_single(text)
+        loop = asyncio.get_running_loop()
+        if self._pending_chars + len(text) > self.max_chars:
+            self._flush()
+        future = loop.create_future()
+        self._pending.append((text, future, llm.current_usage()))
+        self._pending_chars += len(text)
+        if len(self._pending) >= self.max_documents:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending, self._pending_chars = self._pending, [], 0
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch):
+        try:
+            with llm.track_usage() as usage:
+                results = await grade_batch([text for text, _, _ in batch])
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future, member_usage), result in zip(batch, results):
+            if member_usage is not None:
+                # Each submission is charged an equal share of the shared request
+                member_usage.add(usage.prompt_tokens // len(batch), usage.completion_tokens // len(batch), requests=0)
+            if not future.done():
+                future.set_result(result)
+
+
+batcher = GradeBatcher()
+
+
+async def regrade_class(db, class_id: int, batch_size: int = REGRADE_BATCH_SIZE) -> dict:
+    """Grade every assignment of a class again, in batches, and save the new grades."""
+    import analytics
+    import search
+    from dashboard_cache import dashboard_cache
+    from extraction import load_assignment_text
+    from models import Assignment
+
+    assignments = db.query(Assignment).filter(Assignment.class_id == class_id).order_by(Assignment.id).all()
+    texts, graded, extracted = [], [], []
+    for assignment in assignments:
+        try:
+            text, was_extracted = await load_assignment_text(assignment)
+        except Exception as e:
+            log_error(f"Error loading text of assignment {assignment.id}: {str(e)}")
+            continue
+        if was_extracted:
+            extracted.append(assignment.id)
+        if text.strip():
+            texts.append(text)
+            graded.append(assignment)
+    if extracted:
+        # Keep the extracted texts even if grading fails below
+        search.index_assignments(db, extracted)
+        db.commit()
+
+    results = await evaluate_grades(texts, batch_size=batch_size, use_cache=False, with_usage=True)
+    failed = 0
+    for assignment, (grade, feedback, usage) in zip(graded, results):
+        if grade == "Error":
+            # Keep the previous grade rather than overwrite it with an error
+            failed += 1
+            continue
+        assignment.grade = grade
+        assignment.feedback = feedback
+        # Tokens of the latest grading, so the analytics rollups rebuilt below stay current
+        assignment.prompt_tokens = usage.prompt_tokens
+        assignment.completion_tokens = usage.completion_tokens
+    search.index_assignments(db, [assignment.id for assignment in graded])
+    db.flush()
+    analytics.rebuild(db, class_id)
+    db.commit()
+    dashboard_cache.invalidate_class(class_id)
+    return {
+        "assignments": len(assignments),
+        "regraded": len(graded) - failed,
+        "failed": failed,
+        "skipped": len(assignments) - len(graded),
+    }
+
+
+if __name__ == "__main__":
+    import sys
+
+    from models import Class, SessionLocal
+
+    if len(sys.argv) != 3 or sys.argv[1] != "regrade":
+        print('usage: python batch_grading.py regrade "<class name>"')
+        sys.exit(1)
+
+    db = SessionLocal()
+    try:
+        class_obj = db.query(Class).filter(Class.name == sys.argv[2]).first()
+        if not class_obj:
+            print(f"Class {sys.argv[2]} not found.")
+            sys.exit(1)
+        print(asyncio.run(regrade_class(db, class_obj.id)))
+    finally:
+        db.close()
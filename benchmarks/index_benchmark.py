@@ -0,0 +1,182 @@
+# benchmarks/index_benchmark.py
+# Query plans and dashboard latency before and after migration 1 (composite key on
+# student_class_association and indexes on hot lookup columns).
+#
+#   python benchmarks/index_benchmark.py [--assignments 100000] [--json results.json]
+#
+# Seeds a throwaway SQLite database, strips it back to the pre-migration schema,
+# measures, applies the migration and measures again.
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)  # the app serves templates and static files relative to the repo root
+os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/index_benchmark.db"
+os.environ["SESSION_SECRET"] = "index-benchmark-session-secret"
+os.environ["DASHBOARD_CACHE_PATH"] = ""  # in-process tier only, so clear() drops everything
+
+from sqlalchemy import insert, text  # noqa: E402
+
+from fastapi.testclient import TestClient  # noqa: E402
+from auth import SESSION_COOKIE, create_session  # noqa: E402
+from dashboard_cache import dashboard_cache  # noqa: E402
+from migrate import add_lookup_indexes, migrate  # noqa: E402
+from models import (  # noqa: E402
+    Assignment, Base, Class, Comment, Instructor, SemesterEnum, SessionLocal, Student, engine,
+    student_class_association,
+)
+from routes import app  # noqa: E402
+
+# Hot queries, as issued by the dashboards, JSON API and grading worker
+QUERIES = {
+    "classes_by_instructor": "SELECT id FROM classes WHERE instructor_id = :instructor_id",
+    "class_by_name": "SELECT id FROM classes WHERE name = :class_name",
+    "roster_by_class": (
+        "SELECT students.id FROM students JOIN student_class_association "
+        "ON student_class_association.student_id = students.id "
+        "WHERE student_class_association.class_id = :class_id"
+    ),
+    "assignments_by_class": "SELECT id FROM assignments WHERE class_id IN (:class_id)",
+    "assignments_by_student_and_class": (
+        "SELECT id FROM assignments WHERE student_id = :student_id AND class_id = :class_id"
+    ),
+    "results_by_student": "SELECT id FROM assignments WHERE student_id = :student_id ORDER BY id LIMIT 50",
+    "comments_by_assignment": "SELECT id FROM comments WHERE assignment_id IN (:assignment_id)",
+}
+
+
+def seed(n_assignments, n_instructors=50, n_classes=200, n_students=5000, classes_per_student=4):
+    rng = random.Random(530)
+    with engine.begin() as conn:
+        conn.execute(insert(Instructor), [
+            {"id": i, "name": f"Instructor {i}", "email": f"i{i}@example.com"} for i in range(1, n_instructors + 1)
+        ])
+        conn.execute(insert(Class), [
+            {"id": c, "name": f"EC{c:04d}", "year": 2025, "semester": SemesterEnum.FALL,
+             "instructor_id": rng.randint(1, n_instructors)}
+            for c in range(1, n_classes + 1)
+        ])
+        conn.execute(insert(Student), [
+            {"id": s, "name": f"Student {s}", "email": f"s{s}@example.com"} for s in range(1, n_students + 1)
+        ])
+        enrollments = [
+            (s, c) for s in range(1, n_students + 1) for c in rng.sample(range(1, n_classes + 1), classes_per_student)
+        ]
+        conn.execute(student_class_association.insert(), [{"student_id": s, "class_id": c} for s, c in enrollments])
+        conn.execute(insert(Assignment), [
+            {"id": a, "filename": f"a{a}.txt", "grade": rng.choice("ABCDF"), "feedback": "Feedback text.",
+             "student_id": s, "class_id": c}
+            for a, (s, c) in enumerate((rng.choice(enrollments) for _ in range(n_assignments)), start=1)
+        ])
+        conn.execute(insert(Comment), [
+            {"assignment_id": a, "student_comment": "Why this grade?"}
+            for a in rng.sample(range(1, n_assignments + 1), n_assignments // 10)
+        ])
+
+
+def strip_to_pre_migration_schema():
+    """Drop the indexes and association primary key that migration 1 adds."""
+    with engine.begin() as conn:
+        for table_name in ("classes", "assignments", "comments", "grading_jobs", "student_class_association"):
+            for index in Base.metadata.tables[table_name].indexes:
+                conn.execute(text(f"DROP INDEX IF EXISTS {index.name}"))
+        conn.execute(text("ALTER TABLE student_class_association RENAME TO student_class_association_pk"))
+        conn.execute(text("CREATE TABLE student_class_association (student_id INTEGER, class_id INTEGER)"))
+        conn.execute(text("INSERT INTO student_class_association SELECT student_id, class_id FROM student_class_association_pk"))
+        conn.execute(text("DROP TABLE student_class_association_pk"))
+        conn.execute(text("DELETE FROM schema_migrations"))
+        conn.execute(text("ANALYZE"))
+    # Pooled connections may still hold the old schema in their statement caches
+    engine.dispose()
+
+
+def sample_params():
+    with engine.connect() as conn:
+        instructor_id, class_id = conn.execute(text(
+            "SELECT instructor_id, id FROM classes GROUP BY instructor_id ORDER BY COUNT(*) DESC LIMIT 1"
+        )).one()
+        class_name = conn.execute(text("SELECT name FROM classes WHERE id = :id"), {"id": class_id}).scalar()
+        student_id = conn.execute(text(
+            "SELECT student_id FROM student_class_association WHERE class_id = :id LIMIT 1"
+        ), {"id": class_id}).scalar()
+        assignment_id = conn.execute(text("SELECT assignment_id FROM comments LIMIT 1")).scalar()
+    return {"instructor_id": instructor_id, "class_id": class_id, "class_name": class_name,
+            "student_id": student_id, "assignment_id": assignment_id}
+
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return {"median_ms": round(statistics.median(samples), 3), "min_ms": round(min(samples), 3)}
+
+
+def measure(params, repeat):
+    results = {"queries": {}, "dashboard": None}
+    with engine.connect() as conn:
+        for name, sql in QUERIES.items():
+            plan = [row[-1] for row in conn.execute(text("EXPLAIN QUERY PLAN " + sql), params)]
+            timing = timed(lambda: conn.execute(text(sql), params).all(), repeat)
+            results["queries"][name] = {"plan": plan, **timing}
+
+    with SessionLocal() as db:
+        token = create_session(db, "instructor", params["instructor_id"])
+    client = TestClient(app)
+    client.cookies.set(SESSION_COOKIE, token)
+
+    def load_dashboard():
+        # Render from the database every time: cached fragments would hide the indexes being compared
+        dashboard_cache.clear()
+        # No redirects: a login page served instead of the dashboard must fail, not be timed
+        response = client.get("/instructor_dashboard", follow_redirects=False)
+        assert response.status_code == 200, f"dashboard returned {response.status_code}"
+
+    results["dashboard"] = timed(load_dashboard, max(repeat // 10, 3))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--assignments", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    migrate()
+    print(f"Seeding {args.assignments} assignments...")
+    seed(args.assignments)
+    params = sample_params()
+
+    strip_to_pre_migration_schema()
+    before = measure(params, args.repeat)
+
+    with engine.begin() as conn:
+        add_lookup_indexes(conn)
+        conn.execute(text("ANALYZE"))
+    engine.dispose()
+    after = measure(params, args.repeat)
+
+    for name in QUERIES:
+        b, a = before["queries"][name], after["queries"][name]
+        print(f"\n{name}: {b['median_ms']} ms -> {a['median_ms']} ms")
+        print(f"  before: {'; '.join(b['plan'])}")
+        print(f"  after:  {'; '.join(a['plan'])}")
+    print(f"\ninstructor_dashboard: {before['dashboard']['median_ms']} ms -> {after['dashboard']['median_ms']} ms")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"assignments": args.assignments, "params": params, "before": before, "after": after}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,425 @@
+# benchmarks/load_test.py
+# Load test of the whole app against a fake LLM.
+#
+#   python benchmarks/load_test.py [--scenarios upload,dashboard,csv_import,download]
+#       [--requests 200] [--concurrency 20] [--llm-latency 0.5] [--json run.json] [--compare baseline.json]
+#
+# Seeds a synthetic dataset (students, classes, graded assignments and their files)
+# in a throwaway database, starts the app with its grading workers, and drives
+# concurrent requests through the ASGI app in process. Uploads are followed until
+# every grading job has finished. Each scenario reports p50/p95/p99 latency,
+# requests per second, errors and peak RSS; the whole run is written as JSON so
+# two runs can be compared with --compare.
+
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import math
+import os
+import platform
+import random
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)  # the app serves templates and static files relative to the repo root
+WORK_DIR = tempfile.mkdtemp()
+os.environ["DATABASE_URL"] = f"sqlite:///{WORK_DIR}/load_test.db"
+os.environ["UPLOAD_DIR"] = f"{WORK_DIR}/uploads"
+os.environ["DOCUMENTS_DIR"] = f"{WORK_DIR}/documents"
+os.environ["CSV_IMPORT_DIR"] = f"{WORK_DIR}/imports"
+os.environ["LLM_BACKEND"] = "fake"
+os.environ["SESSION_SECRET"] = "load-test-session-secret"
+
+import httpx  # noqa: E402
+from sqlalchemy import insert  # noqa: E402
+
+import jobs  # noqa: E402
+from auth import SESSION_COOKIE, create_session  # noqa: E402
+import llm  # noqa: E402
+import storage  # noqa: E402
+from migrate import migrate  # noqa: E402
+from models import (  # noqa: E402
+    Admin, Assignment, Blob, Class, GradingJob, Instructor, JobStatusEnum, SemesterEnum, SessionLocal, Student,
+    engine, student_class_association,
+)
+from routes import app  # noqa: E402
+
+SCENARIOS = ("upload", "dashboard", "csv_import", "download")
+WORDS = ("analysis data model system result method theory evidence argument design network signal "
+         "process energy market policy history structure function variable experiment").split()
+
+
+def essay(rng, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+def seed(rng, n_instructors, n_classes, n_students, n_assignments, n_files, classes_per_student=4):
+    """Bulk-insert a synthetic school. Returns what the scenarios need to build requests."""
+    file_hashes = []
+    with SessionLocal() as db:
+        for _ in range(n_files):
+            path, size, content_hash = storage.spool_bytes(essay(rng, 2000).encode())
+            storage.store_blob_file(path, content_hash)
+            storage.discard(path)
+            if content_hash not in file_hashes:
+                db.add(Blob(sha256=content_hash, size=size, created_at=datetime.datetime.utcnow(),
+                            last_used_at=datetime.datetime.utcnow()))
+                file_hashes.append(content_hash)
+        db.add(Admin(name="Load Admin", email="admin@example.com"))
+        db.commit()
+        admin_id = db.query(Admin.id).filter(Admin.email == "admin@example.com").scalar()
+
+    enrollments = [
+        (s, c) for s in range(1, n_students + 1)
+        for c in rng.sample(range(1, n_classes + 1), min(classes_per_student, n_classes))
+    ]
+    owners = [rng.choice(enrollments) for _ in range(n_assignments)]
+    with engine.begin() as conn:
+        conn.execute(insert(Instructor), [
+            {"id": i, "name": f"Instructor {i}", "email": f"i{i}@example.com"} for i in range(1, n_instructors + 1)
+        ])
+        conn.execute(insert(Class), [
+            {"id": c, "name": f"LOAD{c:04d}", "year": 2025, "semester": SemesterEnum.FALL,
+             "instructor_id": rng.randint(1, n_instructors)}
+            for c in range(1, n_classes + 1)
+        ])
+        conn.execute(insert(Student), [
+            {"id": s, "name": f"Student {s}", "email": f"s{s}@example.com"} for s in range(1, n_students + 1)
+        ])
+        conn.execute(student_class_association.insert(), [{"student_id": s, "class_id": c} for s, c in enrollments])
+        conn.execute(insert(Assignment), [
+            {"id": a, "filename": f"a{a}.txt", "content_hash": rng.choice(file_hashes), "grade": rng.choice("ABCDF"),
+             "feedback": "Feedback text.", "student_id": s, "class_id": c}
+            for a, (s, c) in enumerate(owners, start=1)
+        ])
+    return {
+        "admin_id": admin_id,
+        "instructor_ids": list(range(1, n_instructors + 1)),
+        "enrollments": enrollments,
+        "assignments": [(a, s) for a, (s, _) in enumerate(owners, start=1)],  # (id, owning student)
+    }
+
+
+def max_rss() -> int:
+    """Peak RSS of this process so far, in bytes (ru_maxrss is in KB on Linux, bytes on macOS)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+_sessions = {}
+
+
+def cookies(user_id, role) -> dict:
+    """Session cookie header for the user, logging them in on first use."""
+    if (role, user_id) not in _sessions:
+        with SessionLocal() as db:
+            _sessions[(role, user_id)] = create_session(db, role, user_id)
+    return {"Cookie": f"{SESSION_COOKIE}={_sessions[(role, user_id)]}"}
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    return sorted_values[max(math.ceil(p / 100 * len(sorted_values)) - 1, 0)]
+
+
+def summarize(latencies, elapsed, errors) -> dict:
+    ms = sorted(latency * 1000 for latency in latencies)
+    return {
+        "requests": len(ms),
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(len(ms) / elapsed, 2) if elapsed else None,
+        "latency_ms": {
+            "p50": round(percentile(ms, 50), 2) if ms else None,
+            "p95": round(percentile(ms, 95), 2) if ms else None,
+            "p99": round(percentile(ms, 99), 2) if ms else None,
+            "mean": round(sum(ms) / len(ms), 2) if ms else None,
+            "max": round(ms[-1], 2) if ms else None,
+        },
+    }
+
+
+class RssSampler:
+    """Tracks the peak resident set size of this process while a scenario runs."""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.peak = 0
+        self._task = None
+
+    @staticmethod
+    def current() -> int:
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError):
+            # No procfs (macOS): fall back to the lifetime peak
+            return max_rss()
+
+    async def _run(self):
+        while True:
+            self.peak = max(self.peak, self.current())
+            await asyncio.sleep(self.interval)
+
+    def __enter__(self):
+        self.peak = self.current()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        return self
+
+    def __exit__(self, *exc):
+        self._task.cancel()
+        self.peak = max(self.peak, self.current())
+
+    @property
+    def peak_mb(self) -> float:
+        return round(self.peak / (1024 * 1024), 1)
+
+
+async def drive(make_request, total: int, concurrency: int):
+    """Send `total` requests from `concurrency` concurrent clients. Returns (summary, responses)."""
+    latencies, responses, errors = [], [], 0
+    counter = itertools.count()
+
+    async def client():
+        nonlocal errors
+        while (i := next(counter)) < total:
+            start = time.perf_counter()
+            try:
+                response = await make_request(i)
+                await response.aread()
+            except Exception:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+            failed = response.status_code >= 400 or (
+                response.headers.get("content-type", "").startswith("application/json")
+                and isinstance(response.json(), dict) and "error" in response.json()
+            )
+            errors += failed
+            responses.append(response)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return summarize(latencies, time.perf_counter() - start, errors), responses
+
+
+async def wait_for_grading(job_ids, timeout: float):
+    """Poll until every job is done or failed. Returns grading throughput and job latency."""
+    start = time.perf_counter()
+    pending = set(job_ids)
+    while pending and time.perf_counter() - start < timeout:
+        await asyncio.sleep(0.1)
+        with SessionLocal() as db:
+            finished = db.query(GradingJob.id).filter(
+                GradingJob.id.in_(pending), GradingJob.status.in_([JobStatusEnum.DONE, JobStatusEnum.FAILED])
+            ).all()
+        pending -= {job_id for (job_id,) in finished}
+    elapsed = time.perf_counter() - start
+
+    with SessionLocal() as db:
+        rows = db.query(GradingJob.status, GradingJob.created_at, GradingJob.updated_at).filter(
+            GradingJob.id.in_(job_ids)
+        ).all()
+    done = [row for row in rows if row.status == JobStatusEnum.DONE]
+    job_seconds = sorted((row.updated_at - row.created_at).total_seconds() * 1000 for row in done if row.updated_at)
+    return {
+        "jobs": len(job_ids),
+        "done": len(done),
+        "failed": sum(row.status == JobStatusEnum.FAILED for row in rows),
+        "unfinished": len(pending),
+        "drain_seconds": round(elapsed, 3),
+        "jobs_per_second": round(len(done) / elapsed, 2) if elapsed else None,
+        "job_latency_ms": {p: round(percentile(job_seconds, int(p[1:])), 2) if job_seconds else None
+                           for p in ("p50", "p95", "p99")},
+    }
+
+
+async def scenario_upload(client, data, args, rng):
+    uploads = [(rng.choice(data["enrollments"]), essay(rng, args.upload_words)) for _ in range(args.requests)]
+
+    async def request(i):
+        (student_id, class_id), text = uploads[i]
+        return await client.post(
+            "/upload",
+            files={"file": (f"load-{i}.txt", f"{i} {text}".encode(), "text/plain")},
+            data={"class_name": f"LOAD{class_id:04d}"},
+            headers=cookies(student_id, "student"),
+        )
+
+    summary, responses = await drive(request, args.requests, args.concurrency)
+    job_ids = [r.json()["job_id"] for r in responses if r.status_code == 200 and "job_id" in r.json()]
+    summary["grading"] = await wait_for_grading(job_ids, args.timeout)
+    return summary
+
+
+async def scenario_dashboard(client, data, args, rng):
+    instructors = [rng.choice(data["instructor_ids"]) for _ in range(args.requests)]
+    return (await drive(
+        lambda i: client.get("/instructor_dashboard", headers=cookies(instructors[i], "instructor")),
+        args.requests, args.concurrency,
+    ))[0]
+
+
+async def scenario_csv_import(client, data, args, rng):
+    files = []
+    for n in range(args.csv_imports):
+        lines = ["type,name,email,year,semester,instructor_email,student_emails"]
+        lines.append(f"instructor,CSV Instructor {n},csv-i{n}@example.com,,,,")
+        lines += [f"student,CSV Student {n}-{i},csv-s{n}-{i}@example.com,,,," for i in range(args.csv_rows)]
+        for c in range(args.csv_rows // 100):
+            emails = ",".join(f"csv-s{n}-{i}@example.com" for i in rng.sample(range(args.csv_rows), 30))
+            lines.append(f'class,CSV{n}-{c},,2025,SPRING,csv-i{n}@example.com,"{emails}"')
+        files.append(("\n".join(lines) + "\n").encode())
+
+    summary, responses = await drive(
+        lambda i: client.post("/upload_csv", files={"file": (f"roster{i}.csv", files[i], "text/csv")},
+                              headers=cookies(data["admin_id"], "admin")),
+        len(files), min(args.concurrency, len(files)),
+    )
+    job_ids = [int(m.group(1)) for r in responses if (m := re.search(r"/csv_imports/(\d+)", r.text))]
+    start = time.perf_counter()
+    results = {}
+    while len(results) < len(job_ids) and time.perf_counter() - start < args.timeout:
+        for job_id in job_ids:
+            if job_id not in results:
+                progress = (await client.get(f"/csv_imports/{job_id}", headers=cookies(data["admin_id"], "admin"))).json()
+                if progress["status"] in ("done", "failed"):
+                    results[job_id] = progress
+        await asyncio.sleep(0.1)
+    elapsed = time.perf_counter() - start
+    rows = sum(progress["rows_processed"] for progress in results.values())
+    summary["import"] = {
+        "imports": len(job_ids),
+        "done": sum(progress["status"] == "done" for progress in results.values()),
+        "rows": rows,
+        "drain_seconds": round(elapsed, 3),
+        "rows_per_second": round(rows / elapsed, 1) if elapsed else None,
+    }
+    return summary
+
+
+async def scenario_download(client, data, args, rng):
+    picks = [rng.choice(data["assignments"]) for _ in range(args.requests)]
+
+    def request(i):
+        assignment_id, student_id = picks[i]
+        headers = cookies(student_id, "student")
+        # Every fourth download asks for a byte range, like a PDF viewer or a resumed download
+        if i % 4 == 3:
+            headers["Range"] = "bytes=0-4095"
+        return client.get(f"/download/{assignment_id}", headers=headers)
+
+    summary, responses = await drive(request, args.requests, args.concurrency)
+    summary["bytes"] = sum(len(r.content) for r in responses)
+    return summary
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, cwd=ROOT).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(current, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"\nCompared with {baseline_path} ({baseline['run'].get('git_commit')}):", file=sys.stderr)
+    for name, result in current["scenarios"].items():
+        before = baseline["scenarios"].get(name)
+        if not before:
+            continue
+        for label, now, then in (
+            ("p95 ms", result["latency_ms"]["p95"], before["latency_ms"]["p95"]),
+            ("req/s", result["requests_per_second"], before["requests_per_second"]),
+            ("peak RSS MB", result["peak_rss_mb"], before["peak_rss_mb"]),
+        ):
+            change = f"{(now - then) / then * 100:+.1f}%" if now is not None and then else "n/a"
+            print(f"  {name:<12} {label:<12} {then} -> {now} ({change})", file=sys.stderr)
+
+
+async def run(args) -> dict:
+    rng = random.Random(args.seed)
+    migrate()
+    seed_start = time.perf_counter()
+    data = seed(rng, args.instructors, args.classes, args.students, args.assignments, args.files)
+    dataset = {
+        "instructors": args.instructors, "classes": args.classes, "students": args.students,
+        "assignments": args.assignments, "files": args.files,
+        "seed_seconds": round(time.perf_counter() - seed_start, 2),
+    }
+
+    llm.set_backend(llm.FakeBackend(latency=args.llm_latency))
+    jobs.worker_pool.concurrency = args.workers
+    scenarios = {}
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://loadtest", timeout=args.timeout) as client:
+            for name in args.scenarios:
+                print(f"Running {name}...", file=sys.stderr)
+                with RssSampler() as rss:
+                    result = await globals()[f"scenario_{name}"](client, data, args, rng)
+                result["peak_rss_mb"] = rss.peak_mb
+                scenarios[name] = result
+
+    return {
+        "run": {
+            "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "config": {key: value for key, value in vars(args).items() if key not in ("json", "compare")},
+        },
+        "dataset": dataset,
+        "scenarios": scenarios,
+        "llm_calls": llm.get_backend().calls,
+        "peak_rss_mb": round(max_rss() / (1024 * 1024), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the app against a fake LLM.")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"comma-separated, from: {', '.join(SCENARIOS)}")
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=20, help="concurrent clients")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="seconds the fake LLM takes per request")
+    parser.add_argument("--workers", type=int, default=jobs.GRADING_WORKERS, help="grading workers")
+    parser.add_argument("--upload-words", type=int, default=500)
+    parser.add_argument("--csv-imports", type=int, default=4)
+    parser.add_argument("--csv-rows", type=int, default=2000)
+    parser.add_argument("--instructors", type=int, default=50)
+    parser.add_argument("--classes", type=int, default=200)
+    parser.add_argument("--students", type=int, default=5000)
+    parser.add_argument("--assignments", type=int, default=50_000)
+    parser.add_argument("--files", type=int, default=200, help="distinct submitted files")
+    parser.add_argument("--seed", type=int, default=530, help="random seed, for reproducible runs")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds to wait for grading or imports")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--compare", help="print changes against an earlier --json result")
+    args = parser.parse_args()
+    args.scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(sorted(unknown))}")
+
+    results = asyncio.run(run(args))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
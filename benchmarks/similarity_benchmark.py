@@ -0,0 +1,173 @@
+# benchmarks/similarity_benchmark.py
+# Near-duplicate detection (similarity.py) on a synthetic corpus.
+#
+#   python benchmarks/similarity_benchmark.py [--documents 50000] [--classes 50] [--json results.json]
+#
+# Seeds a throwaway SQLite database with random essays, a share of which are
+# lightly edited copies of an earlier essay in the same class by another student.
+# Every document is then indexed in submission order, as uploads would be. Reports
+# signature throughput, the latency of each LSH lookup as the index grows (it
+# should stay flat), the cost of comparing with every earlier submission instead,
+# and how many of the planted copies were found.
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/similarity_benchmark.db"
+
+from sqlalchemy import insert  # noqa: E402
+
+import similarity  # noqa: E402
+from migrate import migrate  # noqa: E402
+from models import (  # noqa: E402
+    Assignment, Class, DocumentSignature, Instructor, SemesterEnum, SessionLocal, SimilarityMatch, Student, engine,
+)
+
+
+def edit(rng, words, vocabulary, rate):
+    copy = list(words)
+    for i in rng.sample(range(len(copy)), int(len(copy) * rate)):
+        copy[i] = rng.choice(vocabulary)
+    return copy
+
+
+def seed(n_documents, n_classes, words_per_document, copy_share, edit_rate, rng):
+    """Insert the corpus; returns {copy id: original id} for the planted near-duplicates."""
+    vocabulary = [f"w{i}" for i in range(20000)]
+    per_class = n_documents // n_classes
+    students_per_class = per_class
+    planted = {}
+    rows = []
+    next_id = 1
+    for c in range(1, n_classes + 1):
+        class_rows = []
+        for s in range(per_class):
+            student_id = (c - 1) * students_per_class + s + 1
+            if class_rows and rng.random() < copy_share:
+                original = rng.choice(class_rows)
+                words = edit(rng, original["extracted_text"].split(), vocabulary, edit_rate)
+                planted[next_id] = original["id"]
+            else:
+                words = [rng.choice(vocabulary) for _ in range(words_per_document)]
+            row = {"id": next_id, "filename": f"a{next_id}.txt", "grade": "A", "feedback": "ok",
+                   "extracted_text": " ".join(words), "student_id": student_id, "class_id": c}
+            class_rows.append(row)
+            next_id += 1
+        rows.extend(class_rows)
+    # Interleave classes so the index grows the way a term of uploads would
+    rows.sort(key=lambda row: (row["id"] - 1) % per_class)
+
+    with engine.begin() as conn:
+        conn.execute(insert(Instructor), [{"id": 1, "name": "Instructor", "email": "i@example.com"}])
+        conn.execute(insert(Class), [
+            {"id": c, "name": f"EC{c:04d}", "year": 2025, "semester": SemesterEnum.FALL, "instructor_id": 1}
+            for c in range(1, n_classes + 1)
+        ])
+        conn.execute(insert(Student), [
+            {"id": s, "name": f"Student {s}", "email": f"s{s}@example.com"}
+            for s in range(1, n_classes * students_per_class + 1)
+        ])
+        conn.execute(insert(Assignment), rows)
+    return planted, [row["id"] for row in rows]
+
+
+def percentiles(samples_ms):
+    ordered = sorted(samples_ms)
+    pick = lambda q: round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 3)  # noqa: E731
+    return {"p50_ms": pick(0.5), "p95_ms": pick(0.95), "p99_ms": pick(0.99), "count": len(ordered)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--documents", type=int, default=50_000)
+    parser.add_argument("--classes", type=int, default=50)
+    parser.add_argument("--words", type=int, default=400, help="words per document")
+    parser.add_argument("--copy-share", type=float, default=0.02, help="share of documents that are edited copies")
+    parser.add_argument("--edit-rate", type=float, default=0.05, help="share of words changed in a copy")
+    parser.add_argument("--windows", type=int, default=5, help="report lookup latency in this many windows")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    rng = random.Random(530)
+    migrate()
+    print(f"Seeding {args.documents} documents in {args.classes} classes...")
+    planted, order = seed(args.documents, args.classes, args.words, args.copy_share, args.edit_rate, rng)
+
+    db = SessionLocal()
+    texts = dict(db.query(Assignment.id, Assignment.extracted_text))
+    owners = {a.id: (a.class_id, a.student_id) for a in db.query(Assignment.id, Assignment.class_id, Assignment.student_id)}
+
+    start = time.perf_counter()
+    signatures = {assignment_id: similarity.signature(texts[assignment_id]) for assignment_id in order}
+    signature_seconds = time.perf_counter() - start
+
+    # Index in submission order, timing each lookup + insert
+    window_size = max(1, len(order) // args.windows)
+    windows, current = [], []
+    start = time.perf_counter()
+    for n, assignment_id in enumerate(order, start=1):
+        class_id, student_id = owners[assignment_id]
+        t = time.perf_counter()
+        similarity.index_document(db, assignment_id, class_id, student_id, signatures[assignment_id])
+        db.flush()
+        current.append((time.perf_counter() - t) * 1000)
+        if n % 500 == 0:
+            db.commit()
+        if n % window_size == 0:
+            windows.append({"indexed": n, **percentiles(current)})
+            current = []
+    db.commit()
+    index_seconds = time.perf_counter() - start
+
+    # The quadratic alternative: compare the last submission with every earlier one in its class
+    last = order[-1]
+    class_id = owners[last][0]
+    earlier = [(a, data) for a, data in db.query(DocumentSignature.assignment_id, DocumentSignature.signature)
+               .filter(DocumentSignature.class_id == class_id, DocumentSignature.assignment_id != last)]
+    t = time.perf_counter()
+    for _, data in earlier:
+        similarity.estimate_similarity(signatures[last], similarity.unpack_signature(data))
+    brute_force_ms = (time.perf_counter() - t) * 1000
+
+    found = {(m.assignment_id, m.matched_assignment_id) for m in db.query(SimilarityMatch)}
+    detected = sum(1 for pair in planted.items() if pair in found)
+    # Two copies of the same original are a genuine match too; only pairs with different roots are false
+    roots = {}
+    for copy_id, original_id in sorted(planted.items()):
+        roots[copy_id] = roots.get(original_id, original_id)
+    unexpected = sum(1 for a, b in found if roots.get(a, a) != roots.get(b, b))
+    db.close()
+
+    results = {
+        "documents": args.documents,
+        "classes": args.classes,
+        "words_per_document": args.words,
+        "settings": {"shingle_size": similarity.SHINGLE_SIZE, "minhash_size": similarity.MINHASH_SIZE,
+                     "lsh_bands": similarity.LSH_BANDS, "threshold": similarity.SIMILARITY_THRESHOLD},
+        "signatures_per_second": round(len(order) / signature_seconds, 1),
+        "indexed_per_second": round(len(order) / index_seconds, 1),
+        "lookup_latency_by_index_size": windows,
+        "brute_force_one_class_ms": round(brute_force_ms, 3),
+        "brute_force_compared": len(earlier),
+        "planted_copies": len(planted),
+        "detected_copies": detected,
+        "recall": round(detected / len(planted), 4) if planted else None,
+        "unexpected_matches": unexpected,
+        "median_lookup_ms": round(statistics.median(w["p50_ms"] for w in windows), 3),
+    }
+    print(json.dumps(results, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+# chunking.py
+# Map-reduce grading for documents too long for one prompt. The text is split
+# along its pages and section headings into chunks of at most GRADING_CHUNK_TOKENS,
+# every chunk is summarized for the grader in parallel (map), and the final grade
+# and feedback are given from the summaries (reduce).
+#
+# Budgets, all in tokens:
+#   GRADING_MAX_INPUT_TOKENS     documents up to this size are graded in one request
+#   GRADING_CHUNK_TOKENS         size of each chunk sent to the map step
+#   GRADING_SUMMARY_TOKENS       most tokens a chunk summary may use
+#   GRADING_DOCUMENT_TOKEN_BUDGET  most document tokens read at all; the rest is skipped
+
+import asyncio
+import os
+import re
+
+import llm
+from main import GRADING_PROMPT, parse_grade, log_error
+
+GRADING_MAX_INPUT_TOKENS = int(os.getenv("GRADING_MAX_INPUT_TOKENS", "6000"))
+GRADING_CHUNK_TOKENS = int(os.getenv("GRADING_CHUNK_TOKENS", "3000"))
+GRADING_SUMMARY_TOKENS = int(os.getenv("GRADING_SUMMARY_TOKENS", "400"))
+GRADING_DOCUMENT_TOKEN_BUDGET = int(os.getenv("GRADING_DOCUMENT_TOKEN_BUDGET", "60000"))
+
+CHUNK_SUMMARY_PROMPT = '''
+        You are helping a teacher grade a long assignment that is read in parts. This is part {part} of {parts}.
+        Summarize this part for the teacher in at most {words} words: its main points and arguments, the evidence
+        used, the quality of the writing, and any errors or weaknesses. Do not grade it.
+
+        Assignment Part:
+        {chunk}
+        '''
+
+REDUCE_PROMPT = '''
+        You are a teacher who is grading the class assignments. The assignment was too long to read at once, so
+        below are summaries of its {parts} parts, in order.{truncated} Grade the whole assignment from them and
+        give feedback to the student.
+
+        Output Format:
+        ```Grade: A (or B, C, D, F etc.)```
+        Feedback: <detailed explanation>
+
+        Part Summaries:
+        {summaries}
+        '''
+
+# A page break, or a line that looks like a heading ("# Intro", "2. Method", "CHAPTER 3", "Conclusion")
+_SECTION_BREAK = re.compile(
+    r"\f|\n(?=[ \t]*(?:#{1,6}[ \t]|\d+(?:\.\d+)*\.?[ \t]+[A-Z]|(?i:chapter|section|part)\b|[A-Z][A-Z \t]{3,}\n))"
+)
+
+
+def needs_chunking(text: str) -> bool:
+    return llm.count_tokens(text) > GRADING_MAX_INPUT_TOKENS
+
+
+def _split_oversized(text: str, max_tokens: int):
+    """Split a block with no usable headings: paragraphs first, then sentences, then words."""
+    for pattern in (r"\n\s*\n", r"(?<=[.!?])\s+", r"\s+"):
+        pieces = [p for p in re.split(pattern, text) if p.strip()]
+        if len(pieces) > 1:
+            return _pack(pieces, max_tokens)
+    # One enormous "word": cut it by characters
+    step = max_tokens * 4
+    return [text[i:i + step] for i in range(0, len(text), step)]
+
+
+def _pack(pieces, max_tokens: int):
+    chunks, current, current_tokens = [], [], 0
+    for piece in pieces:
+        tokens = llm.count_tokens(piece)
+        if tokens > max_tokens:
+            if current:
+                chunks.append("\n".join(current))
+                current, current_tokens = [], 0
+            chunks.extend(_split_oversized(piece, max_tokens))
+            continue
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append("\n".join(current))
+            current, current_tokens = [], 0
+        current.append(piece)
+        current_tokens += tokens
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+def split_into_chunks(text: str, max_tokens: int = GRADING_CHUNK_TOKENS):
+    """Split text into chunks of at most max_tokens, keeping pages and sections together where they fit."""
+    sections = [s.strip() for s in _SECTION_BREAK.split(text) if s.strip()]
+    return _pack(sections, max_tokens)
+
+
+def apply_budget(chunks, budget: int = GRADING_DOCUMENT_TOKEN_BUDGET):
+    """Keep the leading chunks that fit in the budget. Returns (chunks, whether any were dropped)."""
+    kept, used = [], 0
+    for chunk in chunks:
+        tokens = llm.count_tokens(chunk)
+        if kept and used + tokens > budget:
+            return kept, True
+        kept.append(chunk)
+        used += tokens
+    return kept, False
+
+
+async def summarize_chunk(chunk: str, part: int, parts: int) -> str:
+    prompt = CHUNK_SUMMARY_PROMPT.format(
+        part=part, parts=parts, words=int(GRADING_SUMMARY_TOKENS * 0.75), chunk=chunk
+    )
+    return (await llm.complete(prompt, max_tokens=GRADING_SUMMARY_TOKENS)).strip()
+
+
+async def grade_long_document(text: str) -> (str, str):
+    """Grade a long document by summarizing its chunks in parallel and grading the summaries."""
+    chunks, truncated = apply_budget(split_into_chunks(text, GRADING_CHUNK_TOKENS), GRADING_DOCUMENT_TOKEN_BUDGET)
+    if truncated:
+        log_error(f"Document over the {GRADING_DOCUMENT_TOKEN_BUDGET} token budget; grading its first {len(chunks)} part(s).")
+    if len(chunks) == 1:
+        content = await llm.complete(GRADING_PROMPT.format(file_content=chunks[0]))
+        return parse_grade(content)
+
+    summaries = await asyncio.gather(*(
+        summarize_chunk(chunk, part, len(chunks)) for part, chunk in enumerate(chunks, 1)
+    ))
+    content = await llm.complete(REDUCE_PROMPT.format(
+        parts=len(chunks),
+        truncated=" The end of the assignment was over the reading limit and is not included." if truncated else "",
+        summaries="\n\n".join(f"Part {part}:\n{summary}" for part, summary in enumerate(summaries, 1)),
+    ))
+    return parse_grade(content)
@@ -0,0 +1,228 @@
+# csv_import.py
+# Set-based CSV import for students, instructors and classes.
+#
+# The CSV is read as a stream and handled in batches. Existing emails and class
+# names are preloaded once, new rows go in with one bulk INSERT per table per
+# batch, and enrollments are inserted as association rows in bulk, so the number
+# of queries depends on the number of batches rather than the number of rows.
+
+import codecs
+import csv
+import time
+
+from sqlalchemy import insert, select
+
+from dashboard_cache import dashboard_cache
+from models import Class, Instructor, SemesterEnum, Student, student_class_association
+
+CSV_BATCH_SIZE = 1000
+MAX_REPORTED_ERRORS = 1000
+COUNTERS = (
+    "students_inserted", "instructors_inserted", "classes_inserted", "enrollments_inserted",
+    "rows_processed", "rows_skipped", "error_count",
+)
+
+
+def iter_csv_rows(source, start_row: int = 0):
+    """Yield (line_number, row) from bytes or a binary file object without decoding it all at once."""
+    if isinstance(source, (bytes, bytearray)):
+        lines = source.decode("utf-8-sig").splitlines(keepends=True)
+    else:
+        lines = codecs.iterdecode(source, "utf-8-sig")
+    reader = csv.DictReader(lines)
+    for index, row in enumerate(reader):
+        if index < start_row:
+            continue
+        yield index + 2, row  # line 1 is the header
+
+
+def iter_batches(rows, batch_size: int):
+    batch = []
+    for item in rows:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class CsvImporter:
+    def __init__(self, db):
+        self.db = db
+        self.students_inserted = 0
+        self.instructors_inserted = 0
+        self.classes_inserted = 0
+        self.enrollments_inserted = 0
+        self.rows_processed = 0
+        self.rows_skipped = 0
+        self.errors = []
+        self.error_count = 0
+        self.started = time.perf_counter()
+
+        # One query per table up front instead of one per CSV row
+        self.student_ids = dict(db.execute(select(Student.email, Student.id)).all())
+        self.instructor_ids = dict(db.execute(select(Instructor.email, Instructor.id)).all())
+        self.class_ids = dict(db.execute(select(Class.name, Class.id)).all())
+        self.enrolled = {}  # class_id -> set of student ids, loaded on first use
+        # What the current batch changed, for dashboard cache invalidation after its commit
+        self.changed_class_ids = set()
+        self.classes_added = False
+
+    def error(self, line_number: int, message: str, skipped: bool = True):
+        self.error_count += 1
+        if skipped:
+            self.rows_skipped += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"row": line_number, "error": message})
+
+    def _insert_people(self, model, known: dict, rows: list) -> int:
+        new_rows = []
+        for line_number, name, email in rows:
+            if email in known:
+                self.rows_skipped += 1
+                continue
+            known[email] = None  # reserve so duplicates later in the file are skipped
+            new_rows.append({"name": name, "email": email})
+        if new_rows:
+            result = self.db.execute(insert(model).returning(model.id, model.email), new_rows)
+            known.update({email: id_ for id_, email in result.all()})
+        return len(new_rows)
+
+    def _enrolled_in(self, class_ids):
+        missing = [class_id for class_id in class_ids if class_id not in self.enrolled]
+        for class_id in missing:
+            self.enrolled[class_id] = set()
+        if missing:
+            pairs = self.db.execute(
+                select(student_class_association.c.class_id, student_class_association.c.student_id)
+                .where(student_class_association.c.class_id.in_(missing))
+            ).all()
+            for class_id, student_id in pairs:
+                self.enrolled[class_id].add(student_id)
+
+    def process_batch(self, batch):
+        students, instructors, classes = [], [], []
+
+        for line_number, row in batch:
+            self.rows_processed += 1
+            row_type = (row.get('type') or '').strip().lower()
+            name = (row.get('name') or '').strip()
+            email = (row.get('email') or '').strip()
+
+            if row_type in ('student', 'instructor'):
+                if not name or not email:
+                    self.error(line_number, f"{row_type} row needs both name and email")
+                    continue
+                (students if row_type == 'student' else instructors).append((line_number, name, email))
+            elif row_type == 'class':
+                classes.append((line_number, row))
+            else:
+                self.error(line_number, f"unknown row type '{row_type}'")
+
+        self.students_inserted += self._insert_people(Student, self.student_ids, students)
+        self.instructors_inserted += self._insert_people(Instructor, self.instructor_ids, instructors)
+
+        new_classes = []
+        enrollments = []  # (line_number, class name, [emails])
+        for line_number, row in classes:
+            name = (row.get('name') or '').strip()
+            year = (row.get('year') or '').strip()
+            semester = (row.get('semester') or '').strip().upper()
+            instructor_email = (row.get('instructor_email') or '').strip()
+            student_emails = (row.get('student_emails') or '').strip()
+
+            if not name or not year or not semester:
+                self.error(line_number, "class row needs name, year and semester")
+                continue
+            if name not in self.class_ids:
+                instructor_id = self.instructor_ids.get(instructor_email)
+                if instructor_id is None:
+                    self.error(line_number, f"instructor {instructor_email} not found")
+                    continue
+                if semester not in SemesterEnum.__members__:
+                    self.error(line_number, f"unknown semester {semester}")
+                    continue
+                try:
+                    year_value = int(year)
+                except ValueError:
+                    self.error(line_number, f"invalid year {year}")
+                    continue
+                self.class_ids[name] = None
+                new_classes.append({
+                    "name": name,
+                    "year": year_value,
+                    "semester": SemesterEnum[semester],
+                    "instructor_id": instructor_id,
+                })
+            if student_emails:
+                enrollments.append((line_number, name, [e.strip() for e in student_emails.split(",") if e.strip()]))
+
+        if new_classes:
+            result = self.db.execute(insert(Class).returning(Class.id, Class.name), new_classes)
+            self.class_ids.update({class_name: id_ for id_, class_name in result.all()})
+            self.classes_inserted += len(new_classes)
+            self.classes_added = True
+
+        self._enrolled_in({self.class_ids[name] for _, name, _ in enrollments})
+        new_pairs = []
+        for line_number, name, emails in enrollments:
+            class_id = self.class_ids[name]
+            for email in emails:
+                student_id = self.student_ids.get(email)
+                if student_id is None:
+                    self.error(line_number, f"student {email} not found", skipped=False)
+                    continue
+                if student_id not in self.enrolled[class_id]:
+                    self.enrolled[class_id].add(student_id)
+                    new_pairs.append({"student_id": student_id, "class_id": class_id})
+        if new_pairs:
+            self.db.execute(student_class_association.insert(), new_pairs)
+            self.enrollments_inserted += len(new_pairs)
+            self.changed_class_ids.update(pair["class_id"] for pair in new_pairs)
+
+    def restore(self, counters: dict, errors: list):
+        """Continue the counts of an earlier, interrupted run of the same file."""
+        for name in COUNTERS:
+            setattr(self, name, counters.get(name) or 0)
+        self.errors = list(errors)
+
+    def run(self, source, batch_size: int = CSV_BATCH_SIZE, start_row: int = 0, on_batch=None) -> dict:
+        """Import `source`, committing once per batch.
+
+        `start_row` skips data rows already imported by an earlier run, and
+        `on_batch(importer)` is called before each commit so callers can save
+        progress in the same transaction as the batch.
+        """
+        try:
+            for batch in iter_batches(iter_csv_rows(source, start_row), batch_size):
+                self.process_batch(batch)
+                if on_batch:
+                    on_batch(self)
+                self.db.commit()
+                dashboard_cache.invalidate_class(*self.changed_class_ids, class_list=self.classes_added)
+                self.changed_class_ids.clear()
+                self.classes_added = False
+        except Exception:
+            self.db.rollback()
+            raise
+        return self.report()
+
+    def report(self) -> dict:
+        elapsed = time.perf_counter() - self.started
+        return {
+            "students_inserted": self.students_inserted,
+            "instructors_inserted": self.instructors_inserted,
+            "classes_inserted": self.classes_inserted,
+            "enrollments_inserted": self.enrollments_inserted,
+            "rows_processed": self.rows_processed,
+            "rows_skipped": self.rows_skipped,
+            "error_count": self.error_count,
+            "errors": self.errors,
+            "elapsed_seconds": round(elapsed, 3),
+            "rows_per_second": round(self.rows_processed / elapsed, 1) if elapsed > 0 else None,
+        }
+
+
+def import_csv(source, db, batch_size: int = CSV_BATCH_SIZE) -> dict:
+    return CsvImporter(db).run(source, batch_size)
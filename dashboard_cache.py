@@ -0,0 +1,196 @@
+# dashboard_cache.py
+# Cache of rendered dashboard fragments and the small pieces of data the pages
+# are assembled from, so repeated dashboard loads don't touch the database.
+#
+# Entries belong to a scope: "class:<id>" for everything shown about one class,
+# "classes" for the list of all classes. Writes that change what a class shows
+# (a graded upload, a comment, a regrade, a CSV import) call `invalidate_class`,
+# which drops only that class's entries. Each scope has a generation number that
+# invalidation bumps; a value built from data read before an invalidation is
+# never stored under the new generation.
+#
+# Two tiers: an in-process LRU and, when DASHBOARD_CACHE_PATH is set, an SQLite
+# file shared by the web workers on one host. With the shared tier, a worker sees
+# the invalidations made by the others through the shared generation numbers.
+
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Callable, Iterable, Optional
+
+import metrics
+
+DASHBOARD_CACHE_ENABLED = os.getenv("DASHBOARD_CACHE_ENABLED", "1") == "1"
+DASHBOARD_CACHE_SIZE = int(os.getenv("DASHBOARD_CACHE_SIZE", "2048"))
+# e.g. /tmp/document_analyzer_dashboards.db; empty = in-process tier only
+DASHBOARD_CACHE_PATH = os.getenv("DASHBOARD_CACHE_PATH", "")
+
+CLASS_LIST_SCOPE = "classes"
+
+
+def class_scope(class_id: int) -> str:
+    return f"class:{class_id}"
+
+
+class SharedTier:
+    """Generations and values in a local SQLite file, one connection per thread."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS generations (scope TEXT PRIMARY KEY, generation INTEGER NOT NULL)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries (scope TEXT, key TEXT, generation INTEGER NOT NULL, "
+                "value TEXT NOT NULL, PRIMARY KEY (scope, key))"
+            )
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def generations(self, scopes) -> dict:
+        scopes = list(scopes)
+        placeholders = ",".join("?" * len(scopes))
+        rows = self._connect().execute(
+            f"SELECT scope, generation FROM generations WHERE scope IN ({placeholders})", scopes
+        ).fetchall()
+        return dict(rows)
+
+    def get(self, scope: str, key: str, generation: int):
+        row = self._connect().execute(
+            "SELECT value FROM entries WHERE scope = ? AND key = ? AND generation = ?", (scope, key, generation)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, scope: str, key: str, generation: int, value):
+        self._connect().execute(
+            "INSERT INTO entries (scope, key, generation, value) SELECT ?, ?, ?, ? "
+            "WHERE ? = coalesce((SELECT generation FROM generations WHERE scope = ?), 0) "
+            "ON CONFLICT (scope, key) DO UPDATE SET generation = excluded.generation, value = excluded.value",
+            (scope, key, generation, json.dumps(value), generation, scope),
+        )
+
+    def invalidate(self, scopes):
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for scope in scopes:
+                conn.execute(
+                    "INSERT INTO generations (scope, generation) VALUES (?, 1) "
+                    "ON CONFLICT (scope) DO UPDATE SET generation = generation + 1", (scope,)
+                )
+                conn.execute("DELETE FROM entries WHERE scope = ?", (scope,))
+
+
+class DashboardCache:
+    def __init__(self, max_size: int = DASHBOARD_CACHE_SIZE, shared_path: str = DASHBOARD_CACHE_PATH,
+                 enabled: bool = DASHBOARD_CACHE_ENABLED):
+        self.max_size = max_size
+        self.enabled = enabled
+        self.shared = SharedTier(shared_path) if shared_path and enabled else None
+        self._entries = OrderedDict()  # (scope, key) -> (generation, value)
+        self._generations = {}  # scope -> generation (in-process tier only)
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def _current_generations(self, scopes) -> dict:
+        if self.shared is not None:
+            generations = self.shared.generations(scopes)
+        else:
+            with self._lock:
+                generations = {scope: self._generations.get(scope, 0) for scope in scopes}
+        return {scope: generations.get(scope, 0) for scope in scopes}
+
+    def _remember(self, entry_key, generation, value):
+        with self._lock:
+            self._entries[entry_key] = (generation, value)
+            self._entries.move_to_end(entry_key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def get_many(self, keys: Iterable[tuple], build: Callable[[list], dict]) -> dict:
+        """Return {(scope, key): value}, calling build(missing keys) once for the misses.
+
+        `build` must return a value for every key it was given (JSON-serializable when
+        the shared tier is on). Values are stored only if their scope wasn't
+        invalidated while they were being built.
+        """
+        keys = list(dict.fromkeys(keys))
+        if not keys:
+            return {}
+        if not self.enabled:
+            return build(keys)
+        generations = self._current_generations({scope for scope, _ in keys})
+
+        found, missing = {}, []
+        for entry_key in keys:
+            generation = generations[entry_key[0]]
+            with self._lock:
+                entry = self._entries.get(entry_key)
+                if entry is not None and entry[0] == generation:
+                    self._entries.move_to_end(entry_key)
+                    self.memory_hits += 1
+                    found[entry_key] = entry[1]
+                    continue
+            value = self.shared.get(*entry_key, generation) if self.shared is not None else None
+            if value is not None:
+                self.shared_hits += 1
+                self._remember(entry_key, generation, value)
+                found[entry_key] = value
+            else:
+                missing.append(entry_key)
+
+        if missing:
+            self.misses += len(missing)
+            built = build(missing)
+            for entry_key in missing:
+                value = built[entry_key]
+                found[entry_key] = value
+                generation = generations[entry_key[0]]
+                if self.shared is not None:
+                    self.shared.put(*entry_key, generation, value)
+                if self._current_generations([entry_key[0]])[entry_key[0]] == generation:
+                    self._remember(entry_key, generation, value)
+        return found
+
+    def invalidate(self, *scopes: str):
+        if not scopes:
+            return
+        with self._lock:
+            for scope in scopes:
+                self._generations[scope] = self._generations.get(scope, 0) + 1
+            for entry_key in [k for k in self._entries if k[0] in scopes]:
+                del self._entries[entry_key]
+        if self.shared is not None:
+            self.shared.invalidate(scopes)
+
+    def invalidate_class(self, *class_ids: Optional[int], class_list: bool = False):
+        """Drop what is cached about these classes (and the class list, if classes were added)."""
+        scopes = [class_scope(class_id) for class_id in class_ids if class_id is not None]
+        if class_list:
+            scopes.append(CLASS_LIST_SCOPE)
+        self.invalidate(*scopes)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+dashboard_cache = DashboardCache()
+
+metrics.CallbackMetric(
+    "dashboard_cache_lookups_total", "Dashboard fragment cache lookups by result.",
+    lambda: {("memory",): dashboard_cache.memory_hits, ("shared",): dashboard_cache.shared_hits,
+             ("miss",): dashboard_cache.misses},
+    labels=["result"], type="counter",
+)
@@ -0,0 +1,74 @@
+# extraction.py
+# Text extraction for uploaded assignments. PDFs are parsed page by page with
+# PyMuPDF in a separate process pool so a large or scanned file never stalls the
+# event loop, and output is capped by page count and character count.
+
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import storage
+
+EXTRACTION_WORKERS = int(os.getenv("EXTRACTION_WORKERS", "2"))
+EXTRACT_MAX_PAGES = int(os.getenv("EXTRACT_MAX_PAGES", "50"))
+EXTRACT_MAX_CHARS = int(os.getenv("EXTRACT_MAX_CHARS", "200000"))
+
+_pool = None
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=EXTRACTION_WORKERS)
+    return _pool
+
+
+def shutdown_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def extract_pdf_text(path: str, max_pages: int = EXTRACT_MAX_PAGES, max_chars: int = EXTRACT_MAX_CHARS) -> str:
+    """Read a PDF one page at a time, stopping at max_pages pages or max_chars characters."""
+    import fitz  # pymupdf
+
+    parts = []
+    total = 0
+    with fitz.open(path) as doc:
+        for page_number, page in enumerate(doc):
+            if page_number >= max_pages or total >= max_chars:
+                break
+            text = page.get_text()
+            if parts:
+                text = "\f" + text  # keep page boundaries for chunking.py
+            parts.append(text[:max_chars - total])
+            total += len(parts[-1])
+    return "".join(parts)
+
+
+def extract_plain_text(path: str, max_chars: int = EXTRACT_MAX_CHARS) -> str:
+    with open(path, "r", encoding="utf-8", errors="ignore") as f:
+        return f.read(max_chars)
+
+
+async def extract_text(path: str, filename: str) -> str:
+    """Extract the gradeable text of a saved upload without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    if filename.lower().endswith(".pdf"):
+        return await loop.run_in_executor(_get_pool(), extract_pdf_text, path)
+    return await loop.run_in_executor(None, extract_plain_text, path)
+
+
+async def load_assignment_text(assignment) -> (str, bool):
+    """Return (text, extracted) for an assignment, extracting the text only if it isn't stored.
+
+    A newly extracted text is set on `assignment.extracted_text` (extracted is True);
+    the caller commits it and updates the search index.
+    """
+    if assignment.extracted_text is not None:
+        return assignment.extracted_text, False
+    path = storage.assignment_path(assignment)
+    assignment.extracted_text = await extract_text(path, assignment.filename)
+    return assignment.extracted_text, True
@@ -0,0 +1,189 @@
+# grading_cache.py
+# Content-addressed cache for GPT grades. Byte-identical (after normalization)
+# resubmissions graded with the same prompt and model reuse the stored result
+# instead of paying for another LLM call.
+#
+# Two tiers: an in-process LRU in front of the `grade_cache` SQLite table. The
+# table is read and written in a worker thread, off the event loop.
+
+import asyncio
+import datetime
+import hashlib
+import os
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+
+import metrics
+from models import GradeCacheEntry, SessionLocal
+
+GRADE_CACHE_ENABLED = os.getenv("GRADE_CACHE_ENABLED", "1") == "1"
+GRADE_CACHE_TTL_SECONDS = float(os.getenv("GRADE_CACHE_TTL_SECONDS", str(30 * 24 * 3600)))
+GRADE_CACHE_MEMORY_SIZE = int(os.getenv("GRADE_CACHE_MEMORY_SIZE", "1024"))
+GRADE_CACHE_MAX_ENTRIES = int(os.getenv("GRADE_CACHE_MAX_ENTRIES", "100000"))
+# Trim the persistent tier once every this many writes rather than on every put
+GRADE_CACHE_EVICT_EVERY = int(os.getenv("GRADE_CACHE_EVICT_EVERY", "100"))
+# A hit refreshes last_used_at (for LRU eviction) only when it is older than this share
+# of the TTL, so most hits are a read with no write transaction
+GRADE_CACHE_TOUCH_FRACTION = float(os.getenv("GRADE_CACHE_TOUCH_FRACTION", "0.1"))
+
+
+def normalize_text(text: str) -> str:
+    text = unicodedata.normalize("NFC", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def cache_key(text: str, prompt_template: str, model: str) -> str:
+    digest = hashlib.sha256()
+    for part in (normalize_text(text), prompt_template, model):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class GradeCache:
+    def __init__(self, session_factory=SessionLocal, memory_size: int = GRADE_CACHE_MEMORY_SIZE,
+                 ttl_seconds: float = GRADE_CACHE_TTL_SECONDS, max_entries: int = GRADE_CACHE_MAX_ENTRIES,
+                 enabled: bool = GRADE_CACHE_ENABLED):
+        self.session_factory = session_factory
+        self.memory_size = memory_size
+        self.ttl = datetime.timedelta(seconds=ttl_seconds)
+        self.touch_interval = self.ttl * GRADE_CACHE_TOUCH_FRACTION
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self._memory = OrderedDict()  # key -> (grade, feedback, created_at)
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self) -> dict:
+        lookups = self.memory_hits + self.db_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": (self.memory_hits + self.db_hits) / lookups if lookups else 0.0,
+            "memory_entries": len(self._memory),
+        }
+
+    def _expired(self, created_at) -> bool:
+        return created_at is None or datetime.datetime.utcnow() - created_at > self.ttl
+
+    def _remember(self, key, grade, feedback, created_at):
+        with self._lock:
+            self._memory[key] = (grade, feedback, created_at)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_size:
+                self._memory.popitem(last=False)
+
+    async def get(self, text: str, prompt_template: str, model: str):
+        """Return (grade, feedback) for a previously graded document, or None."""
+        if not self.enabled:
+            return None
+        key = cache_key(text, prompt_template, model)
+
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry and not self._expired(entry[2]):
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return entry[0], entry[1]
+            if entry:
+                del self._memory[key]
+
+        found = await asyncio.to_thread(self._load, key)
+        if found is None:
+            self.misses += 1
+            return None
+        self.db_hits += 1
+        self._remember(key, *found)
+        return found[0], found[1]
+
+    def _load(self, key: str):
+        """(grade, feedback, created_at) of the stored row, or None. Blocking; runs in a thread."""
+        db = self.session_factory()
+        try:
+            row = db.query(GradeCacheEntry).filter(GradeCacheEntry.key == key).first()
+            if row and not self._expired(row.created_at):
+                now = datetime.datetime.utcnow()
+                if row.last_used_at is None or now - row.last_used_at > self.touch_interval:
+                    row.last_used_at = now
+                    db.commit()
+                return row.grade, row.feedback, row.created_at
+            if row:
+                db.delete(row)
+                db.commit()
+                self.evictions += 1
+            return None
+        finally:
+            db.close()
+
+    async def put(self, text: str, prompt_template: str, model: str, grade: str, feedback: str):
+        if not self.enabled:
+            return
+        key = cache_key(text, prompt_template, model)
+        now = datetime.datetime.utcnow()
+        self._remember(key, grade, feedback, now)
+        await asyncio.to_thread(self._store, key, model, grade, feedback, now)
+
+    def _store(self, key: str, model: str, grade: str, feedback: str, now):
+        db = self.session_factory()
+        try:
+            db.merge(GradeCacheEntry(key=key, model=model, grade=grade, feedback=feedback,
+                                     created_at=now, last_used_at=now))
+            db.commit()
+            with self._lock:
+                self._writes += 1
+                evict = self._writes % GRADE_CACHE_EVICT_EVERY == 0
+            if evict:
+                self.evict(db)
+        finally:
+            db.close()
+
+    def evict(self, db=None) -> int:
+        """Drop expired rows, then the least recently used rows beyond max_entries."""
+        own_session = db is None
+        db = db or self.session_factory()
+        try:
+            cutoff = datetime.datetime.utcnow() - self.ttl
+            removed = db.query(GradeCacheEntry).filter(GradeCacheEntry.created_at < cutoff).delete(synchronize_session=False)
+
+            overflow = db.query(GradeCacheEntry).count() - self.max_entries
+            if overflow > 0:
+                stale_keys = (
+                    db.query(GradeCacheEntry.key)
+                    .order_by(GradeCacheEntry.last_used_at)
+                    .limit(overflow)
+                    .subquery()
+                )
+                removed += (
+                    db.query(GradeCacheEntry)
+                    .filter(GradeCacheEntry.key.in_(stale_keys.select()))
+                    .delete(synchronize_session=False)
+                )
+            db.commit()
+            self.evictions += removed
+            return removed
+        finally:
+            if own_session:
+                db.close()
+
+    def clear_memory(self):
+        with self._lock:
+            self._memory.clear()
+
+
+grade_cache = GradeCache()
+
+metrics.CallbackMetric(
+    "grade_cache_lookups_total", "Grade cache lookups by result.",
+    lambda: {("memory_hit",): grade_cache.memory_hits, ("db_hit",): grade_cache.db_hits, ("miss",): grade_cache.misses},
+    labels=["result"], type="counter",
+)
+metrics.CallbackMetric("grade_cache_hit_ratio", "Share of grade cache lookups that were hits.",
+                       lambda: grade_cache.stats()["hit_rate"])
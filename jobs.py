@@ -0,0 +1,394 @@
+# jobs.py
+# Durable background jobs. Uploads are stored as rows in `grading_jobs` and picked up by
+# a fixed-size pool of asyncio workers, so a burst of submissions is graded at a steady
+# rate and nothing is lost if the server restarts mid-grade. CSV roster imports are
+# tracked the same way in `csv_import_jobs` (see the bottom of this file).
+
+import asyncio
+import csv
+import datetime
+import json
+import os
+import time
+import uuid
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+import metrics
+from auth import identity_cache
+
+from main import process_file, log_error, log_event, GradingError
+from models import GradingJob, CsvImportJob, JobStatusEnum, SessionLocal
+from storage import spool_bytes, discard
+from csv_import import CsvImporter, iter_csv_rows, COUNTERS, CSV_BATCH_SIZE, MAX_REPORTED_ERRORS
+
+GRADING_WORKERS = int(os.getenv("GRADING_WORKERS", "4"))
+GRADING_MAX_ATTEMPTS = int(os.getenv("GRADING_MAX_ATTEMPTS", "3"))
+GRADING_RETRY_BASE_SECONDS = float(os.getenv("GRADING_RETRY_BASE_SECONDS", "5"))
+GRADING_RETRY_MAX_SECONDS = float(os.getenv("GRADING_RETRY_MAX_SECONDS", "300"))
+GRADING_POLL_SECONDS = float(os.getenv("GRADING_POLL_SECONDS", "2"))
+# A RUNNING job is leased to its worker, which renews the lease (updated_at) every
+# GRADING_HEARTBEAT_SECONDS. Only jobs whose lease has run out are requeued, so other
+# live processes (several uvicorn workers, a rolling restart) keep their jobs.
+GRADING_LEASE_SECONDS = float(os.getenv("GRADING_LEASE_SECONDS", "300"))
+GRADING_HEARTBEAT_SECONDS = float(os.getenv("GRADING_HEARTBEAT_SECONDS", str(GRADING_LEASE_SECONDS / 5)))
+CSV_IMPORT_DIR = os.getenv("CSV_IMPORT_DIR", "imports")
+CSV_IMPORT_BATCH_SIZE = int(os.getenv("CSV_IMPORT_BATCH_SIZE", str(CSV_BATCH_SIZE)))
+
+
+def enqueue_grading_job(db: Session, upload_path: str, filename: str, class_name: str, student_id: int,
+                        content_hash: str = None, size: int = None) -> GradingJob:
+    job = GradingJob(
+        status=JobStatusEnum.QUEUED,
+        filename=filename,
+        class_name=class_name,
+        upload_path=upload_path,
+        content_hash=content_hash,
+        size=size,
+        student_id=student_id,
+        max_attempts=GRADING_MAX_ATTEMPTS,
+    )
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    return job
+
+
+def retry_delay(attempts: int) -> float:
+    # Exponential backoff: base, 2*base, 4*base, ... capped at GRADING_RETRY_MAX_SECONDS
+    return min(GRADING_RETRY_BASE_SECONDS * (2 ** max(attempts - 1, 0)), GRADING_RETRY_MAX_SECONDS)
+
+
+def claim_next_job(db: Session):
+    """Atomically move the oldest runnable job from QUEUED to RUNNING and return its id."""
+    now = datetime.datetime.utcnow()
+    candidates = (
+        db.query(GradingJob.id)
+        .filter(GradingJob.status == JobStatusEnum.QUEUED, GradingJob.run_after <= now)
+        .order_by(GradingJob.id)
+        .limit(5)
+        .all()
+    )
+    for (job_id,) in candidates:
+        # Only one worker can win the QUEUED -> RUNNING transition for a given row
+        claimed = (
+            db.query(GradingJob)
+            .filter(GradingJob.id == job_id, GradingJob.status == JobStatusEnum.QUEUED)
+            .update(
+                {"status": JobStatusEnum.RUNNING, "attempts": GradingJob.attempts + 1, "updated_at": now},
+                synchronize_session=False,
+            )
+        )
+        db.commit()
+        if claimed:
+            return job_id
+    return None
+
+
+def recover_interrupted_jobs(db: Session, lease_seconds: float = GRADING_LEASE_SECONDS) -> int:
+    """Requeue RUNNING jobs whose lease ran out: their worker died mid-grade."""
+    expired = datetime.datetime.utcnow() - datetime.timedelta(seconds=lease_seconds)
+    count = (
+        db.query(GradingJob)
+        .filter(GradingJob.status == JobStatusEnum.RUNNING, GradingJob.updated_at < expired)
+        .update({"status": JobStatusEnum.QUEUED}, synchronize_session=False)
+    )
+    db.commit()
+    return count
+
+
+def renew_lease(db: Session, job_id: int):
+    db.query(GradingJob).filter(GradingJob.id == job_id, GradingJob.status == JobStatusEnum.RUNNING).update(
+        {"updated_at": datetime.datetime.utcnow()}, synchronize_session=False
+    )
+    db.commit()
+
+
+busy_workers = metrics.Gauge("grading_workers_busy", "Grading workers currently running a job.")
+attempts_finished = metrics.Counter("grading_attempts_total", "Finished grading attempts by the status they left the job in.", ["status"])
+
+
+class GradingWorkerPool:
+    def __init__(self, concurrency: int = GRADING_WORKERS, session_factory=SessionLocal):
+        self.concurrency = concurrency
+        self.session_factory = session_factory
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+        self._last_recovery = 0.0
+
+    def recover(self):
+        db = self.session_factory()
+        try:
+            recovered = recover_interrupted_jobs(db)
+            if recovered:
+                log_event(f"Requeued {recovered} interrupted grading job(s).", jobs=recovered)
+        except Exception as e:
+            log_error(f"Error requeueing interrupted grading jobs: {str(e)}")
+        finally:
+            db.close()
+        self._last_recovery = time.monotonic()
+
+    async def start(self):
+        await asyncio.to_thread(self.recover)
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def notify(self):
+        # Wake idle workers right away instead of waiting for the next poll
+        self._wakeup.set()
+
+    async def _worker(self):
+        while True:
+            db = self.session_factory()
+            try:
+                job_id = claim_next_job(db)
+            except Exception as e:
+                log_error(f"Error claiming grading job: {str(e)}")
+                job_id = None
+            finally:
+                db.close()
+
+            if job_id is None:
+                # Jobs of a process that died while this one runs are picked up once their lease ends
+                if time.monotonic() - self._last_recovery > GRADING_LEASE_SECONDS / 2:
+                    await asyncio.to_thread(self.recover)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=GRADING_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+
+            busy_workers.inc()
+            try:
+                await self.run_job(job_id)
+            finally:
+                busy_workers.dec()
+
+    async def run_job(self, job_id: int):
+        db = self.session_factory()
+        try:
+            job = db.query(GradingJob).filter(GradingJob.id == job_id).first()
+            if not job:
+                return
+            if job.upload_path is None and job.payload is not None:
+                # Job queued by an older version that kept the file in the database
+                job.upload_path, job.size, job.content_hash = spool_bytes(job.payload)
+                job.payload = None
+                db.commit()
+            heartbeat = asyncio.create_task(self._heartbeat(job_id))
+            try:
+                assignment_id = await process_file(
+                    job.upload_path, job.filename, job.class_name, db, job.student_id, job.content_hash
+                )
+            except GradingError as e:
+                db.rollback()
+                job.status = JobStatusEnum.FAILED
+                job.last_error = str(e)
+            except Exception as e:
+                db.rollback()
+                job.last_error = str(e)
+                if job.attempts >= job.max_attempts:
+                    job.status = JobStatusEnum.FAILED
+                else:
+                    job.status = JobStatusEnum.QUEUED
+                    job.run_after = datetime.datetime.utcnow() + datetime.timedelta(seconds=retry_delay(job.attempts))
+            else:
+                job.status = JobStatusEnum.DONE
+                job.assignment_id = assignment_id
+                job.last_error = None
+            finally:
+                heartbeat.cancel()
+            db.commit()
+            attempts_finished.inc(status=job.status.value)
+            if job.status == JobStatusEnum.FAILED:
+                discard(job.upload_path)
+        except Exception as e:
+            log_error(f"Error finalizing grading job {job_id}: {str(e)}")
+        finally:
+            db.close()
+
+    async def _heartbeat(self, job_id: int):
+        """Renew the job's lease until cancelled, in a session of its own."""
+        while True:
+            await asyncio.sleep(GRADING_HEARTBEAT_SECONDS)
+            db = self.session_factory()
+            try:
+                await asyncio.to_thread(renew_lease, db, job_id)
+            except Exception as e:
+                log_error(f"Error renewing the lease of grading job {job_id}: {str(e)}")
+            finally:
+                db.close()
+
+
+worker_pool = GradingWorkerPool()
+
+
+def _jobs_by_status(model):
+    db = SessionLocal()
+    try:
+        counts = dict(db.query(model.status, func.count(model.id)).group_by(model.status).all())
+    finally:
+        db.close()
+    return {(status.value,): counts.get(status, 0) for status in JobStatusEnum}
+
+
+metrics.CallbackMetric("grading_jobs", "Grading jobs by status (queued is the queue depth).",
+                       lambda: _jobs_by_status(GradingJob), labels=["status"])
+metrics.CallbackMetric("csv_import_jobs", "CSV import jobs by status.",
+                       lambda: _jobs_by_status(CsvImportJob), labels=["status"])
+
+
+# --- CSV Import Jobs ---
+# Roster imports run off the request in a worker thread, one at a time, committing
+# each batch together with a checkpoint of how many rows are done. An import that
+# was interrupted (crash, restart) continues from its last checkpoint on startup.
+
+def save_csv_upload(fileobj, chunk_size: int = 1024 * 1024):
+    """Copy an uploaded CSV to CSV_IMPORT_DIR in chunks. Returns (path, data rows).
+
+    Rows are counted the way the import reads them (quoted newlines, blank lines),
+    so the progress total is what rows_processed ends at. None if the file can't be parsed.
+    """
+    os.makedirs(CSV_IMPORT_DIR, exist_ok=True)
+    path = os.path.join(CSV_IMPORT_DIR, f"{uuid.uuid4().hex}.csv")
+    with open(path, "wb") as out:
+        while True:
+            chunk = fileobj.read(chunk_size)
+            if not chunk:
+                break
+            out.write(chunk)
+    try:
+        with open(path, "rb") as f:
+            total_rows = sum(1 for _ in iter_csv_rows(f))
+    except (UnicodeDecodeError, csv.Error):
+        total_rows = None
+    return path, total_rows
+
+
+def enqueue_csv_import(db: Session, file_path: str, filename: str, total_rows: int = None) -> CsvImportJob:
+    job = CsvImportJob(status=JobStatusEnum.QUEUED, file_path=file_path, filename=filename, total_rows=total_rows)
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    return job
+
+
+def run_csv_import(job_id: int, session_factory=SessionLocal, batch_size: int = CSV_IMPORT_BATCH_SIZE):
+    """Run (or resume) one CSV import job to completion. Blocking; call from a thread."""
+    db = session_factory()
+    try:
+        job = db.query(CsvImportJob).filter(CsvImportJob.id == job_id).first()
+        if not job or job.status in (JobStatusEnum.DONE, JobStatusEnum.FAILED):
+            return
+        job.status = JobStatusEnum.RUNNING
+        job.started_at = job.started_at or datetime.datetime.utcnow()
+        db.commit()
+
+        importer = CsvImporter(db)
+        importer.restore({name: getattr(job, name) for name in COUNTERS}, json.loads(job.errors or "[]"))
+
+        def save_progress(importer):
+            for name in COUNTERS:
+                setattr(job, name, getattr(importer, name))
+            job.errors = json.dumps(importer.errors[:MAX_REPORTED_ERRORS])
+
+        try:
+            with open(job.file_path, "rb") as f:
+                importer.run(f, batch_size=batch_size, start_row=job.rows_processed, on_batch=save_progress)
+        except Exception as e:
+            log_error(f"Error importing CSV job {job_id}: {str(e)}")
+            job.status = JobStatusEnum.FAILED
+            job.last_error = str(e)
+            job.finished_at = datetime.datetime.utcnow()
+            db.commit()
+            return
+
+        job.status = JobStatusEnum.DONE
+        job.finished_at = datetime.datetime.utcnow()
+        db.commit()
+        # New enrollments and classes change what logged-in users may see
+        identity_cache.clear()
+        for error in importer.errors:
+            log_error(f"CSV import {job_id} row {error['row']}: {error['error']}")
+        try:
+            os.remove(job.file_path)
+        except OSError:
+            pass
+    finally:
+        db.close()
+
+
+def csv_import_progress(job: CsvImportJob) -> dict:
+    rate = None
+    if job.started_at and job.rows_processed:
+        end = job.finished_at or datetime.datetime.utcnow()
+        elapsed = (end - job.started_at).total_seconds()
+        rate = round(job.rows_processed / elapsed, 1) if elapsed > 0 else None
+    return {
+        "id": job.id,
+        "status": job.status.value,
+        "filename": job.filename,
+        "total_rows": job.total_rows,
+        "rows_processed": job.rows_processed,
+        "rows_skipped": job.rows_skipped,
+        "inserted": {
+            "students": job.students_inserted,
+            "instructors": job.instructors_inserted,
+            "classes": job.classes_inserted,
+            "enrollments": job.enrollments_inserted,
+        },
+        "error_count": job.error_count,
+        "errors": json.loads(job.errors or "[]")[:20],
+        "rows_per_second": rate,
+        "error": job.last_error,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+
+class CsvImportRunner:
+    def __init__(self, session_factory=SessionLocal):
+        self.session_factory = session_factory
+        self._lock = asyncio.Lock()  # SQLite has one writer; run imports one after another
+        self._tasks = set()
+
+    async def start(self):
+        db = self.session_factory()
+        try:
+            pending = (
+                db.query(CsvImportJob.id)
+                .filter(CsvImportJob.status.in_([JobStatusEnum.QUEUED, JobStatusEnum.RUNNING]))
+                .order_by(CsvImportJob.id)
+                .all()
+            )
+        finally:
+            db.close()
+        for (job_id,) in pending:
+            self.submit(job_id)
+
+    def submit(self, job_id: int):
+        task = asyncio.create_task(self._run(job_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, job_id: int):
+        async with self._lock:
+            await asyncio.to_thread(run_csv_import, job_id, self.session_factory)
+
+    async def stop(self):
+        # A batch already running in a thread finishes on its own; anything left is
+        # picked up from its checkpoint on the next start().
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+csv_import_runner = CsvImportRunner()
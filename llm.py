@@ -0,0 +1,263 @@
+# llm.py
+# Shared LLM client used by the grader. One pooled async client per event loop, a
+# semaphore bounding in-flight requests, and a per-attempt timeout on the client.
+# Backends are pluggable so a local fake can stand in for OpenAI during load tests.
+#
+# Every request's tokens are counted: process-wide in `usage_totals`, and for
+# whatever is being graded inside a `track_usage()` block. The counts are the ones
+# the provider bills (its `usage`); they are only counted locally when it reports none.
+
+import asyncio
+import contextlib
+import contextvars
+import dataclasses
+import functools
+import hashlib
+import os
+import re
+import weakref
+
+import httpx
+
+import metrics
+
+LLM_BACKEND = os.getenv("LLM_BACKEND", "openai")
+LLM_MODEL = os.getenv("LLM_MODEL", "gpt-4o-mini")
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "8"))
+# Per attempt, enforced by the HTTP client; the SDK retries a failed attempt up to LLM_MAX_RETRIES times
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "60"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "20"))
+FAKE_LLM_LATENCY_SECONDS = float(os.getenv("FAKE_LLM_LATENCY_SECONDS", "0.5"))
+
+
+@dataclasses.dataclass
+class Completion:
+    """A backend's reply, with the token usage the provider reported (None if it reports none)."""
+
+    content: str
+    prompt_tokens: int = None
+    completion_tokens: int = None
+
+
+class LLMBackend:
+    """Interface every grading backend implements."""
+
+    model = LLM_MODEL
+
+    async def complete(self, prompt: str, max_tokens: int = None) -> Completion:
+        raise NotImplementedError
+
+    async def aclose(self):
+        pass
+
+
+class OpenAIBackend(LLMBackend):
+    def __init__(self, model: str = LLM_MODEL):
+        self.model = model
+        self._clients = weakref.WeakKeyDictionary()
+
+    def _client(self):
+        # httpx connection pools are tied to the event loop that created them
+        from openai import AsyncOpenAI
+
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            http_client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=LLM_MAX_CONNECTIONS),
+                timeout=LLM_TIMEOUT_SECONDS,
+            )
+            client = AsyncOpenAI(http_client=http_client, timeout=LLM_TIMEOUT_SECONDS, max_retries=LLM_MAX_RETRIES)
+            self._clients[loop] = client
+        return client
+
+    async def complete(self, prompt: str, max_tokens: int = None) -> Completion:
+        extra = {"max_completion_tokens": max_tokens} if max_tokens else {}
+        completion = await self._client().chat.completions.create(
+            model=self.model,
+            store=True,
+            messages=[
+                {"role": "user", "content": prompt}
+            ],
+            **extra
+        )
+        usage = completion.usage
+        return Completion(
+            completion.choices[0].message.content,
+            usage.prompt_tokens if usage else None,
+            usage.completion_tokens if usage else None,
+        )
+
+    async def aclose(self):
+        loop = asyncio.get_running_loop()
+        client = self._clients.pop(loop, None)
+        if client is not None:
+            await client.close()
+
+
+class FakeBackend(LLMBackend):
+    """Offline stand-in for OpenAI: sleeps for `latency` seconds and returns a
+    deterministic, well-formed grade so the rest of the pipeline runs unchanged."""
+
+    model = "fake"
+
+    def __init__(self, latency: float = FAKE_LLM_LATENCY_SECONDS):
+        self.latency = latency
+        self.calls = 0
+
+    async def complete(self, prompt: str, max_tokens: int = None) -> Completion:
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        # Batched prompts (see batch_grading.py) get one answer per document
+        documents = re.findall(r'<document id="(\d+)">\n(.*?)\n</document>', prompt, re.DOTALL)
+        if documents:
+            return Completion("\n\n".join(f"### Document {i}\n{self._answer(text)}" for i, text in documents))
+        # No usage reported, like a provider that omits it: complete() counts the tokens itself
+        return Completion(self._answer(prompt))
+
+    @staticmethod
+    def _answer(text: str) -> str:
+        grade = "ABCDF"[hashlib.sha256(text.encode("utf-8")).digest()[0] % 5]
+        return f"```Grade: {grade}```\nFeedback: Automatically generated feedback for load testing."
+
+
+_backend = None
+_semaphores = weakref.WeakKeyDictionary()
+
+
+def get_backend() -> LLMBackend:
+    global _backend
+    if _backend is None:
+        _backend = FakeBackend() if LLM_BACKEND == "fake" else OpenAIBackend()
+    return _backend
+
+
+def set_backend(backend: LLMBackend):
+    global _backend
+    _backend = backend
+
+
+def _semaphore() -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    semaphore = _semaphores.get(loop)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+        _semaphores[loop] = semaphore
+    return semaphore
+
+
+@functools.lru_cache(maxsize=None)
+def _encoding(model: str):
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    # tiktoken downloads the BPE file on first use; offline, count by characters instead
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        from main import log_error
+        log_error(f"Could not load the tiktoken encoding for {model}, estimating tokens: {str(e)}")
+        return None
+
+
+async def warm_encoding():
+    """Load the tokenizer off the event loop (at startup) so the first request doesn't download it."""
+    await asyncio.to_thread(_encoding, get_backend().model)
+
+
+def count_tokens(text: str, model: str = None) -> int:
+    """Number of tokens text takes for the model; about 4 characters a token without tiktoken."""
+    encoding = _encoding(model or get_backend().model)
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+@dataclasses.dataclass
+class TokenUsage:
+    requests: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def add(self, prompt_tokens: int, completion_tokens: int, requests: int = 1):
+        self.requests += requests
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+
+
+usage_totals = TokenUsage()
+
+in_flight = metrics.Gauge("llm_in_flight_requests", "LLM requests currently being answered.")
+request_seconds = metrics.Histogram("llm_request_duration_seconds", "Time for the LLM to answer one request.")
+requests_total = metrics.Counter("llm_requests_total", "LLM requests by outcome.", ["outcome"])
+tokens_total = metrics.Counter("llm_tokens_total", "LLM tokens spent.", ["type"])
+_current_usage = contextvars.ContextVar("llm_usage", default=None)
+
+
+def current_usage():
+    """The TokenUsage of the enclosing track_usage() block, or None."""
+    return _current_usage.get()
+
+
+@contextlib.contextmanager
+def track_usage():
+    """Collect the tokens of every request made inside the block (tasks it starts included)."""
+    usage = TokenUsage()
+    token = _current_usage.set(usage)
+    try:
+        yield usage
+    finally:
+        _current_usage.reset(token)
+
+
+def _is_timeout(error: Exception) -> bool:
+    if isinstance(error, (asyncio.TimeoutError, httpx.TimeoutException)):
+        return True
+    try:
+        from openai import APITimeoutError
+    except ImportError:
+        return False
+    return isinstance(error, APITimeoutError)
+
+
+async def complete(prompt: str, max_tokens: int = None) -> str:
+    """Send one prompt through the shared backend, bounded by LLM_CONCURRENCY.
+
+    The timeout is the backend's own (the OpenAI client applies LLM_TIMEOUT_SECONDS to
+    each attempt), so it never cancels the SDK in the middle of its retries.
+    """
+    backend = get_backend()
+    async with _semaphore():
+        in_flight.inc()
+        try:
+            with request_seconds.time():
+                completion = await backend.complete(prompt, max_tokens)
+        except Exception as e:
+            requests_total.inc(outcome="timeout" if _is_timeout(e) else "error")
+            raise
+        finally:
+            in_flight.dec()
+    requests_total.inc(outcome="ok")
+    content = completion.content
+    prompt_tokens, completion_tokens = completion.prompt_tokens, completion.completion_tokens
+    if prompt_tokens is None:
+        prompt_tokens = count_tokens(prompt, backend.model)
+    if completion_tokens is None:
+        completion_tokens = count_tokens(content or "", backend.model)
+    usage_totals.add(prompt_tokens, completion_tokens)
+    tokens_total.inc(prompt_tokens, type="prompt")
+    tokens_total.inc(completion_tokens, type="completion")
+    usage = _current_usage.get()
+    if usage is not None:
+        usage.add(prompt_tokens, completion_tokens)
+    return content
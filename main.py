@@ -1,32 +1,81 @@
-from fastapi import FastAPI, UploadFile, BackgroundTasks
+from fastapi import FastAPI, UploadFile
 from fastapi.responses import HTMLResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi import Request
-import httpx
-import shutil
-import uuid
 import os
 import re
-import csv, io
-from openai import OpenAI
+import asyncio
+import llm
+from grading_cache import grade_cache
+from extraction import extract_text
+import storage
+import search
+import similarity
+import analytics
+from dashboard_cache import dashboard_cache
 from models import Assignment, Class, Student, Instructor
 from sqlalchemy.orm import Session
 import datetime
+import json
+import logging
+import metrics
 
-error_log = 'error_logs.txt'
+# --- Logging ---
+# One JSON object per line on stderr (and in LOG_FILE when set), so log lines can
+# be searched and filtered by field instead of grepped out of a flat text file.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FILE = os.getenv("LOG_FILE")
 
+logger = logging.getLogger("document_analyzer")
 
-def log_error(message):
-    with open(error_log, 'a') as f:
-        f.write(message + '\n')
 
-# In-memory storage
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
 
-# --- Simulated GPT Call ---
-async def evaluate_grade(file_content: str) -> (str, str):
-    try:
-        prompt = f'''
+
+def configure_logging():
+    if logger.handlers:
+        return
+    handlers = [logging.StreamHandler()]
+    if LOG_FILE:
+        handlers.append(logging.FileHandler(LOG_FILE))
+    for handler in handlers:
+        handler.setFormatter(JsonFormatter())
+        logger.addHandler(handler)
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+
+
+configure_logging()
+
+
+def log_error(message, **fields):
+    logger.error(message, extra={"fields": fields})
+
+
+def log_event(message, **fields):
+    logger.info(message, extra={"fields": fields})
+
+
+class GradingError(Exception):
+    """Raised when a submission can never be graded (e.g. unknown student or class)."""
+
+
+class GradeUnavailable(Exception):
+    """Raised when the LLM request or its reply failed; transient, so the grading job is retried."""
+
+GRADING_PROMPT = '''
         You are a teacher who is grading the class assignments. Grade the following assignment and give feedback to the student.
         
         Output Format:
@@ -36,158 +85,131 @@ async def evaluate_grade(file_content: str) -> (str, str):
         Assignment Text:
         {file_content}
         '''
-        client = OpenAI( )
-
-        completion = client.chat.completions.create(
-            model="gpt-4o-mini",
-            store=True,
-            messages=[
-                {"role": "user", "content": prompt}
-            ]
-        )
-        content = completion.choices[0].message.content
 
-        grade_match = re.search(r"```Grade:\s*(.*?)```", content, re.DOTALL | re.IGNORECASE)
-        grade_query = grade_match.group(1).strip() if grade_match else None
+# --- GPT Call ---
+def parse_grade(content: str) -> (str, str):
+    """Pull the grade and feedback out of a model reply in GRADING_PROMPT's format."""
+    grade_match = re.search(r"```Grade:\s*(.*?)```", content, re.DOTALL | re.IGNORECASE)
+    grade_query = grade_match.group(1).strip() if grade_match else None
+
+    explanation_match = re.search(r"Feedback:\s*(.*)", content, re.DOTALL)
+    explanation = explanation_match.group(1).strip() if explanation_match else None
+
+    if grade_query is None or explanation is None:
+        raise ValueError("Could not extract grade or explanation properly.")
+    return grade_query, explanation
+
 
-        explanation_match = re.search(r"Feedback:\s*(.*)", content, re.DOTALL)
-        explanation = explanation_match.group(1).strip() if explanation_match else None
+async def request_grade(file_content: str) -> (str, str):
+    prompt = GRADING_PROMPT.format(file_content=file_content)
+    # Shared pooled client; awaiting here no longer blocks the event loop
+    content = await llm.complete(prompt)
+    return parse_grade(content)
 
-        if grade_query is None or explanation is None:
-            raise ValueError("Could not extract grade or explanation properly.")
 
+async def evaluate_grade(file_content: str, raise_errors: bool = False) -> (str, str):
+    """Grade one text. A failed request gives ("Error", ...), or GradeUnavailable with raise_errors."""
+    try:
+        model = llm.get_backend().model
+        cached = await grade_cache.get(file_content, GRADING_PROMPT, model)
+        if cached:
+            return cached
+
+        # Imported here: batch_grading and chunking build on the helpers above
+        from batch_grading import batcher
+        from chunking import needs_chunking, grade_long_document
+        if needs_chunking(file_content):
+            # Too long for one prompt: summarize the parts, then grade the summaries
+            grade_query, explanation = await grade_long_document(file_content)
+        elif batcher.enabled:
+            # Shares one request with other submissions being graded right now
+            grade_query, explanation = await batcher.grade(file_content)
+        else:
+            grade_query, explanation = await request_grade(file_content)
+
+        await grade_cache.put(file_content, GRADING_PROMPT, model, grade_query, explanation)
         return grade_query, explanation
 
     except Exception as e:
         log_error(f"Error in evaluate_grade: {str(e)}")
+        if raise_errors:
+            # The grading workers retry the job with backoff instead of saving an "Error" grade
+            raise GradeUnavailable(str(e)) from e
         return "Error", "Could not generate feedback."
 
 # --- Background Grading Task ---
-async  def process_file(content: bytes, filename: str, class_name: str, db: Session, student_id: int):
+# Runs inside a grading worker (see jobs.py). `upload_path` is the spooled upload
+# (see storage.py). It stays in the spool until the assignment is committed, so a
+# failed attempt can be retried from the same file. Returns the new assignment id;
+# raises GradingError for submissions that can't be graded, and GradeUnavailable (or
+# anything else) for failures the worker should retry.
+async  def process_file(upload_path: str, filename: str, class_name: str, db: Session, student_id: int,
+                        content_hash: str = None) -> int:
     try:
         # Find the student object
         student = db.query(Student).filter(Student.id == student_id).first()
         if not student:
-            log_error(f"Student ID {student_id} not found.")
-            return
+            raise GradingError(f"Student ID {student_id} not found.")
 
         # Find the class object
         class_obj = db.query(Class).filter(Class.name == class_name).first()
         if not class_obj:
-            log_error(f"Class {class_name} not found.")
-            return
-
-        # --- Create structured file name ---
-        clean_student_email = student.email.replace('@', '_at_')  # (optional: replace special chars)
-        clean_class_name = class_obj.name.replace(' ', '_')       # (optional: remove spaces if any)
-        timestamp = datetime.datetime.now()
-        structured_filename = f"{clean_student_email}-{clean_class_name}-{timestamp}-{filename}"
-        documents_dir = "documents"
-        os.makedirs(documents_dir, exist_ok=True)
-
-        saved_path = os.path.join(documents_dir, structured_filename)
-
-        # Save file
-        with open(saved_path, "wb") as f:
-            f.write(content)
-
-        # Then grading etc. as before
-        grade, feedback = await evaluate_grade(content.decode('utf-8', errors='ignore') if filename.endswith('.txt') else "PDF parsing...")  # (simplified here)
+            raise GradingError(f"Class {class_name} not found.")
+        class_id = class_obj.id
+
+        # Extract text (PDFs are parsed in a process pool), then grade it
+        with metrics.span("text_extraction"):
+            text = await extract_text(upload_path, filename)
+        if not text.strip():
+            raise GradingError(f"No text could be extracted from {filename}.")
+        with metrics.span("similarity_signature"):
+            signature = await asyncio.to_thread(similarity.signature, text)
+        with llm.track_usage() as usage, metrics.span("evaluate_grade"):
+            grade, feedback = await evaluate_grade(text, raise_errors=True)
+
+        # Store one copy per unique content in the blob store, off the event loop
+        with metrics.span("file_save"):
+            if content_hash is None:
+                content_hash = await asyncio.to_thread(storage.hash_file, upload_path)
+            size = await asyncio.to_thread(os.path.getsize, upload_path)
+            created = await asyncio.to_thread(storage.store_blob_file, upload_path, content_hash)
+        storage.remember_blob(db, content_hash, size)
 
         # Save to database
         new_assignment = Assignment(
-            filename=structured_filename, 
+            filename=filename,
+            content_hash=content_hash,
             grade=grade,
             feedback=feedback,
+            extracted_text=text,
+            prompt_tokens=usage.prompt_tokens,
+            completion_tokens=usage.completion_tokens,
             student_id=student.id,
-            class_id=class_obj.id
+            class_id=class_id
         )
         db.add(new_assignment)
-        db.commit()
+        try:
+            with metrics.span("db_commit"):
+                db.flush()
+                search.index_assignment(db, new_assignment.id)
+                matches = similarity.index_document(db, new_assignment.id, class_id, student.id, signature)
+                analytics.record_assignment(db, new_assignment.id, class_id, student.id, grade,
+                                            usage.prompt_tokens, usage.completion_tokens)
+                db.commit()
+        except Exception:
+            db.rollback()
+            if created and not db.query(Assignment.id).filter(Assignment.content_hash == content_hash).first():
+                storage.discard(storage.blob_path(content_hash))
+            raise
+        dashboard_cache.invalidate_class(class_id)
+        storage.discard(upload_path)
         db.refresh(new_assignment)
+        for matched_id, score in matches:
+            log_event("Possible near-duplicate submission", assignment_id=new_assignment.id,
+                      matched_assignment_id=matched_id, similarity=round(score, 3), class_name=class_name)
+        return new_assignment.id
 
     except Exception as e:
-        log_error(f"Error processing file {filename}: {str(e)}")
-
-async def upload_csv(file_content: bytes, db):
-    decoded = file_content.decode('utf-8')
-    reader = csv.DictReader(io.StringIO(decoded))
-
-    inserted_students = 0
-    inserted_instructors = 0
-    inserted_classes = 0
-
-    for row in reader:
-        row_type = row.get('type', '').strip().lower()
-        if row_type == 'student':
-            name = row.get('name', '').strip()
-            email = row.get('email', '').strip()
-
-            if name and email:
-                existing_student = db.query(Student).filter(Student.email == email).first()
-                if not existing_student:
-                    new_student = Student(name=name, email=email)
-                    db.add(new_student)
-                    db.flush()
-                    inserted_students += 1
-
-        elif row_type == 'instructor':
-            name = row.get('name', '').strip()
-            email = row.get('email', '').strip()
-
-            if name and email:
-                existing_instructor = db.query(Instructor).filter(Instructor.email == email).first()
-                if not existing_instructor:
-                    new_instructor = Instructor(name=name, email=email)
-                    db.add(new_instructor)
-                    db.flush()
-                    inserted_instructors += 1
-
-        elif row_type == 'class':
-            name = row.get('name', '').strip()
-            year = row.get('year', '').strip()
-            semester = row.get('semester', '').strip().upper()
-            instructor_email = row.get('instructor_email', '').strip()
-            student_emails = row.get('student_emails', '').strip()
-
-            instructor = db.query(Instructor).filter(Instructor.email == instructor_email).first()
-
-            if name and year and semester and instructor:
-                existing_class = db.query(Class).filter(Class.name == name).first()
-
-                if not existing_class:
-                    new_class = Class(
-                        name=name,
-                        year=int(year),
-                        semester=semester,
-                        instructor_id=instructor.id
-                    )
-                    db.add(new_class)
-                    db.flush()
-                    target_class = new_class
-                    inserted_classes += 1
-                    print(f"✅ New class {name} created.")
-                else:
-                    target_class = existing_class
-                    print(f"ℹ️ Class {name} already exists, adding students to it.")
-
-                if student_emails:
-                    email_list = [email.strip() for email in student_emails.split(",")]
-                    for email in email_list:
-                        student = db.query(Student).filter(Student.email == email).first()
-                        if student:
-                            if student not in target_class.students:
-                                target_class.students.append(student)
-                                print(f"Student {student.email} added to class {target_class.name}")
-                            else:
-                                print(f"Student {student.email} already enrolled in {target_class.name}")
-                        else:
-                            print(f" Student with email {email} not found!")
-
-    db.commit()
-    db.close()
-    return {
-        "students_inserted": inserted_students,
-        "instructors_inserted": inserted_instructors,
-        "classes_inserted": inserted_classes
-    }
\ No newline at end of file
+        log_error(f"Error processing file {filename}: {str(e)}", filename=filename, student_id=student_id,
+                  class_name=class_name, error_type=type(e).__name__)
+        raise
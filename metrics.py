@@ -0,0 +1,199 @@
+# metrics.py
+# In-process metrics in the Prometheus text format, served at /metrics.
+#
+# Counters and histograms are updated where things happen; gauges that describe
+# state kept elsewhere (queue depth, cache hit counts) are read by a callback when
+# the endpoint is scraped. `span(stage)` times one stage of a request or job into
+# the `stage_duration_seconds` histogram.
+
+import contextlib
+import math
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_registry = []
+_lock = threading.Lock()
+
+
+def _format_labels(names, values) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        escaped = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name: str, documentation: str, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for suffix, label_names, label_values, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(label_names, label_values)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labels=()):
+        super().__init__(name, documentation, labels)
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        for key, value in sorted(self._values.items()):
+            yield "", self.label_names, key, value
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels=()):
+        super().__init__(name, documentation, labels)
+        self._values = {}
+
+    def set(self, value: float, **labels):
+        with _lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        for key, value in sorted(self._values.items()):
+            yield "", self.label_names, key, value
+
+
+class CallbackMetric(_Metric):
+    """A gauge or counter whose values are read from `callback` at scrape time.
+
+    The callback returns a number, or a dict of label-value tuples to numbers.
+    """
+
+    def __init__(self, name: str, documentation: str, callback, labels=(), type: str = "gauge"):
+        super().__init__(name, documentation, labels)
+        self.callback = callback
+        self.type = type
+
+    def samples(self):
+        values = self.callback()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in sorted(values.items()):
+            yield "", self.label_names, key, value
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with _lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def count(self, **labels) -> int:
+        series = self._series.get(self._key(labels))
+        return series[-1] if series else 0
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        bucket_labels = self.label_names + ("le",)
+        for key, series in sorted(self._series.items()):
+            for bound, count in zip(self.buckets, series):
+                yield "_bucket", bucket_labels, key + (_format_value(bound),), count
+            yield "_sum", self.label_names, key, series[-2]
+            yield "_count", self.label_names, key, series[-1]
+
+
+def render() -> str:
+    """All registered metrics in the Prometheus text exposition format."""
+    parts = []
+    for metric in list(_registry):
+        try:
+            parts.append(metric.render())
+        except Exception:
+            # A failing callback (e.g. the database is down) must not break the scrape
+            continue
+    return "\n".join(parts) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+http_requests = Counter("http_requests_total", "HTTP requests handled.", ["method", "route", "status"])
+http_request_seconds = Histogram("http_request_duration_seconds", "Time to handle an HTTP request.", ["method", "route"])
+stage_seconds = Histogram(
+    "stage_duration_seconds",
+    "Time spent in one stage of an upload, grading job or dashboard request.",
+    ["stage"],
+)
+stage_errors = Counter("stage_errors_total", "Stages that ended with an exception.", ["stage"])
+
+
+@contextlib.contextmanager
+def span(stage: str):
+    """Time the enclosed block as `stage` (works around awaits too)."""
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        stage_errors.inc(stage=stage)
+        raise
+    finally:
+        stage_seconds.observe(time.perf_counter() - start, stage=stage)
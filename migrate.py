@@ -0,0 +1,122 @@
+# migrate.py
+# Explicit schema migration step. Run it once per deploy, before starting the web
+# server, instead of creating tables every time models.py is imported:
+#
+#   python migrate.py
+#
+# It creates missing tables, adds nullable columns that were added to existing
+# models, then applies the numbered migrations below that haven't run yet
+# (recorded in the `schema_migrations` table).
+
+import datetime
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect, text
+
+import analytics
+import search
+from models import Base, engine, student_class_association
+
+migrations_table = Table(
+    "schema_migrations",
+    MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("description", String(255)),
+    Column("applied_at", DateTime),
+)
+
+# version -> (description, function(connection)), applied in version order
+MIGRATIONS = {}
+
+
+def migration(version: int, description: str):
+    def register(fn):
+        MIGRATIONS[version] = (description, fn)
+        return fn
+    return register
+
+
+def add_missing_columns(engine=engine):
+    """Add nullable columns that exist on a model but not yet in its table."""
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {col["name"] for col in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing and column.nullable:
+                    col_type = column.type.compile(dialect=engine.dialect)
+                    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {col_type}'))
+
+
+@migration(1, "Composite primary key on student_class_association; indexes on hot lookup columns")
+def add_lookup_indexes(conn):
+    # Rebuild the association table with a (student_id, class_id) primary key,
+    # dropping duplicate and half-empty enrollment rows on the way
+    conn.execute(text("ALTER TABLE student_class_association RENAME TO student_class_association_old"))
+    student_class_association.create(conn)
+    conn.execute(text(
+        "INSERT INTO student_class_association (student_id, class_id) "
+        "SELECT DISTINCT student_id, class_id FROM student_class_association_old "
+        "WHERE student_id IS NOT NULL AND class_id IS NOT NULL"
+    ))
+    conn.execute(text("DROP TABLE student_class_association_old"))
+
+    for table_name in ("classes", "assignments", "comments", "grading_jobs"):
+        for index in Base.metadata.tables[table_name].indexes:
+            index.create(conn, checkfirst=True)
+
+
+@migration(2, "Index assignments.content_hash for the blob store")
+def add_content_hash_index(conn):
+    for index in Base.metadata.tables["assignments"].indexes:
+        if index.name == "ix_assignments_content_hash":
+            index.create(conn, checkfirst=True)
+
+
+@migration(3, "Full-text search index over assignment text, feedback and comments")
+def build_search_index(conn):
+    search.rebuild_index(conn)
+
+
+@migration(4, "Grade analytics rollups per class and student")
+def build_analytics_rollups(conn):
+    analytics.rebuild(conn)
+
+
+def applied_versions(conn) -> set:
+    return {row[0] for row in conn.execute(migrations_table.select().with_only_columns(migrations_table.c.version))}
+
+
+def migrate(engine=engine) -> list:
+    """Bring the database schema up to date. Returns the versions applied in this run."""
+    migrations_table.create(engine, checkfirst=True)
+    with engine.begin() as conn:
+        fresh_database = not applied_versions(conn) and not inspect(conn).has_table("students")
+
+    Base.metadata.create_all(bind=engine)
+    add_missing_columns(engine)
+    # Not an ORM table (FTS5 / tsvector), so create_all doesn't know about it
+    with engine.begin() as conn:
+        search.ensure_search_index(conn)
+
+    applied = []
+    with engine.begin() as conn:
+        done = applied_versions(conn)
+        for version in sorted(MIGRATIONS):
+            if version in done:
+                continue
+            description, fn = MIGRATIONS[version]
+            # create_all already builds a brand new database in its final shape
+            if not fresh_database:
+                fn(conn)
+            conn.execute(migrations_table.insert().values(
+                version=version, description=description, applied_at=datetime.datetime.utcnow()
+            ))
+            applied.append(version)
+    return applied
+
+
+if __name__ == "__main__":
+    applied = migrate()
+    print(f"Database is up to date ({len(applied)} migration(s) applied).")
@@ -1,23 +1,31 @@
 # models.py
 
-from sqlalchemy import create_engine, Column, Integer, String, Text, ForeignKey, Table, Enum
+from sqlalchemy import Column, Integer, BigInteger, Float, String, Text, ForeignKey, Table, Enum, DateTime, LargeBinary, Index, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.orm import relationship
 import enum 
+import datetime
 
-# Database URL
-DATABASE_URL = "sqlite:///./documents.db"
+# Engine and sessions are configured in database.py (DATABASE_URL, pool, SQLite pragmas)
+from database import DATABASE_URL, engine, SessionLocal
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+def get_db():
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
 # --- Association Table for Student-Class Many-to-Many ---
 student_class_association = Table(
     'student_class_association',
     Base.metadata,
-    Column('student_id', Integer, ForeignKey('students.id')),
-    Column('class_id', Integer, ForeignKey('classes.id'))
+    Column('student_id', Integer, ForeignKey('students.id'), primary_key=True),
+    Column('class_id', Integer, ForeignKey('classes.id'), primary_key=True),
+    # The primary key covers student -> classes; this covers class -> students (rosters)
+    Index('ix_student_class_association_class_student', 'class_id', 'student_id')
 )
 
 class Instructor(Base):
@@ -57,7 +65,7 @@ class Class(Base):
     year = Column(Integer)
     semester = Column(Enum(SemesterEnum), nullable=False) 
 
-    instructor_id = Column(Integer, ForeignKey('instructors.id'))
+    instructor_id = Column(Integer, ForeignKey('instructors.id'), index=True)
     instructor = relationship("Instructor", back_populates="classes")
 
     students = relationship(
@@ -67,13 +75,29 @@ class Class(Base):
     )
     assignments = relationship("Assignment", back_populates="class_obj")  
 
+class Blob(Base):
+    """One stored file per unique content, addressed by its SHA-256 (see storage.py)."""
+    __tablename__ = "blobs"
+
+    sha256 = Column(String(64), primary_key=True)
+    size = Column(Integer)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    last_used_at = Column(DateTime, default=datetime.datetime.utcnow)
+
 class Assignment(Base):
     __tablename__ = "assignments"
 
     id = Column(Integer, primary_key=True, index=True)
+    # Original upload name. Assignments saved before the blob store hold the name of
+    # their file in documents/ here and have no content_hash.
     filename = Column(String(255))
+    content_hash = Column(String(64), ForeignKey('blobs.sha256'))
     grade = Column(String(10))
     feedback = Column(Text)
+    extracted_text = Column(Text)
+    # LLM tokens spent on the latest grading of this assignment (0 when the grade came from the cache)
+    prompt_tokens = Column(Integer)
+    completion_tokens = Column(Integer)
 
     student_id = Column(Integer, ForeignKey('students.id'), nullable=False)
     student = relationship("Student", back_populates="assignments")
@@ -82,6 +106,15 @@ class Assignment(Base):
     class_obj = relationship("Class", back_populates="assignments")
     comment = relationship("Comment", uselist=False, back_populates="assignment")
 
+    __table_args__ = (
+        # Dashboards and class listings: WHERE class_id IN (...) [AND student_id = ?]
+        Index('ix_assignments_class_student', 'class_id', 'student_id'),
+        # Student results: WHERE student_id = ? ORDER BY id
+        Index('ix_assignments_student_id', 'student_id', 'id'),
+        # Blob garbage collection: is this content still referenced?
+        Index('ix_assignments_content_hash', 'content_hash'),
+    )
+
 class Admin(Base):
     __tablename__ = "admins"
 
@@ -93,8 +126,169 @@ class Admin(Base):
 class Comment(Base):
     __tablename__ = "comments"
     id = Column(Integer, primary_key=True, index=True)
-    assignment_id = Column(Integer, ForeignKey('assignments.id'), nullable=False)
+    assignment_id = Column(Integer, ForeignKey('assignments.id'), nullable=False, index=True)
     student_comment = Column(Text)
     instructor_response = Column(Text)
     assignment = relationship("Assignment", back_populates="comment")
-Base.metadata.create_all(bind=engine)
+
+# --- Grading Job Queue ---
+
+class JobStatusEnum(enum.Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+class GradingJob(Base):
+    __tablename__ = "grading_jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    status = Column(Enum(JobStatusEnum), nullable=False, default=JobStatusEnum.QUEUED, index=True)
+    filename = Column(String(255), nullable=False)
+    class_name = Column(String(255), nullable=False)
+    upload_path = Column(String(500))  # spooled upload, see storage.py
+    content_hash = Column(String(64))
+    size = Column(Integer)
+    payload = Column(LargeBinary)  # legacy: raw bytes of jobs queued before uploads were spooled to disk
+
+    student_id = Column(Integer, ForeignKey('students.id'), nullable=False)
+    assignment_id = Column(Integer, ForeignKey('assignments.id'))
+
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=3)
+    last_error = Column(Text)
+
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+    run_after = Column(DateTime, default=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        # Worker claim query: WHERE status = 'QUEUED' AND run_after <= now ORDER BY id
+        Index('ix_grading_jobs_status_run_after', 'status', 'run_after'),
+    )
+
+# --- CSV Import Jobs ---
+
+class CsvImportJob(Base):
+    __tablename__ = "csv_import_jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    status = Column(Enum(JobStatusEnum), nullable=False, default=JobStatusEnum.QUEUED, index=True)
+    filename = Column(String(255))
+    file_path = Column(String(500), nullable=False)
+    total_rows = Column(Integer)
+
+    # Checkpoint: number of data rows already committed. A resumed import skips these.
+    rows_processed = Column(Integer, nullable=False, default=0)
+    rows_skipped = Column(Integer, nullable=False, default=0)
+    students_inserted = Column(Integer, nullable=False, default=0)
+    instructors_inserted = Column(Integer, nullable=False, default=0)
+    classes_inserted = Column(Integer, nullable=False, default=0)
+    enrollments_inserted = Column(Integer, nullable=False, default=0)
+    error_count = Column(Integer, nullable=False, default=0)
+    errors = Column(Text)  # JSON list of {"row": ..., "error": ...}
+    last_error = Column(Text)
+
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    started_at = Column(DateTime)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+    finished_at = Column(DateTime)
+
+# --- Grading Cache ---
+
+class GradeCacheEntry(Base):
+    __tablename__ = "grade_cache"
+
+    key = Column(String(64), primary_key=True)
+    model = Column(String(100))
+    grade = Column(String(10))
+    feedback = Column(Text)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    last_used_at = Column(DateTime, default=datetime.datetime.utcnow, index=True)
+
+# --- Login Sessions ---
+
+class UserSession(Base):
+    __tablename__ = "sessions"
+
+    # SHA-256 of the session id; the id itself only ever lives in the signed cookie
+    id = Column(String(64), primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    role = Column(String(20), nullable=False)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+# --- Near-Duplicate Detection (see similarity.py) ---
+
+class DocumentSignature(Base):
+    """MinHash signature of an assignment's text."""
+    __tablename__ = "document_signatures"
+
+    assignment_id = Column(Integer, ForeignKey('assignments.id'), primary_key=True)
+    class_id = Column(Integer, ForeignKey('classes.id'), index=True)
+    student_id = Column(Integer, ForeignKey('students.id'), nullable=False)
+    signature = Column(LargeBinary, nullable=False)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+class LshBucket(Base):
+    """One LSH band of a signature: assignments sharing a bucket in a class are candidates."""
+    __tablename__ = "lsh_buckets"
+
+    # The primary key doubles as the lookup index: WHERE class_id = ? AND bucket IN (...)
+    class_id = Column(Integer, primary_key=True, autoincrement=False)
+    bucket = Column(BigInteger, primary_key=True, autoincrement=False)
+    assignment_id = Column(Integer, ForeignKey('assignments.id'), primary_key=True, autoincrement=False)
+
+class SimilarityMatch(Base):
+    """A pair of submissions in a class whose estimated similarity is above the threshold."""
+    __tablename__ = "similarity_matches"
+
+    id = Column(Integer, primary_key=True, index=True)
+    class_id = Column(Integer, ForeignKey('classes.id'), index=True)
+    assignment_id = Column(Integer, ForeignKey('assignments.id'), nullable=False)  # the later submission
+    matched_assignment_id = Column(Integer, ForeignKey('assignments.id'), nullable=False)
+    similarity = Column(Float, nullable=False)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        UniqueConstraint('assignment_id', 'matched_assignment_id', name='uq_similarity_matches_pair'),
+    )
+
+# --- Grade Analytics Rollups (see analytics.py) ---
+
+class ClassRollup(Base):
+    """Running totals for one class, updated as assignments are graded and commented on."""
+    __tablename__ = "class_rollups"
+
+    class_id = Column(Integer, ForeignKey('classes.id'), primary_key=True, autoincrement=False)
+    submissions = Column(Integer, nullable=False, default=0)
+    students = Column(Integer, nullable=False, default=0)  # students with at least one submission
+    graded = Column(Integer, nullable=False, default=0)  # submissions with a letter grade
+    grade_points = Column(Float, nullable=False, default=0)
+    comments = Column(Integer, nullable=False, default=0)
+    unanswered_comments = Column(Integer, nullable=False, default=0)
+    prompt_tokens = Column(Integer, nullable=False, default=0)
+    completion_tokens = Column(Integer, nullable=False, default=0)
+
+class ClassGradeCount(Base):
+    __tablename__ = "class_grade_counts"
+
+    class_id = Column(Integer, ForeignKey('classes.id'), primary_key=True, autoincrement=False)
+    grade = Column(String(10), primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+class StudentRollup(Base):
+    """Running totals for one student in one class."""
+    __tablename__ = "student_rollups"
+
+    class_id = Column(Integer, ForeignKey('classes.id'), primary_key=True, autoincrement=False)
+    student_id = Column(Integer, ForeignKey('students.id'), primary_key=True, autoincrement=False)
+    submissions = Column(Integer, nullable=False, default=0)
+    graded = Column(Integer, nullable=False, default=0)
+    grade_points = Column(Float, nullable=False, default=0)
+    comments = Column(Integer, nullable=False, default=0)
+    unanswered_comments = Column(Integer, nullable=False, default=0)
+    latest_assignment_id = Column(Integer)
+    latest_grade = Column(String(10))
+
+# Tables are created by migrate.py, not at import time.
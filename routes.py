@@ -1,57 +1,211 @@
 # --- Routes ---
-from fastapi import FastAPI, UploadFile, BackgroundTasks
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi import FastAPI, UploadFile
+from fastapi.responses import HTMLResponse, FileResponse, StreamingResponse, Response, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi import Request
-from models import Assignment, Class, Student, Instructor, Admin, Comment
-from  main import process_file, upload_csv
-from fastapi import Depends
-from models import SessionLocal
-from sqlalchemy.orm import Session
+from models import Assignment, Class, Student, Instructor, Admin, Comment, GradingJob, CsvImportJob
+from jobs import enqueue_grading_job, worker_pool
+from jobs import save_csv_upload, enqueue_csv_import, csv_import_progress, csv_import_runner
+from storage import receive_upload, UploadTooLarge, UploadSizeLimit, MAX_UPLOAD_BYTES, assignment_path, blob_gc, iter_zip
+from email.utils import formatdate, parsedate_to_datetime
+import mimetypes
+import time
+import metrics
+import asyncio
+import llm
+import extraction
+import search
+import analytics
+from dashboard_cache import dashboard_cache, class_scope, CLASS_LIST_SCOPE
+from markupsafe import Markup
+from fastapi import Depends, Cookie
+from models import SessionLocal, get_db
+import api
+from sqlalchemy.orm import Session, selectinload, joinedload, defer
+from collections import defaultdict
 from fastapi import Form
 from fastapi.responses import RedirectResponse
 from fastapi import status
-from fastapi import Cookie
+from auth import Identity, current_user, find_user_by_email, create_session, end_session, set_session_cookie, require_session_secret, LANDING_PAGES, SESSION_COOKIE
 import os
-app = FastAPI()
+from contextlib import asynccontextmanager
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    require_session_secret()
+    await llm.warm_encoding()
+    # Grading workers live for the lifetime of the web process
+    await worker_pool.start()
+    await csv_import_runner.start()
+    blob_gc.start()
+    yield
+    await blob_gc.stop()
+    await csv_import_runner.stop()
+    await worker_pool.stop()
+    await llm.get_backend().aclose()
+    extraction.shutdown_pool()
+
+app = FastAPI(lifespan=lifespan)
+# Refuse oversized uploads before their body is read and spooled
+app.add_middleware(UploadSizeLimit)
+
+
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    start = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        # Label by route template (/jobs/{job_id}), not the raw path, to keep the series bounded
+        route = request.scope.get("route")
+        path = route.path if route is not None else "unmatched"
+        metrics.http_requests.inc(method=request.method, route=path, status=status_code)
+        metrics.http_request_seconds.observe(time.perf_counter() - start, method=request.method, route=path)
 
+@app.get("/metrics")
+async def get_metrics():
+    # Scrape callbacks may query the database; keep them off the event loop
+    return PlainTextResponse(await asyncio.to_thread(metrics.render), media_type=metrics.CONTENT_TYPE)
 
 
 # Static & Template Setup
 templates = Jinja2Templates(directory="frontend-files")
 app.mount("/static", StaticFiles(directory="static"), name="static")
+app.include_router(api.router)
+
+def build_classes_data(db: Session, classes):
+    """Group every assignment of the given classes by (class, student) for the dashboards.
+
+    Classes must already have `students` loaded. All assignments (joined with their comments)
+    are fetched in one query for all classes, so the number of queries doesn't grow
+    with the number of classes or students.
+    """
+    class_ids = [class_.id for class_ in classes]
+    assignments_by_key = defaultdict(list)
+    if class_ids:
+        assignments = (
+            db.query(Assignment)
+            .filter(Assignment.class_id.in_(class_ids))
+            .options(joinedload(Assignment.comment), defer(Assignment.extracted_text))
+            .order_by(Assignment.id)
+            .all()
+        )
+        for assignment in assignments:
+            assignments_by_key[(assignment.class_id, assignment.student_id)].append(assignment)
+    # Stats come from the rollup tables, not from the assignments above
+    summaries = analytics.class_summaries(db, class_ids)
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+    classes_data = []
+    for class_ in classes:
+        classes_data.append({
+            "class": class_,
+            "instructor": class_.instructor,
+            "summary": summaries[class_.id],
+            "students": [
+                {"student": student, "assignments": assignments_by_key.get((class_.id, student.id), [])}
+                for student in class_.students
+            ]
+        })
+    return classes_data
+
+def class_fragments(db: Session, class_ids, template_name: str) -> list:
+    """The rendered per-class blocks of a dashboard, in class id order.
+
+    Blocks come from the dashboard cache; only classes without a current block are
+    queried and rendered, all of them together with build_classes_data.
+    """
+    keys = {class_scope(class_id): class_id for class_id in sorted(class_ids)}
+
+    def build(missing):
+        with metrics.span("dashboard_query"):
+            classes = (
+                db.query(Class)
+                .filter(Class.id.in_([keys[scope] for scope, _ in missing]))
+                .options(joinedload(Class.instructor), selectinload(Class.students))
+                .all()
+            )
+            classes_data = build_classes_data(db, classes)
+        template = templates.get_template(template_name)
+        rendered = {class_scope(info["class"].id): template.render(class_info=info) for info in classes_data}
+        # A class that no longer exists renders as nothing
+        return {(scope, key): rendered.get(scope, "") for scope, key in missing}
+
+    fragments = dashboard_cache.get_many([(scope, template_name) for scope in keys], build)
+    return [Markup(fragments[(scope, template_name)]) for scope in keys if fragments[(scope, template_name)]]
 
 @app.get("/", response_class=HTMLResponse)
-async def read_root(request: Request, db: Session = Depends(get_db), user_id: str = Cookie(default=None), user_role: str = Cookie(default=None)):
-    if not user_id or user_role != "student":
+async def read_root(request: Request, db: Session = Depends(get_db), user: Identity = Depends(current_user)):
+    if not user or user.role != "student":
         return RedirectResponse(url="/login")
 
-    classes = db.query(Class).join(Class.students).filter(Student.id == user_id).all()
-    return templates.TemplateResponse("index.html", {"request": request, "classes": classes})
+    # Enrollments come with the session identity; class names come from the cache
+    keys = {class_scope(class_id): class_id for class_id in sorted(user.class_ids)}
+
+    def build(missing):
+        ids = [keys[scope] for scope, _ in missing]
+        names = dict(db.query(Class.id, Class.name).filter(Class.id.in_(ids)).all())
+        return {(scope, "name"): names.get(keys[scope]) for scope, _ in missing}
+
+    names = dashboard_cache.get_many([(scope, "name") for scope in keys], build)
+    classes = [{"name": names[(scope, "name")]} for scope in keys if names[(scope, "name")] is not None]
+    return templates.TemplateResponse(request, "index.html", {"classes": classes})
 
 @app.post("/upload")
-async def upload_file(file: UploadFile, background_tasks: BackgroundTasks,  class_name: str = Form(...),  user_id: str = Cookie(default=None),  user_role: str = Cookie(default=None),db: Session = Depends(get_db)):
-    if not user_id or user_role != "student":
+async def upload_file(file: UploadFile, class_name: str = Form(...),  user: Identity = Depends(current_user),db: Session = Depends(get_db)):
+    if not user or user.role != "student":
         return {"error": "You must be logged in to upload assignments."}
-    content = await file.read()  # Read the file immediately
-
-    background_tasks.add_task(process_file, content , file.filename, class_name, db, user_id)
-    return {"message": "File received, grading in progress!"}
+    if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+        return {"error": f"File is larger than the {MAX_UPLOAD_BYTES} byte limit."}
+    try:
+        # Stream to the spool directory in chunks; only the path goes to the grader
+        with metrics.span("upload_receive"):
+            upload_path, size, content_hash = await receive_upload(file)
+    except UploadTooLarge as e:
+        return {"error": str(e)}
+
+    job = enqueue_grading_job(db, upload_path, file.filename, class_name, user.user_id, content_hash, size)
+    worker_pool.notify()
+    return {"message": "File received, grading in progress!", "job_id": job.id}
+
+@app.get("/jobs/{job_id}")
+async def get_job_status(job_id: int, user: Identity = Depends(current_user), db: Session = Depends(get_db)):
+    if not user or user.role != "student":
+        return {"error": "You must be logged in to view grading jobs."}
+
+    job = db.query(GradingJob).filter(GradingJob.id == job_id, GradingJob.student_id == user.user_id).first()
+    if not job:
+        return {"error": "Job not found or you are not authorized."}
+
+    return {
+        "id": job.id,
+        "status": job.status.value,
+        "filename": job.filename,
+        "class_name": job.class_name,
+        "attempts": job.attempts,
+        "max_attempts": job.max_attempts,
+        "assignment_id": job.assignment_id,
+        "error": job.last_error,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "updated_at": job.updated_at.isoformat() if job.updated_at else None,
+    }
 
 @app.get("/results")
-async def get_results(user_id: str = Cookie(default=None), db: Session = Depends(get_db)):
-    if not user_id:
+async def get_results(user: Identity = Depends(current_user), db: Session = Depends(get_db)):
+    if not user:
         return []
 
-    assignments = db.query(Assignment).filter(Assignment.student_id == int(user_id)).all()
+    assignments = (
+        db.query(Assignment)
+        .filter(Assignment.student_id == user.user_id)
+        .options(joinedload(Assignment.class_obj), selectinload(Assignment.comment), defer(Assignment.extracted_text))
+        .all()
+    )
     return [
         {
             "id": a.id, 
@@ -67,145 +221,190 @@ async def get_results(user_id: str = Cookie(default=None), db: Session = Depends
 @app.get("/instructor_dashboard", response_class=HTMLResponse)
 async def instructor_dashboard(
     request: Request,
-    user_id: str = Cookie(default=None),
-    user_role: str = Cookie(default=None),
+    user: Identity = Depends(current_user),
     db: Session = Depends(get_db)
 ):
-    if not user_id or user_role != "instructor":
+    if not user or user.role != "instructor":
         return RedirectResponse(url="/login")
-    instructor_id = int(user_id)
-    # Get all classes taught by this instructor
-    classes = db.query(Class).filter(Class.instructor_id == instructor_id).all()
-
-    classes_data = []
-    for class_ in classes:
-        students_data = []
-        for student in class_.students:
-            assignments = db.query(Assignment).filter(
-                Assignment.student_id == student.id,
-                Assignment.class_id == class_.id
-            ).all()
-            students_data.append({
-                "student": student,
-                "assignments": assignments
-            })
-
-        classes_data.append({
-            "class": class_,
-            "students": students_data
-        })
-
+    # The classes taught by this instructor come with the session identity
     return templates.TemplateResponse(
+        request,
         "instructor_dashboard.html",
-        {"request": request, "classes_data": classes_data}
+        {"class_fragments": class_fragments(db, user.class_ids, "instructor_dashboard_class.html")}
     )
+def not_modified(request: Request, etag: str, last_modified: float) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        return etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")] or if_none_match.strip() == "*"
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(last_modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
 @app.get("/download/{assignment_id}")
-async def download_assignment(assignment_id: int, db: Session = Depends(get_db)):
-    assignment = db.query(Assignment).filter(Assignment.id == assignment_id).first()
+async def download_assignment(assignment_id: int, request: Request, user: Identity = Depends(current_user), db: Session = Depends(get_db)):
+    if not user:
+        return {"error": "You must be logged in to download assignments."}
+
+    assignment = (
+        db.query(Assignment)
+        .options(defer(Assignment.extracted_text))
+        .filter(Assignment.id == assignment_id)
+        .first()
+    )
 
-    if not assignment:
+    # Students get their own files; instructors those of the classes they teach
+    if not assignment or not (assignment.student_id == user.user_id if user.role == "student" else user.can_view_class(assignment.class_id)):
         return {"error": "Assignment not found."}
 
-    file_path = os.path.join("documents", assignment.filename)
+    file_path = assignment_path(assignment)
 
-    if not os.path.exists(file_path):
+    try:
+        stat_result = await asyncio.to_thread(os.stat, file_path)
+    except OSError:
         return {"error": "File not found on server."}
 
+    # Blob-backed files never change, so the content hash is a strong validator
+    headers = {
+        "Cache-Control": "private, no-cache",
+        "Last-Modified": formatdate(stat_result.st_mtime, usegmt=True),
+    }
+    if assignment.content_hash:
+        headers["ETag"] = f'"{assignment.content_hash}"'
+        if not_modified(request, headers["ETag"], stat_result.st_mtime):
+            return Response(status_code=304, headers=headers)
+
+    # FileResponse streams the file and answers Range / If-Range requests itself
     return FileResponse(
         path=file_path,
         filename=assignment.filename,  # <-- What browser will name the downloaded file
-        media_type='application/octet-stream'  # <-- General binary type
+        media_type=mimetypes.guess_type(assignment.filename)[0] or 'application/octet-stream',
+        headers=headers,
+        stat_result=stat_result
+    )
+
+@app.get("/classes/{class_id}/submissions.zip")
+async def download_class_submissions(class_id: int, compress: bool = False, user: Identity = Depends(current_user), db: Session = Depends(get_db)):
+    if not user or not user.can_view_class(class_id):
+        return {"error": "Class not found or you are not authorized."}
+    class_obj = db.query(Class).filter(Class.id == class_id).first()
+    if not class_obj:
+        return {"error": "Class not found or you are not authorized."}
+
+    rows = (
+        db.query(Assignment.id, Assignment.filename, Assignment.content_hash, Student.email)
+        .join(Student, Student.id == Assignment.student_id)
+        .filter(Assignment.class_id == class_id)
+        .order_by(Student.email, Assignment.id)
+        .all()
     )
+    # Only (name, path) pairs go to the streaming generator; the session is done after this
+    entries = [
+        (f"{email}/{assignment_id}-{os.path.basename(filename)}",
+         assignment_path(Assignment(filename=filename, content_hash=content_hash)))
+        for assignment_id, filename, content_hash, email in rows
+    ]
+    archive_name = f"{class_obj.name.replace(' ', '_')}-submissions.zip"
+    return StreamingResponse(
+        iter_zip(entries, compress=compress),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{archive_name}"'}
+    )
+
 @app.get("/admin_dashboard", response_class=HTMLResponse)
 async def admin_dashboard(
     request: Request,
-    user_id: str = Cookie(default=None),
-    user_role: str = Cookie(default=None),
+    user: Identity = Depends(current_user),
     db: Session = Depends(get_db)):
-    if not user_id or user_role != "admin":
+    if not user or user.role != "admin":
         return RedirectResponse(url="/login")
 
-    classes = db.query(Class).all()
-
-    classes_data = []
-    for class_ in classes:
-        students_data = []
-        for student in class_.students:
-            assignments = db.query(Assignment).filter(
-                Assignment.student_id == student.id,
-                Assignment.class_id == class_.id
-            ).all()
-            students_data.append({
-                "student": student,
-                "assignments": assignments
-            })
-
-        classes_data.append({
-            "class": class_,
-            "instructor": class_.instructor,
-            "students": students_data
-        })
-    return templates.TemplateResponse("admin_dashboard.html", {"request": request, "classes_data": classes_data})
+    class_ids = dashboard_cache.get_many(
+        [(CLASS_LIST_SCOPE, "ids")],
+        lambda missing: {(CLASS_LIST_SCOPE, "ids"): [class_id for (class_id,) in db.query(Class.id).order_by(Class.id)]},
+    )[(CLASS_LIST_SCOPE, "ids")]
+    fragments = class_fragments(db, class_ids, "admin_dashboard_class.html")
+    return templates.TemplateResponse(request, "admin_dashboard.html", {"class_fragments": fragments})
 
 @app.post("/upload_csv")
-async def upload_file(file: UploadFile, user_id: str = Cookie(default=None), user_role: str = Cookie(default=None), db: Session = Depends(get_db)):
-    if not user_id or user_role != "admin":
+async def upload_file(file: UploadFile, user: Identity = Depends(current_user), db: Session = Depends(get_db)):
+    if not user or user.role != "admin":
         return {"error": "You must be logged in to upload csvs."}
 
-    content = await file.read()  
-
-    await upload_csv(content, db) 
-    return HTMLResponse(content="""
+    # Spool the upload to disk off the event loop, then import it in the background
+    file_path, total_rows = await asyncio.to_thread(save_csv_upload, file.file)
+    job = enqueue_csv_import(db, file_path, file.filename, total_rows)
+    csv_import_runner.submit(job.id)
+    return HTMLResponse(content=f"""
     <html>
-    <head><meta charset="utf-8"><title>Upload Success</title></head>
+    <head><meta charset="utf-8"><title>Upload Received</title></head>
     <body style="text-align:center; margin-top: 50px;">
-        <h2>Upload successful! Redirecting to Admin Dashboard...</h2>
+        <h2>Upload received! Importing CSV...</h2>
+        <p id="progress">Queued</p>
         <script>
-            setTimeout(function() {
-                window.location.href = '/admin_dashboard';
-            }, 1500);  // Redirect after 1.5 seconds
+            async function poll() {{
+                const response = await fetch('/csv_imports/{job.id}');
+                const job = await response.json();
+                document.getElementById('progress').textContent =
+                    `${{job.status}}: ${{job.rows_processed}} / ${{job.total_rows}} rows`;
+                if (job.status === 'done' || job.status === 'failed') {{
+                    setTimeout(function() {{
+                        window.location.href = '/admin_dashboard';
+                    }}, 1500);  // Redirect after 1.5 seconds
+                }} else {{
+                    setTimeout(poll, 1000);
+                }}
+            }}
+            poll();
         </script>
     </body>
     </html>
     """, status_code=200)
+
+@app.get("/csv_imports")
+async def list_csv_imports(user: Identity = Depends(current_user), db: Session = Depends(get_db)):
+    if not user or user.role != "admin":
+        return {"error": "You must be logged in as an admin to view imports."}
+
+    jobs = db.query(CsvImportJob).order_by(CsvImportJob.id.desc()).limit(10).all()
+    return [csv_import_progress(job) for job in jobs]
+
+@app.get("/csv_imports/{job_id}")
+async def get_csv_import(job_id: int, user: Identity = Depends(current_user), db: Session = Depends(get_db)):
+    if not user or user.role != "admin":
+        return {"error": "You must be logged in as an admin to view imports."}
+
+    job = db.query(CsvImportJob).filter(CsvImportJob.id == job_id).first()
+    if not job:
+        return {"error": "Import not found."}
+    return csv_import_progress(job)
+
 @app.get("/login", response_class=HTMLResponse)
 async def login_form(request: Request):
-    return templates.TemplateResponse("login.html", {"request": request, "error": ""})
+    return templates.TemplateResponse(request, "login.html", {"error": ""})
 
 @app.post("/login", response_class=HTMLResponse)
 async def login_submit(request: Request, email: str = Form(...), db: Session = Depends(get_db)):
-    student = db.query(Student).filter(Student.email == email).first()
-
-    if student:
-        response = RedirectResponse(url="/", status_code=302)
-        response.set_cookie(key="user_id", value=str(student.id))
-        response.set_cookie(key="user_role", value="student")
-        return response
-
-    # If not a student, check if Instructor
-    instructor = db.query(Instructor).filter(Instructor.email == email).first()
-
-    if instructor:
-        response = RedirectResponse(url="/instructor_dashboard", status_code=302)
-        response.set_cookie(key="user_id", value=str(instructor.id))
-        response.set_cookie(key="user_role", value="instructor")
-        return response
-    admin = db.query(Admin).filter(Admin.email == email).first()
-    if admin:
-        response = RedirectResponse(url="/admin_dashboard", status_code=302)
-        response.set_cookie(key="user_id", value=str(admin.id))
-        response.set_cookie(key="user_role", value="admin")
-        return response
-    # If neither found
-    return templates.TemplateResponse("login.html", {"request": request, "error": "User not found!"})
+    # One query across students, instructors and admins
+    user = find_user_by_email(db, email)
+    if not user:
+        return templates.TemplateResponse(request, "login.html", {"error": "User not found!"})
+
+    role, user_id = user
+    response = RedirectResponse(url=LANDING_PAGES[role], status_code=302)
+    set_session_cookie(response, create_session(db, role, user_id))
+    return response
 from fastapi import Form
 
 @app.post("/comment/{assignment_id}")
-async def student_comment(assignment_id: int, comment_text: str = Form(...), db: Session = Depends(get_db), user_id: str = Cookie(default=None),user_role: str = Cookie(default=None) ):
-    if not user_id or user_role != "student":
+async def student_comment(assignment_id: int, comment_text: str = Form(...), db: Session = Depends(get_db), user: Identity = Depends(current_user) ):
+    if not user or user.role != "student":
         return {"error": "You must be logged in as a student to comment."}
 
-    assignment = db.query(Assignment).filter(Assignment.id == assignment_id, Assignment.student_id == int(user_id)).first()
+    assignment = db.query(Assignment).filter(Assignment.id == assignment_id, Assignment.student_id == user.user_id).first()
 
     if not assignment:
         return {"error": "Assignment not found or you are not authorized."}
@@ -218,30 +417,40 @@ async def student_comment(assignment_id: int, comment_text: str = Form(...), db:
             student_comment=comment_text
         )
         db.add(new_comment)
+        analytics.record_comment(db, assignment.class_id, assignment.student_id, comments=1, unanswered=1)
 
+    class_id = assignment.class_id
+    search.index_assignment(db, assignment_id)
     db.commit()
+    dashboard_cache.invalidate_class(class_id)
     return {"message": "Comment submitted successfully."}
 
 @app.post("/comment_response/{assignment_id}")
-async def instructor_response(assignment_id: int, response_text: str = Form(...), db: Session = Depends(get_db), user_id: str = Cookie(default=None),user_role: str = Cookie(default=None)):
-    if not user_id or user_role != "instructor":
+async def instructor_response(assignment_id: int, response_text: str = Form(...), db: Session = Depends(get_db), user: Identity = Depends(current_user)):
+    if not user or user.role != "instructor":
         return {"error": "You must be logged in as an instructor to respond."}
 
     assignment = db.query(Assignment).filter(Assignment.id == assignment_id).first()
 
-    if not assignment or assignment.class_obj.instructor_id != int(user_id):
+    if not assignment or assignment.class_id not in user.class_ids:
         return {"error": "Assignment not found or you are not authorized."}
 
     if assignment.comment:
+        was_answered = bool(assignment.comment.instructor_response)
         assignment.comment.instructor_response = response_text
+        analytics.record_comment(db, assignment.class_id, assignment.student_id,
+                                 unanswered=int(was_answered) - int(bool(response_text)))
+        class_id = assignment.class_id
+        search.index_assignment(db, assignment_id)
         db.commit()
+        dashboard_cache.invalidate_class(class_id)
         return RedirectResponse(url="/instructor_dashboard", status_code=303)
     else:
         return {"error": "No comment from student to respond to."}
 
 @app.get("/logout")
-async def logout():
+async def logout(session: str = Cookie(default=None), db: Session = Depends(get_db)):
+    end_session(db, session)
     response = RedirectResponse(url="/login")
-    response.delete_cookie(key="user_id")
-    response.delete_cookie(key="user_role")
+    response.delete_cookie(key=SESSION_COOKIE)
     return response
\ No newline at end of file
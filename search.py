@@ -0,0 +1,271 @@
+# search.py
+# Full-text search over assignment text, grading feedback and comments.
+#
+# SQLite keeps an FTS5 table `assignment_search` (one row per assignment, rowid =
+# assignment id); PostgreSQL keeps a table of weighted tsvectors with a GIN index.
+# Rows are rewritten by `index_assignment` in the same transaction as the change
+# they reflect (a new assignment, a comment, a regrade), so the index never lags
+# behind the data. Results are ranked (bm25 / ts_rank_cd) and paged with an opaque
+# `next_after` cursor of the last row's rank and id.
+#
+# On SQLite each row also carries "scope" tokens (class<id>, student<id>), so the
+# caller's classes are applied inside the index lookup instead of after ranking
+# every match in the database.
+#
+#   python search.py rebuild      # re-index every assignment
+
+import re
+from typing import Iterable, Optional
+
+from sqlalchemy import bindparam, text
+
+# Column weights: filename, extracted text, feedback, comments (scope never scores)
+SQLITE_WEIGHTS = "0.0, 4.0, 1.0, 2.0, 2.0"
+SNIPPET_TOKENS = 16
+
+_SQLITE_SCHEMA = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS assignment_search USING fts5("
+    "scope, filename, body, feedback, comments, tokenize = 'porter unicode61')",
+]
+
+_POSTGRES_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS assignment_search ("
+    "assignment_id INTEGER PRIMARY KEY REFERENCES assignments(id) ON DELETE CASCADE, "
+    "class_id INTEGER, student_id INTEGER NOT NULL, document TSVECTOR NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS ix_assignment_search_document ON assignment_search USING GIN (document)",
+    "CREATE INDEX IF NOT EXISTS ix_assignment_search_class ON assignment_search (class_id)",
+    "CREATE INDEX IF NOT EXISTS ix_assignment_search_student ON assignment_search (student_id)",
+]
+
+_SQLITE_ROWS = """
+    SELECT a.id, 'class' || coalesce(a.class_id, 0) || ' student' || a.student_id,
+           coalesce(a.filename, ''), coalesce(a.extracted_text, ''), coalesce(a.feedback, ''),
+           coalesce((SELECT group_concat(coalesce(c.student_comment, '') || ' ' || coalesce(c.instructor_response, ''), ' ')
+                     FROM comments c WHERE c.assignment_id = a.id), '')
+    FROM assignments a
+"""
+
+_POSTGRES_ROWS = """
+    SELECT a.id, a.class_id, a.student_id,
+           setweight(to_tsvector('english', coalesce(a.filename, '')), 'A') ||
+           setweight(to_tsvector('english', coalesce(a.feedback, '')), 'B') ||
+           setweight(to_tsvector('english', coalesce((SELECT string_agg(concat_ws(' ', c.student_comment, c.instructor_response), ' ')
+                                                      FROM comments c WHERE c.assignment_id = a.id), '')), 'B') ||
+           setweight(to_tsvector('english', coalesce(a.extracted_text, '')), 'C')
+    FROM assignments a
+"""
+
+
+def _dialect(bind) -> str:
+    return bind.dialect.name
+
+
+def ensure_search_index(conn):
+    """Create the search table if it doesn't exist yet (called by migrate())."""
+    statements = _POSTGRES_SCHEMA if _dialect(conn) == "postgresql" else _SQLITE_SCHEMA
+    for statement in statements:
+        conn.execute(text(statement))
+
+
+def _reindex(conn, ids: Optional[list] = None):
+    """Delete and re-insert the index rows of the given assignments (all of them if ids is None)."""
+    if _dialect(conn) == "postgresql":
+        key, columns, rows = "assignment_id", "assignment_id, class_id, student_id, document", _POSTGRES_ROWS
+    else:
+        key, columns, rows = "rowid", "rowid, scope, filename, body, feedback, comments", _SQLITE_ROWS
+    delete = text("DELETE FROM assignment_search" + (f" WHERE {key} IN :ids" if ids is not None else ""))
+    insert = text(f"INSERT INTO assignment_search ({columns}) {rows}" + (" WHERE a.id IN :ids" if ids is not None else ""))
+    if ids is not None:
+        delete = delete.bindparams(bindparam("ids", expanding=True))
+        insert = insert.bindparams(bindparam("ids", expanding=True))
+    params = {"ids": ids} if ids is not None else {}
+    conn.execute(delete, params)
+    conn.execute(insert, params)
+
+
+def index_assignments(db, assignment_ids: Iterable[int]):
+    """Rewrite the index rows of these assignments in the caller's transaction.
+
+    Pending ORM changes are flushed first so the index sees them; the caller commits.
+    """
+    ids = sorted(set(assignment_ids))
+    if not ids:
+        return
+    db.flush()
+    conn = db.connection()
+    for start in range(0, len(ids), 500):
+        _reindex(conn, ids[start:start + 500])
+
+
+def index_assignment(db, assignment_id: int):
+    index_assignments(db, [assignment_id])
+
+
+def rebuild_index(conn) -> int:
+    """Re-index every assignment. Returns the number of rows indexed."""
+    _reindex(conn)
+    if _dialect(conn) != "postgresql":
+        # Merge the b-trees written by the bulk insert into one
+        conn.execute(text("INSERT INTO assignment_search (assignment_search) VALUES ('optimize')"))
+    return conn.execute(text("SELECT count(*) FROM assignment_search")).scalar()
+
+
+# --- Queries ---
+
+_QUERY_PART = re.compile(r'"([^"]*)"|(\S+)')
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+
+def fts5_query(query: str) -> str:
+    """Turn free text into a safe FTS5 expression: every word must match.
+
+    "Quoted words" stay a phrase and a trailing * on a word makes it a prefix search.
+    Operators and column filters typed by the user are treated as plain words.
+    """
+    terms = []
+    for phrase, word in _QUERY_PART.findall(query):
+        if phrase:
+            words = _WORD.findall(phrase)
+            if words:
+                terms.append('"' + " ".join(words) + '"')
+            continue
+        prefix = word.endswith("*")
+        for token in _WORD.findall(word):
+            terms.append(f'"{token}"')
+        if prefix and terms and _WORD.findall(word):
+            terms[-1] += "*"
+    return " ".join(terms)
+
+
+def encode_cursor(rank: float, assignment_id: int) -> str:
+    return f"{rank!r}:{assignment_id}"
+
+
+def decode_cursor(cursor: Optional[str]):
+    """(rank, id) from a `next_after` value; None if there is none; False if it is malformed."""
+    if not cursor:
+        return None
+    try:
+        rank, assignment_id = cursor.rsplit(":", 1)
+        return float(rank), int(assignment_id)
+    except ValueError:
+        return False
+
+
+def _sqlite_search(db, query, class_ids, student_id, after, limit):
+    terms = fts5_query(query)
+    if not terms:
+        return [], None
+    scopes = []
+    if class_ids is not None:
+        scopes += [f"class{int(class_id)}" for class_id in class_ids]
+    if student_id is not None:
+        scopes.append(f"student{int(student_id)}")
+    match = "{filename body feedback comments} : (" + terms + ")"
+    if class_ids is not None and student_id is not None:
+        match += " AND scope : (" + " OR ".join(scopes[:-1]) + ") AND scope : " + scopes[-1]
+    elif scopes:
+        match += " AND scope : (" + " OR ".join(scopes) + ")"
+
+    rank = f"bm25(assignment_search, {SQLITE_WEIGHTS})"
+    params = {"match": match, "limit": limit + 1}
+    keyset = ""
+    if after:
+        keyset = f"AND ({rank} > :rank OR ({rank} = :rank AND assignment_search.rowid > :after_id))"
+        params.update(rank=after[0], after_id=after[1])
+    rows = db.execute(text(f"""
+        SELECT assignment_search.rowid AS id, {rank} AS bm25_rank, a.filename, a.class_id, a.student_id, a.grade
+        FROM assignment_search JOIN assignments a ON a.id = assignment_search.rowid
+        WHERE assignment_search MATCH :match {keyset}
+        ORDER BY bm25_rank, id
+        LIMIT :limit
+    """), params).all()
+    next_after = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_after = encode_cursor(rows[-1].bm25_rank, rows[-1].id)
+
+    # Snippets only for the page, matching the user's terms alone so scope tokens aren't highlighted
+    snippets = {}
+    if rows:
+        snippets = dict(db.execute(text(
+            f"SELECT rowid, snippet(assignment_search, -1, '[', ']', '…', {SNIPPET_TOKENS}) FROM assignment_search "
+            "WHERE assignment_search MATCH :match AND rowid IN :ids"
+        ).bindparams(bindparam("ids", expanding=True)), {
+            "match": "{filename body feedback comments} : (" + terms + ")", "ids": [row.id for row in rows],
+        }).all())
+    return [_result(row, -row.bm25_rank, snippets.get(row.id)) for row in rows], next_after
+
+
+def _postgres_search(db, query, class_ids, student_id, after, limit):
+    filters, params = [], {"query": query, "limit": limit + 1}
+    if class_ids is not None:
+        filters.append("s.class_id = ANY(:class_ids)")
+        params["class_ids"] = list(class_ids)
+    if student_id is not None:
+        filters.append("s.student_id = :student_id")
+        params["student_id"] = student_id
+    rank = "ts_rank_cd(s.document, q)::float8"
+    if after:
+        filters.append(f"({rank} < :rank OR ({rank} = :rank AND s.assignment_id > :after_id))")
+        params.update(rank=after[0], after_id=after[1])
+    where = "".join(f" AND {f}" for f in filters)
+    rows = db.execute(text(f"""
+        SELECT page.id, page.rank, a.filename, a.class_id, a.student_id, a.grade,
+               ts_headline('english', concat_ws(' ', a.feedback, a.extracted_text), page.q,
+                           'StartSel=[, StopSel=], MaxWords={SNIPPET_TOKENS}, MinWords=5') AS snippet
+        FROM (
+            SELECT s.assignment_id AS id, {rank} AS rank, q
+            FROM assignment_search s, websearch_to_tsquery('english', :query) q
+            WHERE s.document @@ q{where}
+            ORDER BY rank DESC, id
+            LIMIT :limit
+        ) page JOIN assignments a ON a.id = page.id
+        ORDER BY page.rank DESC, page.id
+    """), params).all()
+    # ts_headline runs over the page rows only, not over every match
+    next_after = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_after = encode_cursor(rows[-1].rank, rows[-1].id)
+    return [_result(row, row.rank, row.snippet) for row in rows], next_after
+
+
+def _result(row, score: float, snippet: Optional[str]) -> dict:
+    return {
+        "id": row.id,
+        "filename": row.filename,
+        "class_id": row.class_id,
+        "student_id": row.student_id,
+        "grade": row.grade,
+        "score": round(score, 6),
+        "snippet": snippet,
+    }
+
+
+def search(db, query: str, class_ids: Optional[Iterable[int]] = None, student_id: Optional[int] = None,
+           after=None, limit: int = 20):
+    """Ranked page of assignments matching `query`. Returns (results, next_after).
+
+    `class_ids` and `student_id` restrict the search (None means no restriction);
+    `after` is a decoded cursor from a previous page.
+    """
+    if class_ids is not None:
+        class_ids = sorted(set(class_ids))
+        if not class_ids:
+            return [], None
+    if _dialect(db.get_bind()) == "postgresql":
+        return _postgres_search(db, query, class_ids, student_id, after, limit)
+    return _sqlite_search(db, query, class_ids, student_id, after, limit)
+
+
+if __name__ == "__main__":
+    import sys
+
+    from models import engine
+
+    if len(sys.argv) != 2 or sys.argv[1] != "rebuild":
+        sys.exit("usage: python search.py rebuild")
+    with engine.begin() as conn:
+        ensure_search_index(conn)
+        print(f"Indexed {rebuild_index(conn)} assignment(s).")
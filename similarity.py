@@ -0,0 +1,229 @@
+# similarity.py
+# Near-duplicate detection between submissions of the same class.
+#
+# Each assignment's text is cut into overlapping word shingles and summarized by a
+# MinHash signature (one-permutation hashing: one hash per shingle, the minimum
+# kept in each of MINHASH_SIZE bins). The signature is split into LSH_BANDS bands;
+# every band is one row in `lsh_buckets`, keyed by class and a hash of the band.
+# A new submission only looks at the assignments sharing at least one bucket with
+# it, so a lookup is a handful of index probes however large the class grows.
+# Candidates whose estimated Jaccard similarity reaches SIMILARITY_THRESHOLD are
+# recorded in `similarity_matches`.
+#
+# Signatures stored with one MINHASH_SIZE / LSH_BANDS / SHINGLE_SIZE can't be
+# compared with another; after changing them, clear the tables and backfill.
+#
+#   python similarity.py backfill ["Class name"]
+
+import array
+import asyncio
+import hashlib
+import os
+import re
+from typing import Optional
+
+from sqlalchemy import func, insert
+
+import metrics
+from models import Assignment, DocumentSignature, LshBucket, SimilarityMatch
+
+SHINGLE_SIZE = int(os.getenv("SHINGLE_SIZE", "5"))
+MINHASH_SIZE = int(os.getenv("MINHASH_SIZE", "128"))
+LSH_BANDS = int(os.getenv("LSH_BANDS", "32"))
+SIMILARITY_THRESHOLD = float(os.getenv("SIMILARITY_THRESHOLD", "0.5"))
+# Bound on the candidates verified per upload, so one very common text (a template
+# everyone submitted unchanged) can't make lookups linear in the class size
+SIMILARITY_MAX_CANDIDATES = int(os.getenv("SIMILARITY_MAX_CANDIDATES", "200"))
+SIMILARITY_BACKFILL_BATCH = int(os.getenv("SIMILARITY_BACKFILL_BATCH", "500"))
+
+_MAX_HASH = (1 << 64) - 1
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+matches_found = metrics.Counter("similarity_matches_total", "Near-duplicate submission pairs found.")
+
+
+def _hash64(data: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "big")
+
+
+def shingles(text: str, size: int = SHINGLE_SIZE) -> set:
+    """Hashes of the overlapping `size`-word sequences of the text, case-insensitive."""
+    words = _WORD.findall(text.lower())
+    if len(words) < size:
+        return {_hash64(" ".join(words).encode())} if words else set()
+    return {_hash64(" ".join(words[i:i + size]).encode()) for i in range(len(words) - size + 1)}
+
+
+def minhash(hashes, size: int = MINHASH_SIZE) -> Optional[tuple]:
+    """One-permutation MinHash of a set of 64-bit hashes, or None for an empty set.
+
+    Bins no hash fell into borrow the value of the next non-empty bin to their
+    right (plus a per-distance offset), so every position stays comparable.
+    """
+    if not hashes:
+        return None
+    bin_width = (_MAX_HASH // size) + 1
+    bins = [None] * size
+    for h in hashes:
+        index, value = divmod(h, bin_width)
+        current = bins[index]
+        if current is None or value < current:
+            bins[index] = value
+    if None in bins:
+        filled = [i for i, value in enumerate(bins) if value is not None]
+        for i in range(size):
+            if bins[i] is None:
+                donor = next((j for j in filled if j > i), filled[0] + size)
+                bins[i] = bins[donor % size] + (donor - i) * bin_width
+    return tuple(bins)
+
+
+def signature(text: str) -> Optional[tuple]:
+    return minhash(shingles(text))
+
+
+def estimate_similarity(a, b) -> float:
+    """Estimated Jaccard similarity of the shingle sets behind two signatures."""
+    return sum(x == y for x, y in zip(a, b)) / len(a)
+
+
+def lsh_buckets(sig, bands: int = LSH_BANDS) -> list:
+    """One signed 64-bit bucket key per band (fits an SQL BIGINT)."""
+    rows = len(sig) // bands
+    keys = []
+    for band in range(bands):
+        values = array.array("Q", sig[band * rows:(band + 1) * rows])
+        digest = hashlib.blake2b(band.to_bytes(2, "big") + values.tobytes(), digest_size=8).digest()
+        keys.append(int.from_bytes(digest, "big", signed=True))
+    return keys
+
+
+def pack_signature(sig) -> bytes:
+    # Densified values of empty bins can pass 2**64, so they are stored modulo 2**64
+    return array.array("Q", (value & _MAX_HASH for value in sig)).tobytes()
+
+
+def unpack_signature(data: bytes) -> tuple:
+    return tuple(array.array("Q", data))
+
+
+def index_document(db, assignment_id: int, class_id: Optional[int], student_id: int, sig) -> list:
+    """Compare a new assignment with its class and add it to the LSH index.
+
+    Runs in the caller's transaction. Returns [(matched assignment id, similarity)]
+    for the earlier submissions by other students that reach the threshold.
+    """
+    if sig is None:
+        return []
+    class_key = class_id or 0
+    sig = unpack_signature(pack_signature(sig))
+    buckets = lsh_buckets(sig)
+
+    with metrics.span("similarity_lookup"):
+        collisions = func.count().label("collisions")
+        candidates = [row.assignment_id for row in db.query(LshBucket.assignment_id, collisions)
+                      .filter(LshBucket.class_id == class_key, LshBucket.bucket.in_(buckets),
+                              LshBucket.assignment_id != assignment_id)
+                      .group_by(LshBucket.assignment_id)
+                      .order_by(collisions.desc())
+                      .limit(SIMILARITY_MAX_CANDIDATES)]
+        matches = []
+        if candidates:
+            rows = db.query(DocumentSignature.assignment_id, DocumentSignature.signature).filter(
+                DocumentSignature.assignment_id.in_(candidates), DocumentSignature.student_id != student_id
+            )
+            for other_id, data in rows:
+                similarity = estimate_similarity(sig, unpack_signature(data))
+                if similarity >= SIMILARITY_THRESHOLD:
+                    matches.append((other_id, similarity))
+
+    existing = db.get(DocumentSignature, assignment_id)
+    if existing is not None:
+        # Re-indexed: drop the old buckets by primary key (there is no assignment_id index to scan)
+        db.query(LshBucket).filter(
+            LshBucket.class_id == (existing.class_id or 0),
+            LshBucket.bucket.in_(lsh_buckets(unpack_signature(existing.signature))),
+            LshBucket.assignment_id == assignment_id,
+        ).delete(synchronize_session=False)
+        db.delete(existing)
+        db.flush()
+    db.add(DocumentSignature(assignment_id=assignment_id, class_id=class_id, student_id=student_id,
+                             signature=pack_signature(sig)))
+    db.execute(insert(LshBucket), [
+        {"class_id": class_key, "bucket": bucket, "assignment_id": assignment_id} for bucket in set(buckets)
+    ])
+    for other_id, similarity in matches:
+        db.add(SimilarityMatch(class_id=class_id, assignment_id=assignment_id, matched_assignment_id=other_id,
+                               similarity=round(similarity, 4)))
+    matches_found.inc(len(matches))
+    return sorted(matches, key=lambda match: -match[1])
+
+
+async def backfill(db, class_id: Optional[int] = None, batch_size: int = SIMILARITY_BACKFILL_BATCH) -> dict:
+    """Index every assignment that has no signature yet, oldest first, one batch per commit.
+
+    Going in id order compares each assignment with the ones submitted before it,
+    exactly as if it had been indexed on upload.
+    """
+    import search
+    from extraction import load_assignment_text
+    from main import log_error
+
+    done = {"indexed": 0, "matches": 0, "skipped": 0}
+    after = 0
+    while True:
+        query = (
+            db.query(Assignment)
+            .outerjoin(DocumentSignature, DocumentSignature.assignment_id == Assignment.id)
+            .filter(DocumentSignature.assignment_id.is_(None), Assignment.id > after)
+        )
+        if class_id is not None:
+            query = query.filter(Assignment.class_id == class_id)
+        batch = query.order_by(Assignment.id).limit(batch_size).all()
+        if not batch:
+            return done
+        texts, extracted = [], []
+        for assignment in batch:
+            try:
+                text, was_extracted = await load_assignment_text(assignment)
+            except Exception as e:
+                log_error(f"Error loading text of assignment {assignment.id}: {str(e)}")
+                text, was_extracted = "", False
+            texts.append(text)
+            if was_extracted:
+                extracted.append(assignment.id)
+        if extracted:
+            search.index_assignments(db, extracted)
+        # Signatures are CPU-bound; compute the whole batch off the event loop
+        signatures = await asyncio.to_thread(lambda: [signature(text) for text in texts])
+        for assignment, sig in zip(batch, signatures):
+            if sig is None:
+                done["skipped"] += 1
+                continue
+            matches = index_document(db, assignment.id, assignment.class_id, assignment.student_id, sig)
+            done["indexed"] += 1
+            done["matches"] += len(matches)
+            # Later assignments of the batch must see this one's buckets
+            db.flush()
+        db.commit()
+        after = batch[-1].id
+
+
+if __name__ == "__main__":
+    import sys
+
+    from models import Class, SessionLocal
+
+    if len(sys.argv) not in (2, 3) or sys.argv[1] != "backfill":
+        sys.exit('usage: python similarity.py backfill ["Class name"]')
+    db = SessionLocal()
+    try:
+        class_id = None
+        if len(sys.argv) == 3:
+            class_obj = db.query(Class).filter(Class.name == sys.argv[2]).first()
+            if class_obj is None:
+                sys.exit(f"Class {sys.argv[2]} not found.")
+            class_id = class_obj.id
+        print(asyncio.run(backfill(db, class_id)))
+    finally:
+        db.close()
@@ -0,0 +1,358 @@
+# storage.py
+# File handling for uploads.
+#
+# Incoming files are streamed in chunks to a spool directory with the disk writes
+# pushed off the event loop, the size limit is enforced while reading, and the
+# SHA-256 of the content is computed in the same pass. Only the spooled path is
+# handed on to the grading job.
+#
+# Graded files are kept in a content-addressed blob store: one copy per unique
+# content at BLOB_DIR/ab/cd/abcd..., referenced from Assignment.content_hash. A
+# background collector removes blobs no assignment points to any more.
+
+import asyncio
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+import zipfile
+
+from sqlalchemy import exists
+
+from models import Assignment, Blob, SessionLocal
+
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", "uploads")
+DOCUMENTS_DIR = os.getenv("DOCUMENTS_DIR", "documents")
+BLOB_DIR = os.getenv("BLOB_DIR", os.path.join(DOCUMENTS_DIR, "blobs"))
+# Blobs (and stray files) younger than this are never collected, so a grading job
+# that has stored its file but not committed yet can't lose it
+BLOB_GC_GRACE_SECONDS = float(os.getenv("BLOB_GC_GRACE_SECONDS", "3600"))
+BLOB_GC_INTERVAL_SECONDS = float(os.getenv("BLOB_GC_INTERVAL_SECONDS", "3600"))
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(50 * 1024 * 1024)))
+# Room for the multipart boundaries and form fields around the file itself
+MAX_UPLOAD_OVERHEAD_BYTES = 64 * 1024
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class UploadSizeLimit:
+    """ASGI middleware refusing upload request bodies over the limit with 413.
+
+    The multipart body is otherwise parsed (and spooled to disk) by Starlette before
+    the route runs, so a size check in the route comes after the whole transfer.
+    This answers at once when Content-Length is too large, and stops reading a body
+    without one as soon as it passes the limit.
+    """
+
+    def __init__(self, app, paths=("/upload",), max_bytes: int = None):
+        self.app = app
+        self.paths = set(paths)
+        self.max_bytes = max_bytes
+
+    @property
+    def limit(self) -> int:
+        return self.max_bytes if self.max_bytes is not None else MAX_UPLOAD_BYTES + MAX_UPLOAD_OVERHEAD_BYTES
+
+    async def _reject(self, send):
+        body = json.dumps({"error": f"File is larger than the {MAX_UPLOAD_BYTES} byte limit."}).encode()
+        await send({"type": "http.response.start", "status": 413,
+                    "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()),
+                                (b"connection", b"close")]})
+        await send({"type": "http.response.body", "body": body})
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            return await self.app(scope, receive, send)
+        limit = self.limit
+        length = dict(scope["headers"]).get(b"content-length")
+        if length is not None and length.isdigit() and int(length) > limit:
+            return await self._reject(send)
+
+        received = 0
+        too_large = False
+
+        async def limited_receive():
+            nonlocal received, too_large
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    too_large = True
+                    raise UploadTooLarge(f"Request body is larger than {limit} bytes.")
+            return message
+
+        async def guarded_send(message):
+            # Whatever error response the app makes of the aborted body is replaced by the 413
+            if not too_large:
+                await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except UploadTooLarge:
+            pass
+        if too_large:
+            await self._reject(send)
+
+
+def _spool_path() -> str:
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    return os.path.join(UPLOAD_DIR, uuid.uuid4().hex)
+
+
+async def receive_upload(upload, max_bytes: int = MAX_UPLOAD_BYTES):
+    """Stream an UploadFile to the spool directory. Returns (path, size, sha256 hex digest)."""
+    path = _spool_path()
+    digest = hashlib.sha256()
+    size = 0
+    f = await asyncio.to_thread(open, path, "wb")
+    try:
+        while True:
+            chunk = await upload.read(UPLOAD_CHUNK_BYTES)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_bytes:
+                raise UploadTooLarge(f"File is larger than the {max_bytes} byte limit.")
+            digest.update(chunk)
+            await asyncio.to_thread(f.write, chunk)
+    except BaseException:
+        await asyncio.to_thread(f.close)
+        discard(path)
+        raise
+    await asyncio.to_thread(f.close)
+    return path, size, digest.hexdigest()
+
+
+def spool_bytes(content: bytes):
+    """Write in-memory content to the spool directory. Returns (path, size, sha256 hex digest)."""
+    path = _spool_path()
+    with open(path, "wb") as f:
+        f.write(content)
+    return path, len(content), hashlib.sha256(content).hexdigest()
+
+
+def discard(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_BYTES), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def blob_path(content_hash: str) -> str:
+    return os.path.join(BLOB_DIR, content_hash[:2], content_hash[2:4], content_hash)
+
+
+def assignment_path(assignment) -> str:
+    if assignment.content_hash:
+        return blob_path(assignment.content_hash)
+    return os.path.join(DOCUMENTS_DIR, assignment.filename)
+
+
+def store_blob_file(src_path: str, content_hash: str) -> bool:
+    """Place src_path's content in the blob store, leaving src_path where it is.
+
+    Returns True if a new blob file was created, False if identical content was
+    already stored. Blocking; call from a thread.
+    """
+    path = blob_path(content_hash)
+    if os.path.exists(path):
+        return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        # A hard link is atomic and fails if another job stored the same content first
+        os.link(src_path, path)
+        return True
+    except FileExistsError:
+        return False
+    except OSError:
+        pass
+
+    # Upload spool and blob store are on different filesystems: copy, then link into place
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    shutil.copyfile(src_path, tmp_path)
+    try:
+        os.link(tmp_path, path)
+        return True
+    except FileExistsError:
+        return False
+    finally:
+        discard(tmp_path)
+
+
+def remember_blob(db, content_hash: str, size: int):
+    """Record (or refresh) the Blob row for stored content; committed by the caller."""
+    now = datetime.datetime.utcnow()
+    blob = db.query(Blob).filter(Blob.sha256 == content_hash).first()
+    if blob:
+        blob.last_used_at = now
+    else:
+        db.add(Blob(sha256=content_hash, size=size, created_at=now, last_used_at=now))
+
+
+def collect_garbage(db, grace_seconds: float = BLOB_GC_GRACE_SECONDS) -> dict:
+    """Delete blobs that no assignment references, plus orphaned files in BLOB_DIR."""
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=grace_seconds)
+    unreferenced = (
+        db.query(Blob)
+        .filter(Blob.last_used_at < cutoff)
+        .filter(~exists().where(Assignment.content_hash == Blob.sha256))
+        .all()
+    )
+    for blob in unreferenced:
+        discard(blob_path(blob.sha256))
+        db.delete(blob)
+    db.commit()
+
+    # Files whose job never committed (crash between storing and committing)
+    orphan_files = 0
+    known = None
+    oldest_mtime = time.time() - grace_seconds
+    for root, _, files in os.walk(BLOB_DIR):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                if os.path.getmtime(path) >= oldest_mtime:
+                    continue
+            except OSError:
+                continue
+            if known is None:
+                known = {sha for (sha,) in db.query(Blob.sha256)}
+            if name not in known:
+                discard(path)
+                orphan_files += 1
+
+    return {"blobs_removed": len(unreferenced), "orphan_files_removed": orphan_files}
+
+
+class _ZipChunkBuffer:
+    """Write-only, unseekable file object that collects what ZipFile writes."""
+
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def iter_zip(entries, compress: bool = False):
+    """Yield a zip archive of (archive name, file path) entries chunk by chunk.
+
+    Nothing is buffered beyond one read chunk, so the archive is never built in
+    memory or on disk. Blocking; StreamingResponse runs it in a worker thread.
+    """
+    buffer = _ZipChunkBuffer()
+    compression = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+    with zipfile.ZipFile(buffer, mode="w", compression=compression, allowZip64=True) as archive:
+        for arcname, path in entries:
+            try:
+                src = open(path, "rb")
+            except OSError:
+                continue
+            info = zipfile.ZipInfo.from_file(path, arcname)
+            info.compress_type = compression
+            with src, archive.open(info, mode="w", force_zip64=True) as dest:
+                for chunk in iter(lambda: src.read(UPLOAD_CHUNK_BYTES), b""):
+                    dest.write(chunk)
+                    if buffer.chunks:
+                        yield buffer.drain()
+            if buffer.chunks:
+                yield buffer.drain()
+    # Central directory, written when the archive closes
+    if buffer.chunks:
+        yield buffer.drain()
+
+
+def backfill_legacy_documents(db) -> int:
+    """Move files saved before the blob store (flat documents/ names) into blobs."""
+    moved = 0
+    legacy = db.query(Assignment).filter(Assignment.content_hash.is_(None)).all()
+    for assignment in legacy:
+        path = os.path.join(DOCUMENTS_DIR, assignment.filename)
+        if not os.path.exists(path):
+            continue
+        content_hash = hash_file(path)
+        store_blob_file(path, content_hash)
+        remember_blob(db, content_hash, os.path.getsize(path))
+        assignment.content_hash = content_hash
+        db.commit()
+        discard(path)
+        moved += 1
+    return moved
+
+
+class BlobGarbageCollector:
+    def __init__(self, interval: float = BLOB_GC_INTERVAL_SECONDS, session_factory=SessionLocal):
+        self.interval = interval
+        self.session_factory = session_factory
+        self._task = None
+
+    def _collect(self):
+        db = self.session_factory()
+        try:
+            return collect_garbage(db)
+        finally:
+            db.close()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await asyncio.to_thread(self._collect)
+            except Exception as e:
+                from main import log_error
+                log_error(f"Error collecting unreferenced blobs: {str(e)}")
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+blob_gc = BlobGarbageCollector()
+
+
+if __name__ == "__main__":
+    import sys
+
+    db = SessionLocal()
+    try:
+        if sys.argv[1:] == ["backfill"]:
+            print(f"Moved {backfill_legacy_documents(db)} legacy document(s) into the blob store.")
+        elif sys.argv[1:] == ["gc"]:
+            print(collect_garbage(db))
+        else:
+            print("usage: python storage.py backfill|gc")
+    finally:
+        db.close()